@@ -8,19 +8,24 @@ from typing import Dict, Any, List
 from datetime import datetime
 from uuid import uuid4
 import os
-import requests
 import threading
+import heapq
+import itertools
+from functools import lru_cache
+from collections import OrderedDict, deque
+from datetime import date, timedelta
 from concurrent.futures import ThreadPoolExecutor
+from room_archive import RoomArchive
+from broadcast import Broadcaster, RateLimiter, DEFERRED
+from retry_policy import RetryPolicy, CircuitBreaker
+from templates import render, fit_message, TELEGRAM_MESSAGE_LIMIT
+import metrics
+from log_pipeline import setup_logging
+import tracing
+from router import Router
+from update_recorder import UpdateRecorder
 
-# --- Настройка логирования ---
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler('santa_bot.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+# Логирование (очередь, santa_bot.log и консоль) настраивает runtime.start(), а не импорт модуля
 logger = logging.getLogger(__name__)
 
 # --- Обработчик остановки бота ---
@@ -34,9 +39,23 @@ def signal_handler(sig, frame):
 # signal.signal(signal.SIGINT, signal_handler)
 
 # --- Получаем токен из переменных окружения Scalingo ---
+# Без токена модуль импортируется (бенчмарки, проверки), но runtime.start() откажется запускаться
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 
-if not BOT_TOKEN:
+# TELEGRAM_API_URL позволяет направить бота на локальный fake_telegram для нагрузочных тестов
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+BASE_URL = f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}"
+
+def configure(token=None, api_url=None):
+    """Задает токен и адрес Bot API (по умолчанию - из окружения).
+    Возвращает False, если токена нет"""
+    global BOT_TOKEN, TELEGRAM_API_URL, BASE_URL
+    BOT_TOKEN = token or os.environ.get('BOT_TOKEN')
+    TELEGRAM_API_URL = (api_url or os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')).rstrip('/')
+    BASE_URL = f"{TELEGRAM_API_URL}/bot{BOT_TOKEN}"
+    return bool(BOT_TOKEN)
+
+def print_token_help():
     print("❌ ОШИБКА: Токен бота не найден!")
     print("Добавьте переменную окружения BOT_TOKEN в Scalingo:")
     print("1. Зайдите в Dashboard Scalingo")
@@ -45,17 +64,53 @@ if not BOT_TOKEN:
     print("4. Name: BOT_TOKEN")
     print("5. Value: ваш_токен_от_BotFather")
     print("\nПолучить токен можно у @BotFather в Telegram")
-    sys.exit(1)
 
-BASE_URL = f"https://api.telegram.org/bot{BOT_TOKEN}"
+# --- Данные о самом боте (getMe) ---
+BOT_IDENTITY_REFRESH = 3600  # Обновляем раз в час в фоне
+
+bot_identity = {}  # Результат getMe: id, username, first_name...
+_identity_refresher = None
+
+def get_bot_username():
+    """Username бота из кэша, без сетевых запросов (None, если еще не получен)"""
+    return bot_identity.get('username')
+
+def refresh_bot_identity():
+    """Запрашивает getMe и обновляет кэш"""
+    try:
+        response = runtime.session.get(f"{BASE_URL}/getMe", timeout=10)
+        data = response.json()
+        if response.status_code == 200 and data.get('ok'):
+            bot_identity.clear()
+            bot_identity.update(data['result'])
+            return True
+    except Exception as e:
+        logger.error(f"❌ Ошибка обновления getMe: {e}")
+    return False
+
+def start_identity_refresher():
+    """Фоновое обновление данных о боте"""
+    global _identity_refresher
+    if _identity_refresher and _identity_refresher.is_alive():
+        return
+    
+    def _loop():
+        while True:
+            time.sleep(BOT_IDENTITY_REFRESH)
+            refresh_bot_identity()
+    
+    _identity_refresher = threading.Thread(target=_loop, name='bot-identity', daemon=True)
+    _identity_refresher.start()
 
 # Проверяем валидность токена
 def check_bot_token():
     try:
-        response = requests.get(f"{BASE_URL}/getMe", timeout=10)
+        response = runtime.session.get(f"{BASE_URL}/getMe", timeout=10)
         if response.status_code == 200:
             bot_data = response.json()
             if bot_data.get('ok'):
+                bot_identity.clear()
+                bot_identity.update(bot_data['result'])
                 logger.info(f"✅ Бот @{bot_data['result']['username']} успешно подключен!")
                 return True
             else:
@@ -71,6 +126,13 @@ def check_bot_token():
 # Константы
 BUDGET_OPTIONS = [500, 750, 1000, 1250, 1500, 2500]
 
+# Кнопки главного меню (повторные нажатия можно схлопывать в очереди update)
+MENU_BUTTONS = [
+    "🎯 Создать комнату", "🔍 Присоединиться", "🎲 Жеребьевка", "👥 Участники",
+    "📨 Пригласить", "⚙️ Управление", "👤 Мой профиль", "🎁 Мой получатель",
+    "🔄 Сменить комнату", "🚪 Выйти"
+]
+
 # --- Классы данных ---
 class Participant:
     def __init__(self, user_id: int, full_name: str, username: str = ""):
@@ -109,7 +171,15 @@ class Room:
         self.participants = {}
         self.raffle_done = False
         self.is_active = True
+        self.reminder_sent = False
         self.join_code = str(uuid4())[:6].upper()
+        self.revision = 0          # Растет при каждом изменении, сбрасывает кэш текстов
+        self._render_cache = {}
+        self._participant_pages = (None, [])  # (ревизия, страницы списка участников)
+
+    def touch(self):
+        """Отмечает изменение комнаты (участники, жеребьевка, имена)"""
+        self.revision += 1
 
     def get_invite_link(self, bot_username: str) -> str:
         return f"https://t.me/{bot_username}?start={self.room_id}"
@@ -123,6 +193,7 @@ class Room:
             'gift_date': self.gift_date,
             'raffle_done': self.raffle_done,
             'is_active': self.is_active,
+            'reminder_sent': self.reminder_sent,
             'join_code': self.join_code,
             'participants': {str(k): v.to_dict() for k, v in self.participants.items()}
         }
@@ -138,6 +209,7 @@ class Room:
         )
         room.raffle_done = data['raffle_done']
         room.is_active = data['is_active']
+        room.reminder_sent = data.get('reminder_sent', False)
         room.join_code = data.get('join_code', str(uuid4())[:6].upper())
         room.participants = {
             int(k): Participant.from_dict(v) for k, v in data['participants'].items()
@@ -149,12 +221,146 @@ rooms = {}
 user_rooms = {}  # user_id -> room_id (активная комната)
 user_states = {}
 join_codes = {}
-processing_lock = threading.Lock()
-last_updates = {}
+# Обработчики в режиме webhook идут в нескольких потоках, а комнаты общие для разных пользователей:
+# изменения rooms, user_rooms, user_states и join_codes выполняются под этой блокировкой.
+# RLock - обработчики сами вызывают save_data(), которая тоже ее берет
+processing_lock = threading.RLock()
+# update_id -> время получения, в порядке получения: устаревшие записи всегда в начале
+last_updates = OrderedDict()
+# dedup_middleware стоит до state_lock_middleware, поэтому у last_updates своя блокировка
+last_updates_lock = threading.Lock()
 
-executor = ThreadPoolExecutor(max_workers=20)
+class BoundedExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor с ограничением числа задач в очереди.
+    Когда очередь заполнена, submit() ждет, а не копит задачи в памяти.
+    Из обработчиков update (в том числе под processing_lock) - только try_submit():
+    ожидание места в пуле остановило бы обработку всех update"""
+    
+    def __init__(self, max_workers, max_pending):
+        super().__init__(max_workers=max_workers)
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self.dropped = 0
+    
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        return self._submit(fn, *args, **kwargs)
+    
+    def try_submit(self, fn, *args, **kwargs):
+        """Как submit(), но не ждет: если пул заполнен, задача отбрасывается и возвращается None"""
+        if not self._slots.acquire(blocking=False):
+            self.dropped += 1
+            logger.warning(f"⚠️ Пул задач заполнен, задача {getattr(fn, '__name__', fn)} отброшена")
+            return None
+        return self._submit(fn, *args, **kwargs)
+    
+    def _submit(self, fn, *args, **kwargs):
+        try:
+            # Задача продолжает трассу того update, из которого ее поставили
+            future = super().submit(tracing.wrap(fn), *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+    
+    def pending(self):
+        return self._work_queue.qsize()
+
+EXECUTOR_WORKERS = 20
+EXECUTOR_QUEUE_SIZE = int(os.environ.get('EXECUTOR_QUEUE_SIZE', 1000))
+
+class BotRuntime:
+    """Ресурсы работающего бота: общий пул потоков и HTTP-сессия Telegram API.
+
+    Создаются при первом обращении, поэтому импорт SantOS не запускает потоков,
+    не открывает файлов и не тянет requests. Запуск бота - start().
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._executor = None
+        self._session = None
+        self.started = False
+    
+    @property
+    def executor(self):
+        if self._executor is None:
+            with self.lock:
+                if self._executor is None:
+                    self._executor = BoundedExecutor(max_workers=EXECUTOR_WORKERS, max_pending=EXECUTOR_QUEUE_SIZE)
+        return self._executor
+    
+    @property
+    def session(self):
+        """Одна сессия с пулом keep-alive соединений на все вызовы API"""
+        if self._session is None:
+            with self.lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+                    session = requests.Session()
+                    # Соединений не меньше, чем потоков, которые одновременно зовут API
+                    adapter = HTTPAdapter(pool_maxsize=EXECUTOR_WORKERS + BROADCAST_WORKERS + 8)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+        return self._session
+    
+    def pending(self):
+        """Задачи в очереди пула (0, если пул еще не создан)"""
+        return self._executor.pending() if self._executor else 0
+    
+    def start(self, token=None):
+        """Готовит бота к приему update: логирование, опциональные PROFILING и RECORD_UPDATES,
+        затем проверка токена (сеть) параллельно с загрузкой данных (диск).
+        Возвращает False, если токена нет или он неверный"""
+        setup_logging()
+        if not configure(token):
+            print_token_help()
+            logger.error("❌ BOT_TOKEN не установлен!")
+            return False
+        
+        if os.environ.get('PROFILING') == '1' and profiler is None:
+            enable_profiling()
+        if RECORD_UPDATES and update_recorder is None:
+            enable_update_recording(RECORD_UPDATES)
+        
+        started = time.perf_counter()
+        token_check = self.executor.submit(check_bot_token)
+        load_data()
+        try:
+            token_ok = token_check.result()
+        except Exception as e:
+            logger.error(f"❌ Ошибка проверки токена: {e}")
+            token_ok = False
+        logger.info(f"⏱ Токен и данные: {(time.perf_counter() - started) * 1000:.0f} мс, {len(rooms)} комнат")
+        self.started = token_ok
+        return token_ok
+
+runtime = BotRuntime()
+
+# Завершенные комнаты уезжают в холодный архив и не попадают в santa_data.json
+room_archive = RoomArchive('santa_archive.bin', 'santa_archive_index.json')
+
+# --- Метрики ---
+update_duration = metrics.histogram('santa_update_duration_seconds', 'Время обработки update по обработчикам', ['handler'])
+api_duration = metrics.histogram('santa_telegram_api_duration_seconds', 'Время вызова Telegram API', ['method'])
+api_responses = metrics.counter('santa_telegram_api_responses', 'Ответы Telegram API по кодам', ['method', 'status'])
+api_rate_limited = metrics.counter('santa_telegram_api_rate_limited', 'Ответы 429 от Telegram API', ['method'])
+save_duration = metrics.histogram('santa_save_data_duration_seconds', 'Время сохранения santa_data.json')
+save_bytes = metrics.gauge('santa_save_data_bytes', 'Размер santa_data.json после последнего сохранения')
+metrics.gauge('santa_executor_queue_depth', 'Задачи в очереди общего пула потоков', runtime.pending)
+metrics.gauge('santa_rooms', 'Активные комнаты', lambda: len(rooms))
+metrics.gauge('santa_participants', 'Участники во всех активных комнатах', lambda: sum(len(r.participants) for r in list(rooms.values())))
+metrics.gauge('santa_archived_rooms', 'Комнаты в архиве', lambda: len(room_archive))
+metrics.gauge('santa_telegram_api_circuit_open', '1, если предохранитель Telegram API разомкнут', lambda: int(api_breaker.state != 'closed'))
 
 def save_data():
+    with tracing.start_span('save_data'):
+        _save_data()
+
+def _save_data():
+    started = time.perf_counter()
     with processing_lock:
         data = {
             'rooms': {k: v.to_dict() for k, v in rooms.items()},
@@ -163,12 +369,15 @@ def save_data():
         try:
             with open('santa_data.json', 'w', encoding='utf-8') as f:
                 json.dump(data, f, ensure_ascii=False, indent=2)
+                save_bytes.set(f.tell())
         except Exception as e:
             logger.error(f"❌ Ошибка сохранения: {e}")
+    save_duration.observe(time.perf_counter() - started)
 
 def load_data():
     global rooms, user_rooms, join_codes
     try:
+        room_archive.load()
         if os.path.exists('santa_data.json'):
             with open('santa_data.json', 'r', encoding='utf-8') as f:
                 data = json.load(f)
@@ -178,13 +387,220 @@ def load_data():
                 for room_id, room in rooms.items():
                     join_codes[room.join_code] = room_id
                 
+                rebuild_memberships()
+                date_scheduler.rebuild(rooms.values())
+                
             logger.info("✅ Данные успешно загружены")
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки: {e}")
 
 # --- Функции для работы с Telegram API ---
+API_OK = 'ok'              # Запрос выполнен
+API_FAILED = 'failed'      # Ошибка после всех повторов или ошибка клиента (4xx)
+API_REJECTED = 'rejected'  # Не отправлен: предохранитель открыт (дошлется только sendMessage)
+MAX_RETRY_AFTER = 30       # Дольше ждать по 429 внутри обработчика не имеет смысла
+DEFERRED_MAX = 1000        # Сколько сообщений копим, пока API недоступен
+
+api_retry_policy = RetryPolicy(attempts=3, base=0.5, cap=8.0)
+deferred_messages = deque(maxlen=DEFERRED_MAX)
+deferred_flush_lock = threading.Lock()  # Занята, пока работает досылка: она всегда одна
+
+def flush_deferred_messages():
+    """Досылает сообщения, отложенные пока API был недоступен.
+    Если предохранитель снова открылся, сообщение возвращается в начало очереди и досылка
+    останавливается - ее снова запустит следующее восстановление API"""
+    if not deferred_flush_lock.acquire(blocking=False):
+        return
+    
+    def _flush():
+        sent = 0
+        try:
+            while deferred_messages:
+                try:
+                    payload = deferred_messages.popleft()
+                except IndexError:
+                    break
+                status = _send_message_payload(payload)
+                if status == API_REJECTED:
+                    deferred_messages.appendleft(payload)
+                    break
+                if status == API_OK:
+                    sent += 1
+        finally:
+            deferred_flush_lock.release()
+        if sent:
+            logger.info(f"📬 Досланы отложенные сообщения: {sent}")
+    
+    if runtime.executor.try_submit(_flush) is None:
+        deferred_flush_lock.release()
+
+api_breaker = CircuitBreaker(failure_threshold=5, recovery_timeout=30.0, on_close=flush_deferred_messages)
+
+def api_health():
+    """Метрики предохранителя и очереди отложенных сообщений"""
+    return dict(api_breaker.stats(), deferred=len(deferred_messages))
+
+def telegram_api_call(method, payload, timeout, attempts=None):
+    """Вызывает метод Bot API с повторами и через предохранитель.
+    Возвращает (статус, result из ответа).
+
+    Предохранитель проверяется один раз на вызов, а ошибка засчитывается одна -
+    когда исчерпаны все повторы. При открытом предохранителе откладываются только
+    sendMessage (см. _deliver_message); editMessageText и answerCallbackQuery
+    отбрасываются: callback query к восстановлению API уже протухнет, а правка
+    относится к экрану, который пользователь давно сменил"""
+    with tracing.start_span(f'telegram.{method}', method=method) as span:
+        status, result = _telegram_api_call(method, payload, timeout, attempts, span)
+        span.set_attribute('api.status', status)
+        return status, result
+
+def _telegram_api_call(method, payload, timeout, attempts, span):
+    attempts = attempts or api_retry_policy.attempts
+    url = f"{BASE_URL}/{method}"
+    
+    # В half_open этот вызов и есть пробный запрос, вместе со своими повторами
+    if not api_breaker.allow():
+        return API_REJECTED, None
+    
+    unavailable = False
+    for attempt in range(attempts):
+        span.set_attribute('api.attempts', attempt + 1)
+        started = time.perf_counter()
+        try:
+            response = runtime.session.post(url, json=payload, timeout=timeout)
+        except Exception as e:
+            api_duration.labels(method).observe(time.perf_counter() - started)
+            api_responses.labels(method, 'error').inc()
+            unavailable = True
+            logger.error(f"❌ Ошибка {method}: {e}")
+        else:
+            api_duration.labels(method).observe(time.perf_counter() - started)
+            api_responses.labels(method, response.status_code).inc()
+            span.set_attribute('http.status_code', response.status_code)
+            if response.status_code >= 500:
+                unavailable = True
+                logger.error(f"❌ Ошибка {method}: {response.status_code}")
+            else:
+                # API ответил - значит, он доступен, даже если запрос неудачный
+                unavailable = False
+                api_breaker.record_success()
+                if response.status_code == 200:
+                    try:
+                        return API_OK, response.json().get('result')
+                    except ValueError as e:
+                        # Запрос принят, повторять нельзя - иначе сообщение задвоится
+                        logger.warning(f"⚠️ Нечитаемый ответ {method}: {e}")
+                        return API_OK, None
+                if response.status_code == 429:
+                    api_rate_limited.labels(method).inc()
+                    try:
+                        retry_after = response.json().get('parameters', {}).get('retry_after', 5)
+                    except ValueError:
+                        retry_after = 5
+                    logger.warning(f"⚠️ Rate limit, waiting {retry_after} seconds")
+                    if retry_after > MAX_RETRY_AFTER:
+                        return API_FAILED, None
+                    time.sleep(retry_after)
+                    continue
+                # Остальные 4xx повторять бесполезно
+                logger.error(f"❌ Ошибка {method}: {response.status_code}")
+                return API_FAILED, None
+        
+        if attempt < attempts - 1:
+            time.sleep(api_retry_policy.delay(attempt))
+    
+    if unavailable:
+        api_breaker.record_failure()
+    return API_FAILED, None
+
+# --- Склейка исходящих сообщений ---
+# Пока обрабатывается update, sendMessage копятся в буфере потока и уходят в конце:
+# подряд идущие сообщения в один чат склеиваются, а повтор уже показанной
+# клавиатуры ("Главное меню:" с той же клавиатурой) не отправляется вовсе
+KEYBOARD_REFRESH_TEXTS = {"Главное меню:", "Выберите действие:"}
+REPLY_KEYBOARDS_MAX = 50000
+
+_outbound = threading.local()
+last_reply_keyboards = OrderedDict()  # chat_id -> последняя отправленная reply-клавиатура
+outbound_stats = {'merged': 0, 'skipped': 0}
+
+def _is_inline_markup(reply_markup):
+    if isinstance(reply_markup, str):
+        return '"inline_keyboard"' in reply_markup
+    return 'inline_keyboard' in reply_markup
+
+def _remember_reply_keyboard(chat_id, reply_markup):
+    if reply_markup and not _is_inline_markup(reply_markup):
+        last_reply_keyboards[chat_id] = reply_markup
+        last_reply_keyboards.move_to_end(chat_id)
+        if len(last_reply_keyboards) > REPLY_KEYBOARDS_MAX:
+            last_reply_keyboards.popitem(last=False)
+
+class OutboundBuffer:
+    """Буфер sendMessage и editMessageText на время обработки одного update.
+    Правки (в payload есть message_id) уходят в том же порядке, что и сообщения, и не склеиваются"""
+    
+    def __init__(self):
+        self.messages = []
+        self.keyboards = {}  # chat_id -> reply-клавиатура с учетом буфера
+    
+    def add(self, payload):
+        chat_id = payload['chat_id']
+        reply_markup = payload.get('reply_markup')
+        shown_keyboard = self.keyboards.get(chat_id, last_reply_keyboards.get(chat_id))
+        
+        # Обновление клавиатуры, которая и так уже у пользователя
+        if payload['text'] in KEYBOARD_REFRESH_TEXTS and reply_markup is not None and reply_markup == shown_keyboard:
+            outbound_stats['skipped'] += 1
+            return
+        
+        last = self.messages[-1] if self.messages else None
+        if last and 'message_id' not in last and last['chat_id'] == chat_id:
+            if last == payload:
+                outbound_stats['skipped'] += 1
+                return
+            
+            last_markup = last.get('reply_markup')
+            can_merge = (
+                last.get('parse_mode') == payload.get('parse_mode')
+                and not (last_markup and _is_inline_markup(last_markup))
+                and not (last_markup and reply_markup)
+                and len(last['text']) + len(payload['text']) + 2 <= TELEGRAM_MESSAGE_LIMIT
+            )
+            if can_merge:
+                last['text'] = f"{last['text']}\n\n{payload['text']}"
+                if reply_markup:
+                    last['reply_markup'] = reply_markup
+                if reply_markup and not _is_inline_markup(reply_markup):
+                    self.keyboards[chat_id] = reply_markup
+                outbound_stats['merged'] += 1
+                return
+        
+        self.messages.append(payload)
+        if reply_markup and not _is_inline_markup(reply_markup):
+            self.keyboards[chat_id] = reply_markup
+    
+    def add_edit(self, payload, or_send=False):
+        self.messages.append(dict(payload, _or_send=or_send))
+    
+    def flush(self):
+        messages, self.messages = self.messages, []
+        self.keyboards = {}
+        for payload in messages:
+            if 'message_id' in payload:
+                _deliver_edit(payload, payload.pop('_or_send'))
+            else:
+                _deliver_message(payload)
+
+def flush_outbound():
+    """Отправляет накопленные сообщения и правки сразу, не дожидаясь конца обработчика"""
+    buffer = getattr(_outbound, 'buffer', None)
+    if buffer:
+        buffer.flush()
+
 def send_message(chat_id, text, reply_markup=None, parse_mode=None, retry_count=3):
-    url = f"{BASE_URL}/sendMessage"
+    """Внутри обработчика сообщение встает в буфер и True значит только "принято к отправке".
+    Вне обработчика - True, если Telegram его принял"""
     payload = {
         'chat_id': chat_id,
         'text': text
@@ -194,31 +610,29 @@ def send_message(chat_id, text, reply_markup=None, parse_mode=None, retry_count=
     if parse_mode:
         payload['parse_mode'] = parse_mode
     
-    for attempt in range(retry_count):
-        try:
-            response = requests.post(url, json=payload, timeout=15)
-            if response.status_code == 200:
-                return True
-            elif response.status_code == 429:
-                retry_after = response.json().get('parameters', {}).get('retry_after', 5)
-                logger.warning(f"⚠️ Rate limit, waiting {retry_after} seconds")
-                time.sleep(retry_after)
-                continue
-            else:
-                logger.error(f"❌ Ошибка отправки сообщения: {response.status_code}")
-                if attempt < retry_count - 1:
-                    time.sleep(1)
-                    continue
-        except Exception as e:
-            logger.error(f"❌ Ошибка отправки сообщения: {e}")
-            if attempt < retry_count - 1:
-                time.sleep(1)
-                continue
-    
-    return False
+    buffer = getattr(_outbound, 'buffer', None)
+    if buffer is not None:
+        buffer.add(payload)
+        return True
+    return _deliver_message(payload, retry_count) == API_OK
 
-def edit_message_text(chat_id, message_id, text, reply_markup=None):
-    url = f"{BASE_URL}/editMessageText"
+def _send_message_payload(payload, retry_count=3):
+    status, _ = telegram_api_call('sendMessage', payload, timeout=15, attempts=retry_count)
+    if status == API_OK:
+        _remember_reply_keyboard(payload['chat_id'], payload.get('reply_markup'))
+    return status
+
+def _deliver_message(payload, retry_count=3):
+    """Отправляет сообщение мимо буфера, возвращает статус API_*"""
+    status = _send_message_payload(payload, retry_count)
+    if status == API_REJECTED:
+        # API недоступен: не занимаем воркер, дошлем после восстановления
+        deferred_messages.append(payload)
+    return status
+
+def edit_message_text(chat_id, message_id, text, reply_markup=None, parse_mode=None, or_send=False):
+    """Редактирует сообщение; or_send=True - если править нельзя, отправить текст новым сообщением.
+    Внутри обработчика правка встает в буфер и уходит после него, вне блокировки состояния"""
     payload = {
         'chat_id': chat_id,
         'message_id': message_id,
@@ -226,28 +640,47 @@ def edit_message_text(chat_id, message_id, text, reply_markup=None):
     }
     if reply_markup:
         payload['reply_markup'] = reply_markup
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
     
-    try:
-        response = requests.post(url, json=payload, timeout=10)
-        return response.status_code == 200
-    except Exception as e:
-        logger.error(f"❌ Ошибка редактирования сообщения: {e}")
-        return False
+    buffer = getattr(_outbound, 'buffer', None)
+    if buffer is not None:
+        buffer.add_edit(payload, or_send)
+        return True
+    return _deliver_edit(payload, or_send)
+
+def _deliver_edit(payload, or_send=False):
+    status, _ = telegram_api_call('editMessageText', payload, timeout=10, attempts=2)
+    if status != API_OK and or_send:
+        return _deliver_message({key: value for key, value in payload.items() if key != 'message_id'}) == API_OK
+    return status == API_OK
 
 def answer_callback_query(callback_query_id, text=None):
-    url = f"{BASE_URL}/answerCallbackQuery"
     payload = {
         'callback_query_id': callback_query_id
     }
     if text:
         payload['text'] = text
     
+    # Callback query быстро протухает, поэтому только один повтор
+    status, _ = telegram_api_call('answerCallbackQuery', payload, timeout=5, attempts=2)
+    return status == API_OK
+
+def answer_callback_query_async(callback_query_id, text=None):
+    """Отвечает на callback в фоне: кнопке нужен только сам факт ответа,
+    ждать его перед обработкой нажатия незачем"""
     try:
-        response = requests.post(url, json=payload, timeout=5)
-        return response.status_code == 200
-    except Exception as e:
-        logger.error(f"❌ Ошибка ответа на callback: {e}")
-        return False
+        runtime.executor.try_submit(answer_callback_query, callback_query_id, text)
+    except RuntimeError:
+        # Пул уже остановлен (завершение работы)
+        answer_callback_query(callback_query_id, text)
+
+def answer_discarded_update(update):
+    """Очередь отбросила update (повторное нажатие или переполнение): на нажатие все равно
+    отвечаем пустым answerCallbackQuery, чтобы у кнопки не крутился индикатор"""
+    callback_query = update.get('callback_query')
+    if callback_query and 'id' in callback_query:
+        answer_callback_query_async(callback_query['id'])
 
 # --- Функция для форматирования ссылки на пользователя ---
 def format_user_mention(user_id, full_name, username=None, show_name=True):
@@ -255,43 +688,116 @@ def format_user_mention(user_id, full_name, username=None, show_name=True):
     if username:
         mention = f'@{username}'
     else:
-        # Экранируем HTML-символы в имени
-        safe_name = full_name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        mention = f'<a href="tg://user?id={user_id}">{safe_name}</a>'
+        mention = render('user_mention_link', user_id=user_id, full_name=full_name)
     
     # Добавляем имя пользователя рядом с упоминанием
     if show_name and full_name:
-        safe_display_name = full_name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-        return f"{mention} ({safe_display_name})"
+        return render('user_mention_name', mention=mention, full_name=full_name)
     else:
         return mention
 
+def render_room_text(room, name, **extra):
+    """Рендерит текст о комнате, кэшируя его до следующего room.touch()"""
+    key = (name, room.revision) + tuple(extra.items())
+    text = room._render_cache.get(key)
+    if text is None:
+        admin = room.participants.get(room.admin_id)
+        admin_mention = format_user_mention(room.admin_id, admin.full_name if admin else "Неизвестно", admin.username if admin else "")
+        text = render(
+            name,
+            title=room.title,
+            budget=room.budget,
+            gift_date=room.gift_date,
+            participants_count=len(room.participants),
+            raffle_status='✅ Проведена' if room.raffle_done else '❌ Не проведена',
+            join_code=room.join_code,
+            admin_mention=admin_mention,
+            **extra
+        )
+        # Старые ревизии больше не нужны
+        if len(room._render_cache) > 16:
+            room._render_cache.clear()
+        room._render_cache[key] = text
+    return text
+
+# --- Индекс членства: user_id -> комнаты ---
+user_memberships = {}     # user_id -> {room_id: True} (упорядоченное множество)
+membership_versions = {}  # user_id -> номер версии, растет при каждом изменении членства
+
+# Вызываются при вступлении в комнату и выходе из нее: (user_id, room_id, joined)
+membership_callbacks = []
+# В многопроцессном режиме (sharding.py): user_id -> комнаты пользователя на других шардах,
+# {room_id: (название, организатор ли)}. Они видны в меню и в списке для переключения
+external_rooms = None
+
+def _index_membership(user_id, room_id):
+    user_memberships.setdefault(user_id, {})[room_id] = True
+    membership_versions[user_id] = membership_versions.get(user_id, 0) + 1
+
+def add_membership(user_id, room_id):
+    _index_membership(user_id, room_id)
+    for callback in membership_callbacks:
+        callback(user_id, room_id, True)
+
+def remove_membership(user_id, room_id):
+    user_memberships.get(user_id, {}).pop(room_id, None)
+    membership_versions[user_id] = membership_versions.get(user_id, 0) + 1
+    for callback in membership_callbacks:
+        callback(user_id, room_id, False)
+
+def rebuild_memberships():
+    """Перестраивает индекс по rooms (после load_data)"""
+    user_memberships.clear()
+    for room_id, room in rooms.items():
+        for participant_id in room.participants:
+            _index_membership(participant_id, room_id)
+
+def get_external_rooms(user_id):
+    return external_rooms(user_id) if external_rooms else {}
+
 # --- Клавиатуры ---
+# Статические клавиатуры собираются один раз и сразу кодируются в JSON:
+# Telegram принимает reply_markup как JSON-строку, повторно сериализовать не нужно
+def _encode_keyboard(keyboard):
+    return json.dumps(keyboard, ensure_ascii=False)
+
+MAIN_KEYBOARD_CACHE_MAX = 50000
+_main_keyboard_cache = OrderedDict()  # user_id -> (ключ, JSON клавиатуры), давно не нужные вытесняются
+
 def create_main_keyboard(user_id):
+    current_room_id = user_rooms.get(user_id)
+    current_room = rooms.get(current_room_id) if current_room_id else None
+    external = get_external_rooms(user_id)
+    cache_key = (
+        membership_versions.get(user_id, 0),
+        tuple(external),
+        current_room_id if current_room else None,
+        current_room.raffle_done if current_room else None,
+        room_archive.has_user(user_id)
+    )
+    cached = _main_keyboard_cache.get(user_id)
+    if cached and cached[0] == cache_key:
+        _main_keyboard_cache.move_to_end(user_id)
+        return cached[1]
+    
     keyboard = [["🎯 Создать комнату", "🔍 Присоединиться"]]
     
     # Получаем все комнаты пользователя (где он является участником)
-    user_room_ids = []
-    for room_id, room in rooms.items():
-        if user_id in room.participants:
-            user_room_ids.append(room_id)
+    user_room_ids = get_user_rooms(user_id)
     
-    if user_room_ids:
+    if user_room_ids or external:
         # Если есть только одна комната - показываем её кнопку
-        if len(user_room_ids) == 1:
-            room_id = user_room_ids[0]
-            if room_id in rooms:
-                room = rooms[room_id]
-                room_button = f"🏠 {room.title[:15]}..." if len(room.title) > 15 else f"🏠 {room.title}"
-                keyboard.append([room_button])
+        if len(user_room_ids) == 1 and not external:
+            room = rooms[user_room_ids[0]]
+            room_button = f"🏠 {room.title[:15]}..." if len(room.title) > 15 else f"🏠 {room.title}"
+            keyboard.append([room_button])
         else:
             # Если несколько комнат - показываем кнопку смены комнаты
             keyboard.append(["🔄 Сменить комнату"])
         
         # Добавляем остальные кнопки для текущей активной комнаты
-        current_room_id = user_rooms.get(user_id)
-        if current_room_id and current_room_id in rooms:
-            room = rooms[current_room_id]
+        if current_room:
+            room = current_room
             
             # Кнопки для организатора
             if room.admin_id == user_id:
@@ -304,114 +810,337 @@ def create_main_keyboard(user_id):
                 keyboard.append(["🎁 Мой получатель"])
             
             keyboard.append(["🚪 Выйти"])
+    elif room_archive.has_user(user_id):
+        # Праздник прошел, но получателя все еще можно посмотреть из архива
+        keyboard.append(["🎁 Мой получатель"])
     
-    return {
+    encoded = _encode_keyboard({
         'keyboard': keyboard,
         'resize_keyboard': True
-    }
+    })
+    _main_keyboard_cache[user_id] = (cache_key, encoded)
+    _main_keyboard_cache.move_to_end(user_id)
+    if len(_main_keyboard_cache) > MAIN_KEYBOARD_CACHE_MAX:
+        _main_keyboard_cache.popitem(last=False)
+    return encoded
+
+BACK_KEYBOARD = _encode_keyboard({
+    'keyboard': [["🔙 Назад"]],
+    'resize_keyboard': True
+})
+
+BUDGET_KEYBOARD = _encode_keyboard({
+    'inline_keyboard': [
+        [{'text': f"{budget} руб.", 'callback_data': f"budget_{budget}"} for budget in BUDGET_OPTIONS[i:i+2]]
+        for i in range(0, len(BUDGET_OPTIONS), 2)
+    ]
+})
+
+CONFIRMATION_KEYBOARD = _encode_keyboard({
+    'inline_keyboard': [
+        [{'text': "✅ Создать", 'callback_data': "create_confirm"}],
+        [{'text': "🔙 Назад", 'callback_data': "create_back"}]
+    ]
+})
+
+JOIN_DECISION_KEYBOARD = _encode_keyboard({
+    'inline_keyboard': [
+        [{'text': "✅ Присоединиться", 'callback_data': "join_yes"}],
+        [{'text': "❌ Отказаться", 'callback_data': "join_no"}]
+    ]
+})
+
+PROFILE_CONFIRMATION_KEYBOARD = _encode_keyboard({
+    'inline_keyboard': [
+        [{'text': "✅ Подтвердить", 'callback_data': "profile_confirm"}],
+        [{'text': "✏️ Редактировать", 'callback_data': "profile_edit"}],
+        [{'text': "🔙 Назад", 'callback_data': "profile_back"}]
+    ]
+})
+
+EDIT_PROFILE_KEYBOARD = _encode_keyboard({
+    'inline_keyboard': [
+        [{'text': "👤 ФИО", 'callback_data': "edit_name"}],
+        [{'text': "🎁 Пожелания", 'callback_data': "edit_wish"}],
+        [{'text': "🚫 Анти-пожелания", 'callback_data': "edit_anti_wish"}],
+        [{'text': "🔙 Назад", 'callback_data': "edit_back"}]
+    ]
+})
+
+ROOM_MANAGEMENT_KEYBOARD = _encode_keyboard({
+    'inline_keyboard': [
+        [{'text': "📢 Объявление", 'callback_data': "announce"}],
+        [{'text': "🗑️ Удалить комнату", 'callback_data': "delete_room"}],
+        [{'text': "📊 Статистика", 'callback_data': "room_stats"}],
+        [{'text': "🔙 Назад", 'callback_data': "manage_back"}]
+    ]
+})
 
 def create_back_keyboard():
-    return {
-        'keyboard': [["🔙 Назад"]],
-        'resize_keyboard': True
-    }
+    return BACK_KEYBOARD
 
 def create_budget_keyboard():
-    keyboard = []
-    for i in range(0, len(BUDGET_OPTIONS), 2):
-        row = []
-        for budget in BUDGET_OPTIONS[i:i+2]:
-            row.append({
-                'text': f"{budget} руб.",
-                'callback_data': f"budget_{budget}"
-            })
-        keyboard.append(row)
-    return {'inline_keyboard': keyboard}
+    return BUDGET_KEYBOARD
 
 def create_confirmation_keyboard():
-    return {
-        'inline_keyboard': [
-            [{'text': "✅ Создать", 'callback_data': "create_confirm"}],
-            [{'text': "🔙 Назад", 'callback_data': "create_back"}]
-        ]
-    }
+    return CONFIRMATION_KEYBOARD
 
 def create_join_decision_keyboard():
-    return {
-        'inline_keyboard': [
-            [{'text': "✅ Присоединиться", 'callback_data': "join_yes"}],
-            [{'text': "❌ Отказаться", 'callback_data': "join_no"}]
-        ]
-    }
+    return JOIN_DECISION_KEYBOARD
 
 def create_profile_confirmation_keyboard():
-    return {
-        'inline_keyboard': [
-            [{'text': "✅ Подтвердить", 'callback_data': "profile_confirm"}],
-            [{'text': "✏️ Редактировать", 'callback_data': "profile_edit"}],
-            [{'text': "🔙 Назад", 'callback_data': "profile_back"}]
-        ]
-    }
+    return PROFILE_CONFIRMATION_KEYBOARD
 
 def create_edit_profile_keyboard():
-    return {
-        'inline_keyboard': [
-            [{'text': "👤 ФИО", 'callback_data': "edit_name"}],
-            [{'text': "🎁 Пожелания", 'callback_data': "edit_wish"}],
-            [{'text': "🚫 Анти-пожелания", 'callback_data': "edit_anti_wish"}],
-            [{'text': "🔙 Назад", 'callback_data': "edit_back"}]
-        ]
-    }
+    return EDIT_PROFILE_KEYBOARD
 
 def create_room_management_keyboard():
-    return {
-        'inline_keyboard': [
-            [{'text': "🗑️ Удалить комнату", 'callback_data': "delete_room"}],
-            [{'text': "📊 Статистика", 'callback_data': "room_stats"}],
-            [{'text': "🔙 Назад", 'callback_data': "manage_back"}]
-        ]
-    }
+    return ROOM_MANAGEMENT_KEYBOARD
 
 def create_room_switch_keyboard(user_id):
     keyboard = []
     
-    # Получаем все комнаты пользователя
-    user_room_ids = []
-    for room_id, room in rooms.items():
-        if user_id in room.participants:
-            user_room_ids.append(room_id)
-    
-    for room_id in user_room_ids:
-        if room_id in rooms:
-            room = rooms[room_id]
-            role = "👑" if room.admin_id == user_id else "👤"
-            room_name = room.title[:20] + "..." if len(room.title) > 20 else room.title
-            keyboard.append([{
-                'text': f"{role} {room_name}",
-                'callback_data': f"switch_{room_id}"
-            }])
+    for room_id in get_user_rooms(user_id):
+        room = rooms[room_id]
+        role = "👑" if room.admin_id == user_id else "👤"
+        room_name = room.title[:20] + "..." if len(room.title) > 20 else room.title
+        keyboard.append([{
+            'text': f"{role} {room_name}",
+            'callback_data': f"switch_{room_id}"
+        }])
+    
+    # Комнаты на других шардах: нажатие координатор передаст шарду-владельцу
+    for room_id, (title, is_admin) in get_external_rooms(user_id).items():
+        role = "👑" if is_admin else "👤"
+        room_name = title[:20] + "..." if len(title) > 20 else title
+        keyboard.append([{
+            'text': f"{role} {room_name}",
+            'callback_data': f"switch_{room_id}"
+        }])
     
     keyboard.append([{'text': "🔙 Назад", 'callback_data': "switch_back"}])
     return {'inline_keyboard': keyboard}
 
 # --- Функция проверки даты ---
+@lru_cache(maxsize=4096)
+def parse_gift_date(gift_date_str):
+    """Разбирает дату ДД.ММ.ГГГГ один раз, повторные вызовы берутся из кэша"""
+    try:
+        return datetime.strptime(gift_date_str, '%d.%m.%Y').date()
+    except (ValueError, TypeError):
+        return None
+
 def is_date_passed(gift_date_str):
     """Проверяет, наступила ли уже указанная дата"""
-    try:
-        gift_date = datetime.strptime(gift_date_str, '%d.%m.%Y').date()
-        current_date = datetime.now().date()
-        return current_date >= gift_date
-    except ValueError:
+    gift_date = parse_gift_date(gift_date_str)
+    if gift_date is None:
+        return False
+    return date.today() >= gift_date
+
+# --- Рассылка по комнате ---
+# Рассылки делят общий лимит, оставляя запас до 30 сообщений/сек для обычных ответов
+BROADCAST_RATE = float(os.environ.get('BROADCAST_RATE', 25))
+BROADCAST_WORKERS = int(os.environ.get('BROADCAST_WORKERS', 8))
+
+def _broadcast_send(chat_id, text, parse_mode=None):
+    """Отправка для Broadcaster: отклоненное предохранителем уйдет позже, это не ошибка"""
+    payload = {'chat_id': chat_id, 'text': text}
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    status = _deliver_message(payload)
+    return DEFERRED if status == API_REJECTED else status == API_OK
+
+broadcaster = Broadcaster(
+    _broadcast_send,
+    RateLimiter(BROADCAST_RATE),
+    max_workers=BROADCAST_WORKERS
+)
+
+def broadcast_to_room(room, text, exclude=None, parse_mode=None, on_done=None, name=None):
+    """Рассылает сообщение всем участникам комнаты в фоне, возвращает BroadcastResult"""
+    recipients = [pid for pid in list(room.participants) if pid != exclude]
+    # Ответы обработчика уходят раньше рассылки, а не после нее
+    flush_outbound()
+    return broadcaster.broadcast(
+        ((pid, text) for pid in recipients),
+        name=name or f"room-{room.room_id}",
+        parse_mode=parse_mode,
+        on_done=on_done
+    )
+
+# --- Планировщик событий по датам обмена ---
+REMINDER_DAYS_BEFORE = 3
+REMINDER_HOUR = 10  # Напоминания отправляем в 10:00, а не в полночь
+ARCHIVE_AFTER_DAYS = 14  # Через сколько дней после обмена комната уходит в архив
+REMINDER_GRACE = 3600    # Событие, опоздавшее больше чем на час (бот был выключен), применяем молча
+SCHEDULER_BATCH = 500    # Сколько наступивших событий обрабатываем за одно взятие processing_lock
+
+class DateScheduler:
+    """Очередь событий по датам обмена подарками на min-heap.
+    
+    Поток спит до ближайшего события, постановка и срабатывание стоят O(log n).
+    События удаленных комнат или комнат со сменившейся датой не удаляются из кучи,
+    а просто пропускаются при срабатывании. Наступившие события (у многих комнат
+    одна дата) обрабатываются пачкой: одно сохранение на пачку, а уведомления уходят
+    через broadcaster уже после processing_lock.
+    """
+    
+    def __init__(self):
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+    
+    def _room_events(self, room, skip_overdue=False):
+        gift_date = parse_gift_date(room.gift_date)
+        if gift_date is None:
+            return []
+        
+        events = []
+        if room.is_active:
+            if not room.reminder_sent:
+                remind_at = datetime.combine(gift_date - timedelta(days=REMINDER_DAYS_BEFORE), datetime.min.time())
+                remind_at = remind_at.replace(hour=REMINDER_HOUR)
+                if not skip_overdue or remind_at.timestamp() > time.time() - REMINDER_GRACE:
+                    events.append((remind_at.timestamp(), 'remind'))
+            close_at = datetime.combine(gift_date, datetime.min.time())
+            events.append((close_at.timestamp(), 'close'))
+        archive_at = datetime.combine(gift_date + timedelta(days=ARCHIVE_AFTER_DAYS), datetime.min.time())
+        events.append((archive_at.timestamp(), 'archive'))
+        return [(ts, next(self._seq), kind, room.room_id, room.gift_date) for ts, kind in events]
+    
+    def schedule_room(self, room):
+        """Добавляет события новой комнаты"""
+        with self._cond:
+            for event in self._room_events(room):
+                heapq.heappush(self._heap, event)
+            self._cond.notify()
+    
+    def rebuild(self, all_rooms):
+        """Полностью перестраивает очередь (после load_data).
+        Напоминания, время которых прошло, пока бот не работал, пропускаются: поздно напоминать
+        о дате, до которой осталось меньше обещанного. Просроченные закрытие и архив срабатывают
+        сразу, но без уведомлений организаторам"""
+        with self._cond:
+            self._heap = [event for room in all_rooms for event in self._room_events(room, skip_overdue=True)]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+    
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='date-scheduler', daemon=True)
+        self._thread.start()
+    
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.time():
+                    timeout = self._heap[0][0] - time.time() if self._heap else None
+                    self._cond.wait(timeout)
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < SCHEDULER_BATCH:
+                    due.append(heapq.heappop(self._heap))
+            
+            try:
+                self._fire_batch(due, now)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки событий дат: {e}")
+    
+    def _fire_batch(self, due, now):
+        messages = []  # (chat_id, text) - отправляются после снятия блокировки
+        to_archive = []
+        changed = False
+        # События меняют комнаты так же, как обработчик update
+        with processing_lock:
+            for ts, _, kind, room_id, gift_date in due:
+                try:
+                    if kind == 'archive':
+                        room = rooms.get(room_id)
+                        if room and room.gift_date == gift_date:
+                            to_archive.append(room_id)
+                    else:
+                        changed |= self._fire(kind, room_id, gift_date, now - ts > REMINDER_GRACE, messages)
+                except Exception as e:
+                    logger.error(f"❌ Ошибка события {kind} для комнаты {room_id}: {e}")
+            if to_archive:
+                archive_rooms(to_archive)
+                changed = True
+            if changed:
+                save_data()
+        if messages:
+            broadcaster.broadcast(messages, name='date-events')
+    
+    def _fire(self, kind, room_id, gift_date, late, messages):
+        """Применяет событие к комнате, уведомления складывает в messages.
+        late - событие опоздало (бот был выключен): состояние меняем, но никому не пишем.
+        Возвращает True, если комната изменилась"""
+        room = rooms.get(room_id)
+        if not room or room.gift_date != gift_date:
+            return False
+        
+        if not room.is_active:
+            return False
+        
+        if kind == 'remind':
+            if room.reminder_sent or late or is_date_passed(room.gift_date):
+                return False
+            room.reminder_sent = True
+            days_left = (parse_gift_date(room.gift_date) - date.today()).days
+            
+            if room.raffle_done:
+                text = (
+                    f"⏰ До обмена подарками в комнате \"{room.title}\" осталось дней: {days_left}!\n"
+                    f"📅 Дата: {room.gift_date}\n"
+                    f"🎁 Не забудьте подготовить подарок."
+                )
+                messages.extend((pid, text) for pid in list(room.participants))
+            else:
+                messages.append((
+                    room.admin_id,
+                    f"⏰ До обмена подарками в комнате \"{room.title}\" осталось дней: {days_left}, "
+                    f"а жеребьевка еще не проведена!"
+                ))
+            return True
+        
+        if kind == 'close':
+            room.is_active = False
+            logger.info(f"🔒 Комната {room_id} закрыта: дата обмена наступила")
+            if not late:
+                messages.append((
+                    room.admin_id,
+                    f"🔒 Дата обмена подарками в комнате \"{room.title}\" наступила. "
+                    f"Комната закрыта для новых участников."
+                ))
+            return True
         return False
 
+date_scheduler = DateScheduler()
+
+def archive_rooms(room_ids):
+    """Переносит завершенные комнаты из рабочего набора в холодный архив одной записью.
+    santa_data.json не сохраняет - это делает вызывающий, один раз на пачку"""
+    batch = [rooms[room_id] for room_id in room_ids if room_id in rooms]
+    if not batch:
+        return
+    
+    room_archive.extend([room.to_dict() for room in batch])
+    
+    for room in batch:
+        for participant_id in list(room.participants):
+            remove_membership(participant_id, room.room_id)
+            if user_rooms.get(participant_id) == room.room_id:
+                del user_rooms[participant_id]
+        join_codes.pop(room.join_code, None)
+        del rooms[room.room_id]
+    
+    logger.info(f"📦 В архив перенесено комнат: {len(batch)}")
+
 # --- Вспомогательные функции ---
 def get_user_rooms(user_id):
     """Получает все комнаты пользователя"""
-    user_room_ids = []
-    for room_id, room in rooms.items():
-        if user_id in room.participants:
-            user_room_ids.append(room_id)
-    return user_room_ids
+    return [room_id for room_id in user_memberships.get(user_id, ()) if room_id in rooms]
 
 def set_active_room(user_id, room_id):
     """Устанавливает активную комнату для пользователя"""
@@ -420,31 +1149,17 @@ def set_active_room(user_id, room_id):
 
 def update_participant_info(user_id, full_name, username):
     """Обновляет информацию о пользователе во всех комнатах"""
-    for room in rooms.values():
-        if user_id in room.participants:
-            participant = room.participants[user_id]
+    for room_id in get_user_rooms(user_id):
+        room = rooms[room_id]
+        participant = room.participants[user_id]
+        if participant.full_name != full_name or (username and participant.username != username):
             participant.full_name = full_name
             if username:
                 participant.username = username
+            room.touch()
 
 # --- Обработчики сообщений ---
 def handle_start(message, user_id):
-    # Получаем информацию о пользователе
-    from_user = message.get('from', {})
-    username = from_user.get('username', '')
-    first_name = from_user.get('first_name', '')
-    last_name = from_user.get('last_name', '')
-    
-    # Формируем полное имя
-    full_name = first_name
-    if last_name:
-        full_name += f" {last_name}"
-    if not full_name:
-        full_name = f"User_{user_id}"
-    
-    # Обновляем информацию о пользователе
-    update_participant_info(user_id, full_name, username)
-    
     text_parts = message.get('text', '').split()
     
     if len(text_parts) > 1:
@@ -486,370 +1201,293 @@ def handle_start(message, user_id):
         reply_markup=create_main_keyboard(user_id)
     )
 
-def handle_text_message(message, user_id):
-    # Обновляем информацию о пользователе
-    from_user = message.get('from', {})
-    username = from_user.get('username', '')
-    first_name = from_user.get('first_name', '')
-    last_name = from_user.get('last_name', '')
+# --- Текстовые сообщения ---
+# Какой обработчик вызвать, решает router по (состояние, текст) - см. блок маршрутов ниже
+
+def start_room_creation(user_id):
+    user_states[user_id] = {'state': 'creating_room', 'step': 'title'}
+    send_message(user_id, "🏠 Как назовем комнату?", reply_markup=create_back_keyboard())
+
+def start_join_by_code(user_id):
+    user_states[user_id] = {'state': 'joining_by_code', 'step': 'enter_code'}
+    send_message(user_id, "🔢 Введите код комнаты для присоединения:", reply_markup=create_back_keyboard())
+
+def show_main_menu(user_id):
+    send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
+
+def handle_room_button(user_id):
+    if user_id in user_rooms:
+        room_id = user_rooms[user_id]
+        room = rooms[room_id]
+        show_room_info(user_id, room)
+    else:
+        send_message(user_id, "❌ Вы не состоите в комнате")
+
+def handle_unknown_text(user_id, text):
+    send_message(user_id, "Используйте кнопки меню для навигации", reply_markup=create_main_keyboard(user_id))
+
+def cancel_to_main_menu(notice):
+    """Обработчик кнопки "🔙 Назад" в диалоге: сбрасывает состояние и показывает меню"""
+    def cancel(user_id):
+        user_states[user_id] = {'state': 'main_menu'}
+        send_message(user_id, notice, reply_markup=create_main_keyboard(user_id))
+    return cancel
+
+def handle_room_creation_input(user_id, text):
+    state_data = user_states.get(user_id, {})
+    step = state_data.get('step')
     
-    full_name = first_name
-    if last_name:
-        full_name += f" {last_name}"
-    if not full_name:
-        full_name = f"User_{user_id}"
+    if step == 'title':
+        if text.strip():
+            user_states[user_id] = {
+                'state': 'creating_room',
+                'step': 'budget',
+                'title': text.strip()
+            }
+            keyboard = create_budget_keyboard()
+            send_message(user_id, "💰 Выберите бюджет подарков:", reply_markup=keyboard)
+        else:
+            send_message(user_id, "❌ Название не может быть пустым. Введите название комнаты:")
     
-    update_participant_info(user_id, full_name, username)
+    elif step == 'date':
+        try:
+            datetime.strptime(text, '%d.%m.%Y')
+            user_states[user_id]['date'] = text
+            show_room_confirmation(user_id)
+        except ValueError:
+            send_message(user_id, "❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ:")
+
+def handle_join_code_input(user_id, text):
+    if user_states.get(user_id, {}).get('step') != 'enter_code':
+        return
     
-    text = message.get('text', '')
+    code = text.strip().upper()
+    if code in join_codes:
+        room_id = join_codes[code]
+        if room_id in rooms and rooms[room_id].is_active:
+            # ПРОВЕРКА ДАТЫ ПЕРЕД ПРИСОЕДИНЕНИЕМ
+            room = rooms[room_id]
+            if is_date_passed(room.gift_date):
+                send_message(
+                    user_id,
+                    f"❌ К сожалению, дата обмена подарками ({room.gift_date}) уже наступила.\n"
+                    f"Присоединиться к этой комнате больше нельзя."
+                )
+                return
+            
+            user_states[user_id] = {
+                'state': 'joining_room',
+                'room_id': room_id
+            }
+            
+            keyboard = create_join_decision_keyboard()
+            
+            send_message(
+                user_id,
+                f"🎅 Найдена комната!\n\n"
+                f"Комната: {room.title}\n"
+                f"Бюджет: {room.budget} руб.\n"
+                f"Дата: {room.gift_date}\n\n"
+                f"Хотите присоединиться?",
+                reply_markup=keyboard
+            )
+        else:
+            send_message(user_id, "❌ Комната не найдена или удалена")
+    else:
+        send_message(user_id, "❌ Неверный код комнаты. Попробуйте еще раз:")
+
+def handle_profile_input(user_id, text):
     state_data = user_states.get(user_id, {})
-    state = state_data.get('state', 'main_menu')
+    step = state_data.get('step')
     
-    if text in ["🎯 Создать комнату", "🔍 Присоединиться", "🎲 Жеребьевка", "👥 Участники", 
-                "📨 Пригласить", "⚙️ Управление", "👤 Мой профиль", "🎁 Мой получатель", 
-                "🔄 Сменить комнату", "🚪 Выйти"]:
-        logger.info(f"👤 {user_id}: {text}")
+    if step == 'name':
+        if text.strip():
+            user_states[user_id] = dict(state_data, step='wish', name=text.strip())
+            send_message(user_id, "🎁 Что бы вы хотели получить в подарок?", reply_markup=create_back_keyboard())
+        else:
+            send_message(user_id, "❌ Имя не может быть пустым. Введите ваше ФИО:")
     
-    if state == 'main_menu':
-        if text == "🎯 Создать комнату":
-            user_states[user_id] = {'state': 'creating_room', 'step': 'title'}
-            send_message(user_id, "🏠 Как назовем комнату?", reply_markup=create_back_keyboard())
-        
-        elif text == "🔍 Присоединиться":
-            user_states[user_id] = {'state': 'joining_by_code', 'step': 'enter_code'}
-            send_message(user_id, "🔢 Введите код комнаты для присоединения:", reply_markup=create_back_keyboard())
-        
-        elif text == "🔙 Назад":
-            send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
-        
-        elif text.startswith("🏠 "):
-            if user_id in user_rooms:
-                room_id = user_rooms[user_id]
-                room = rooms[room_id]
-                show_room_info(user_id, room)
-            else:
-                send_message(user_id, "❌ Вы не состоите в комнате")
-        
-        elif text == "🔄 Сменить комнату":
-            handle_switch_room(user_id)
-        
-        elif text == "🎲 Жеребьевка":
-            handle_raffle(user_id)
-        
-        elif text == "👥 Участники":
-            handle_show_participants(user_id)
-        
-        elif text == "📨 Пригласить":
-            handle_invite_players(user_id)
-        
-        elif text == "⚙️ Управление":
-            handle_room_management(user_id)
+    elif step == 'wish':
+        user_states[user_id] = dict(state_data, step='anti_wish', wish=text)
+        send_message(user_id, "🚫 А что точно НЕ хотите получать?", reply_markup=create_back_keyboard())
+    
+    elif step == 'anti_wish':
+        show_profile_confirmation(user_id, state_data['name'], state_data['wish'], text)
+
+def announcement_header(room_ids):
+    if len(room_ids) == 1:
+        return f"📢 Объявление от организатора комнаты \"{rooms[room_ids[0]].title}\":"
+    return "📢 Объявление от организатора:"
+
+def handle_announcement_input(user_id, text):
+    if not text.strip():
+        send_message(user_id, "❌ Объявление не может быть пустым. Введите текст:")
+        return
+    
+    state_data = user_states.get(user_id, {})
+    room_id = state_data.get('room_id')
+    # С заголовком (он длиннее у объявления в одну комнату) и в подтверждении текст
+    # должен уместиться в одно сообщение, иначе Telegram отклонит каждую отправку
+    header = announcement_header([room_id]) if room_id in rooms else announcement_header([])
+    max_length = TELEGRAM_MESSAGE_LIMIT - max(len(header) + 2, len("📢 Ваше объявление:\n\n\n\nКому отправить?"))
+    if len(text) > max_length:
+        send_message(user_id, f"❌ Объявление слишком длинное: {len(text)} символов, можно не больше {max_length}. Сократите текст:")
+        return
+    
+    user_states[user_id] = {'state': 'announcing', 'room_id': state_data.get('room_id'), 'text': text}
+    show_announcement_confirmation(user_id)
+
+def handle_profile_edit_input(user_id, text):
+    state_data = user_states.get(user_id, {})
+    field = state_data.get('editing_field')
+    room_id = user_rooms.get(user_id)
+    
+    if 'name' in state_data and state_data.get('room_id') in rooms:
+        # Правка анкеты до вступления: возвращаемся к подтверждению
+        profile = {key: state_data.get(key) for key in ('name', 'wish', 'anti_wish')}
+        profile[field] = text
+        show_profile_confirmation(user_id, profile['name'], profile['wish'], profile['anti_wish'])
+        return
+    
+    if room_id and room_id in rooms:
+        room = rooms[room_id]
+        participant = room.participants.get(user_id)
         
-        elif text == "👤 Мой профиль":
+        if participant and not room.raffle_done:
+            if field == 'name':
+                participant.full_name = text
+                room.touch()
+                send_message(user_id, "✅ ФИО обновлено!")
+            elif field == 'wish':
+                participant.wishlist = text
+                send_message(user_id, "✅ Пожелания обновлены!")
+            elif field == 'anti_wish':
+                participant.anti_wishlist = text
+                send_message(user_id, "✅ Анти-пожелания обновлены!")
+            
+            save_data()
             handle_show_my_profile(user_id)
-        
-        elif text == "🎁 Мой получатель":
-            handle_show_recipient(user_id)
-        
-        elif text == "🚪 Выйти":
-            handle_leave_room(user_id)
         else:
-            send_message(user_id, "Используйте кнопки меню для навигации", reply_markup=create_main_keyboard(user_id))
+            send_message(user_id, "❌ Редактирование недоступно после жеребьевки")
+    else:
+        send_message(user_id, "❌ Ошибка: комната не найдена")
     
-    elif state == 'creating_room':
-        if text == "🔙 Назад":
-            user_states[user_id] = {'state': 'main_menu'}
-            send_message(user_id, "✅ Создание комнаты отменено", reply_markup=create_main_keyboard(user_id))
-            return
-        
-        step = state_data.get('step')
-        
-        if step == 'title':
-            if text.strip():
-                user_states[user_id] = {
-                    'state': 'creating_room',
-                    'step': 'budget',
-                    'title': text.strip()
-                }
-                keyboard = create_budget_keyboard()
-                send_message(user_id, "💰 Выберите бюджет подарков:", reply_markup=keyboard)
-            else:
-                send_message(user_id, "❌ Название не может быть пустым. Введите название комнаты:")
-        
-        elif step == 'date':
-            try:
-                datetime.strptime(text, '%d.%m.%Y')
-                user_states[user_id]['date'] = text
-                show_room_confirmation(user_id)
-            except ValueError:
-                send_message(user_id, "❌ Неверный формат даты. Используйте ДД.ММ.ГГГГ:")
-    
-    elif state == 'joining_by_code':
-        if text == "🔙 Назад":
-            user_states[user_id] = {'state': 'main_menu'}
-            send_message(user_id, "✅ Присоединение отменено", reply_markup=create_main_keyboard(user_id))
-            return
+    user_states[user_id] = {'state': 'main_menu'}
+
+# --- Нажатия inline-кнопок ---
+# Обработчик получает (user_id, chat_id, message_id, data) и может вернуть текст всплывающего уведомления
+
+def handle_budget_choice(user_id, chat_id, message_id, data):
+    try:
+        budget = int(data.split('_')[1])
+        # Получаем текущее состояние
+        state_data = user_states.get(user_id, {})
         
-        step = state_data.get('step')
+        # Сохраняем бюджет и переходим к следующему шагу
+        user_states[user_id] = {
+            'state': 'creating_room',
+            'step': 'date',
+            'title': state_data.get('title', ''),
+            'budget': budget
+        }
         
-        if step == 'enter_code':
-            code = text.strip().upper()
-            if code in join_codes:
-                room_id = join_codes[code]
-                if room_id in rooms and rooms[room_id].is_active:
-                    # ПРОВЕРКА ДАТЫ ПЕРЕД ПРИСОЕДИНЕНИЕМ
-                    room = rooms[room_id]
-                    if is_date_passed(room.gift_date):
-                        send_message(
-                            user_id,
-                            f"❌ К сожалению, дата обмена подарками ({room.gift_date}) уже наступила.\n"
-                            f"Присоединиться к этой комнате больше нельзя."
-                        )
-                        return
-                    
-                    user_states[user_id] = {
-                        'state': 'joining_room',
-                        'room_id': room_id
-                    }
-                    
-                    keyboard = create_join_decision_keyboard()
-                    
-                    send_message(
-                        user_id,
-                        f"🎅 Найдена комната!\n\n"
-                        f"Комната: {room.title}\n"
-                        f"Бюджет: {room.budget} руб.\n"
-                        f"Дата: {room.gift_date}\n\n"
-                        f"Хотите присоединиться?",
-                        reply_markup=keyboard
-                    )
-                else:
-                    send_message(user_id, "❌ Комната не найдена или удалена")
-            else:
-                send_message(user_id, "❌ Неверный код комнаты. Попробуйте еще раз:")
-    
-    elif state == 'joining_profile':
-        if text == "🔙 Назад":
+        # Редактируем сообщение с запросом даты; если не удалось - отправляем новое
+        edit_message_text(
+            chat_id, 
+            message_id, 
+            f"💰 Бюджет: {budget} руб.\n\n📅 Введите дату обмена подарками (ДД.ММ.ГГГГ):",
+            reply_markup=create_back_keyboard(),
+            or_send=True
+        )
+            
+    except Exception as e:
+        logger.error(f"❌ Ошибка обработки бюджета: {e}")
+        send_message(user_id, "❌ Ошибка выбора бюджета. Попробуйте еще раз.")
+
+def handle_create_back(user_id, chat_id, message_id, data=None):
+    user_states[user_id] = {'state': 'creating_room', 'step': 'title'}
+    edit_message_text(chat_id, message_id, "🔄 Начинаем заново...\n🏠 Как назовем комнату?", reply_markup=create_back_keyboard())
+
+def handle_join_cancel(user_id, chat_id, message_id, data=None):
+    user_states[user_id] = {'state': 'main_menu'}
+    edit_message_text(chat_id, message_id, "✅ Присоединение отменено.")
+    send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
+
+def handle_join_confirm(user_id, chat_id, message_id, data=None):
+    room_id = user_states[user_id].get('room_id')
+    if room_id and room_id in rooms:
+        # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА ДАТЫ ПЕРЕД РЕГИСТРАЦИЕЙ
+        room = rooms[room_id]
+        if is_date_passed(room.gift_date):
+            edit_message_text(
+                chat_id, 
+                message_id, 
+                f"❌ К сожалению, дата обмена подарками ({room.gift_date}) уже наступила.\n"
+                f"Присоединиться к этой комнате больше нельзя."
+            )
             user_states[user_id] = {'state': 'main_menu'}
-            send_message(user_id, "✅ Регистрация отменена", reply_markup=create_main_keyboard(user_id))
             return
         
-        step = state_data.get('step')
-        
-        if step == 'name':
-            if text.strip():
-                user_states[user_id] = {
-                    'state': 'joining_profile',
-                    'step': 'wish',
-                    'name': text.strip(),
-                    'room_id': state_data['room_id']
-                }
-                send_message(user_id, "🎁 Что бы вы хотели получить в подарок?", reply_markup=create_back_keyboard())
-            else:
-                send_message(user_id, "❌ Имя не может быть пустым. Введите ваше ФИО:")
-        
-        elif step == 'wish':
-            user_states[user_id] = {
-                'state': 'joining_profile', 
-                'step': 'anti_wish',
-                'name': state_data['name'],
-                'wish': text,
-                'room_id': state_data['room_id']
-            }
-            send_message(user_id, "🚫 А что точно НЕ хотите получать?", reply_markup=create_back_keyboard())
-        
-        elif step == 'anti_wish':
-            show_profile_confirmation(user_id, state_data['name'], state_data['wish'], text)
-    
-    elif state == 'editing_profile':
-        if text == "🔙 Назад":
+        if user_id in rooms[room_id].participants:
+            edit_message_text(chat_id, message_id, "❌ Вы уже участник этой комнаты!")
             user_states[user_id] = {'state': 'main_menu'}
-            send_message(user_id, "✅ Редактирование отменено", reply_markup=create_main_keyboard(user_id))
             return
         
-        field = state_data.get('editing_field')
-        room_id = user_rooms.get(user_id)
-        
-        if room_id and room_id in rooms:
-            room = rooms[room_id]
-            participant = room.participants.get(user_id)
-            
-            if participant and not room.raffle_done:
-                if field == 'name':
-                    participant.full_name = text
-                    send_message(user_id, "✅ ФИО обновлено!")
-                elif field == 'wish':
-                    participant.wishlist = text
-                    send_message(user_id, "✅ Пожелания обновлены!")
-                elif field == 'anti_wish':
-                    participant.anti_wishlist = text
-                    send_message(user_id, "✅ Анти-пожелания обновлены!")
-                
-                save_data()
-                handle_show_my_profile(user_id)
-            else:
-                send_message(user_id, "❌ Редактирование недоступно после жеребьевки")
-        else:
-            send_message(user_id, "❌ Ошибка: комната не найдена")
-        
+        user_states[user_id] = {
+            'state': 'joining_profile',
+            'step': 'name',
+            'room_id': room_id
+        }
+        edit_message_text(chat_id, message_id, "👤 Регистрация:\nВведите ваше ФИО:", reply_markup=create_back_keyboard())
+    else:
+        edit_message_text(chat_id, message_id, "❌ Ошибка: комната не найдена")
         user_states[user_id] = {'state': 'main_menu'}
 
-def handle_callback_query(callback_query, user_id):
-    try:
-        # Обновляем информацию о пользователе из callback
-        from_user = callback_query.get('from', {})
-        username = from_user.get('username', '')
-        first_name = from_user.get('first_name', '')
-        last_name = from_user.get('last_name', '')
-        
-        full_name = first_name
-        if last_name:
-            full_name += f" {last_name}"
-        if not full_name:
-            full_name = f"User_{user_id}"
-        
-        update_participant_info(user_id, full_name, username)
-        
-        data = callback_query.get('data', '')
-        message = callback_query.get('message', {})
-        message_id = message.get('message_id')
-        chat_id = message.get('chat', {}).get('id')
-        
-        # Всегда отвечаем на callback query
-        answer_callback_query(callback_query['id'])
-        
-        logger.info(f"👤 {user_id}: callback {data}")
-        
-        if data.startswith('budget_'):
-            try:
-                budget = int(data.split('_')[1])
-                # Получаем текущее состояние
-                state_data = user_states.get(user_id, {})
-                
-                # Сохраняем бюджет и переходим к следующему шагу
-                user_states[user_id] = {
-                    'state': 'creating_room',
-                    'step': 'date',
-                    'title': state_data.get('title', ''),
-                    'budget': budget
-                }
-                
-                # Редактируем сообщение с запросом даты
-                success = edit_message_text(
-                    chat_id, 
-                    message_id, 
-                    f"💰 Бюджет: {budget} руб.\n\n📅 Введите дату обмена подарками (ДД.ММ.ГГГГ):",
-                    reply_markup=create_back_keyboard()
-                )
-                
-                if not success:
-                    # Если не удалось отредактировать, отправляем новое сообщение
-                    send_message(
-                        user_id,
-                        f"💰 Бюджет: {budget} руб.\n\n📅 Введите дату обмена подарками (ДД.ММ.ГГГГ):",
-                        reply_markup=create_back_keyboard()
-                    )
-                    
-            except Exception as e:
-                logger.error(f"❌ Ошибка обработки бюджета: {e}")
-                send_message(user_id, "❌ Ошибка выбора бюджета. Попробуйте еще раз.")
-        
-        elif data in ['create_confirm', 'create_back']:
-            if data == 'create_back':
-                user_states[user_id] = {'state': 'creating_room', 'step': 'title'}
-                edit_message_text(chat_id, message_id, "🔄 Начинаем заново...\n🏠 Как назовем комнату?", reply_markup=create_back_keyboard())
-            else:
-                create_room_final(user_id, chat_id, message_id)
-        
-        elif data in ['join_yes', 'join_no', 'profile_back']:
-            if data in ['join_no', 'profile_back']:
-                user_states[user_id] = {'state': 'main_menu'}
-                edit_message_text(chat_id, message_id, "✅ Присоединение отменено.")
-                send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
-            else:
-                room_id = user_states[user_id].get('room_id')
-                if room_id and room_id in rooms:
-                    # ДОПОЛНИТЕЛЬНАЯ ПРОВЕРКА ДАТЫ ПЕРЕД РЕГИСТРАЦИЕЙ
-                    room = rooms[room_id]
-                    if is_date_passed(room.gift_date):
-                        edit_message_text(
-                            chat_id, 
-                            message_id, 
-                            f"❌ К сожалению, дата обмена подарками ({room.gift_date}) уже наступила.\n"
-                            f"Присоединиться к этой комнате больше нельзя."
-                        )
-                        user_states[user_id] = {'state': 'main_menu'}
-                        return
-                    
-                    if user_id in rooms[room_id].participants:
-                        edit_message_text(chat_id, message_id, "❌ Вы уже участник этой комнаты!")
-                        user_states[user_id] = {'state': 'main_menu'}
-                        return
-                    
-                    user_states[user_id] = {
-                        'state': 'joining_profile',
-                        'step': 'name',
-                        'room_id': room_id
-                    }
-                    edit_message_text(chat_id, message_id, "👤 Регистрация:\nВведите ваше ФИО:", reply_markup=create_back_keyboard())
-                else:
-                    edit_message_text(chat_id, message_id, "❌ Ошибка: комната не найдена")
-                    user_states[user_id] = {'state': 'main_menu'}
-        
-        elif data in ['profile_confirm', 'profile_edit']:
-            if data == 'profile_confirm':
-                join_room_final(user_id, chat_id, message_id)
-            else:
-                keyboard = create_edit_profile_keyboard()
-                edit_message_text(chat_id, message_id, "✏️ Что вы хотите изменить?", reply_markup=keyboard)
-        
-        elif data.startswith('edit_'):
-            if data == 'edit_back':
-                state_data = user_states.get(user_id, {})
-                show_profile_confirmation(user_id, state_data.get('name'), state_data.get('wish'), state_data.get('anti_wish'))
-            else:
-                user_states[user_id] = {
-                    'state': 'editing_profile',
-                    'editing_field': data
-                }
-                field_names = {
-                    'edit_name': 'ФИО',
-                    'edit_wish': 'пожелания',
-                    'edit_anti_wish': 'анти-пожелания'
-                }
-                edit_message_text(chat_id, message_id, f"Введите новые {field_names[data]}:", reply_markup=create_back_keyboard())
-        
-        elif data.startswith('switch_'):
-            room_id = data.split('_')[1]
-            if room_id in rooms:
-                set_active_room(user_id, room_id)
-                room = rooms[room_id]
-                edit_message_text(chat_id, message_id, f"✅ Переключились на комнату: {room.title}")
-                send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
-            else:
-                edit_message_text(chat_id, message_id, "❌ Комната не найдена")
-        
-        elif data == 'switch_back':
-            edit_message_text(chat_id, message_id, "Главное меню:")
-            send_message(user_id, "Выберите действие:", reply_markup=create_main_keyboard(user_id))
-        
-        elif data == 'delete_room':
-            handle_delete_room(user_id, chat_id, message_id)
-        
-        elif data in ['manage_back', 'room_stats']:
-            if data == 'manage_back':
-                edit_message_text(chat_id, message_id, "Главное меню:")
-                send_message(user_id, "Выберите действие:", reply_markup=create_main_keyboard(user_id))
-            else:
-                handle_room_stats(user_id, chat_id, message_id)
-    
-    except Exception as e:
-        logger.error(f"❌ Ошибка обработки callback: {e}")
-        # Пытаемся отправить сообщение об ошибке пользователю
-        try:
-            send_message(user_id, "❌ Произошла ошибка. Попробуйте еще раз.")
-        except:
-            pass
+def handle_profile_edit_menu(user_id, chat_id, message_id, data=None):
+    keyboard = create_edit_profile_keyboard()
+    edit_message_text(chat_id, message_id, "✏️ Что вы хотите изменить?", reply_markup=keyboard)
+
+def handle_edit_back(user_id, chat_id, message_id, data=None):
+    state_data = user_states.get(user_id, {})
+    show_profile_confirmation(user_id, state_data.get('name'), state_data.get('wish'), state_data.get('anti_wish'))
+
+PROFILE_FIELD_NAMES = {
+    'name': 'ФИО',
+    'wish': 'пожелания',
+    'anti_wish': 'анти-пожелания'
+}
+
+def handle_edit_field(user_id, chat_id, message_id, data):
+    field = data[len('edit_'):]
+    if field not in PROFILE_FIELD_NAMES:
+        return None
+    # Данные анкеты (при вступлении - еще не сохраненные) должны пережить правку поля
+    user_states[user_id] = dict(
+        user_states.get(user_id, {}),
+        state='editing_profile',
+        editing_field=field
+    )
+    edit_message_text(chat_id, message_id, f"Введите новые {PROFILE_FIELD_NAMES[field]}:", reply_markup=create_back_keyboard())
+
+def handle_switch_choice(user_id, chat_id, message_id, data):
+    room_id = data[len('switch_'):]
+    # В многопроцессном режиме нажатие приходит сюда с другого шарда - проверяем членство здесь
+    if room_id in rooms and user_id in rooms[room_id].participants:
+        set_active_room(user_id, room_id)
+        room = rooms[room_id]
+        edit_message_text(chat_id, message_id, f"✅ Переключились на комнату: {room.title}")
+        send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
+    else:
+        edit_message_text(chat_id, message_id, "❌ Комната не найдена")
+        return "❌ Комната больше не существует"
+
+def handle_inline_back(user_id, chat_id, message_id, data=None):
+    edit_message_text(chat_id, message_id, "Главное меню:")
+    send_message(user_id, "Выберите действие:", reply_markup=create_main_keyboard(user_id))
+
+def handle_participants_callback(user_id, chat_id, message_id, data):
+    _, room_id, page = data.rsplit('_', 2)
+    return handle_participants_page(user_id, chat_id, message_id, room_id, int(page))
 
 def show_room_confirmation(user_id):
     state_data = user_states.get(user_id, {})
@@ -869,7 +1507,18 @@ def show_room_confirmation(user_id):
         reply_markup=keyboard
     )
 
-def create_room_final(user_id, chat_id, message_id):
+# В многопроцессном режиме (sharding.py) комната должна принадлежать шарду, который ее создал
+room_id_filter = None
+# Вызываются с новой комнатой после ее создания (запись update, справочник кодов шардов)
+room_created_callbacks = []
+
+def new_room_id():
+    while True:
+        room_id = str(uuid4())[:8]
+        if room_id not in rooms and (room_id_filter is None or room_id_filter(room_id)):
+            return room_id
+
+def create_room_final(user_id, chat_id, message_id, data=None):
     state_data = user_states.get(user_id, {})
     
     title = state_data.get('title')
@@ -881,12 +1530,15 @@ def create_room_final(user_id, chat_id, message_id):
         user_states[user_id] = {'state': 'main_menu'}
         return
     
-    room_id = str(uuid4())[:8]
+    room_id = new_room_id()
     room = Room(room_id, title, user_id, budget, date)
     
     rooms[room_id] = room
     set_active_room(user_id, room_id)  # Устанавливаем активную комнату
     join_codes[room.join_code] = room_id
+    date_scheduler.schedule_room(room)
+    for callback in room_created_callbacks:
+        callback(room)
     
     user_states[user_id] = {
         'state': 'joining_profile',
@@ -910,13 +1562,15 @@ def create_room_final(user_id, chat_id, message_id):
     send_message(user_id, "👤 Введите ваше ФИО:", reply_markup=create_back_keyboard())
 
 def show_profile_confirmation(user_id, name, wish, anti_wish):
-    user_states[user_id] = {
-        'state': 'joining_profile_confirm',
-        'name': name,
-        'wish': wish,
-        'anti_wish': anti_wish,
-        'room_id': user_states[user_id].get('room_id')
-    }
+    # Остальное состояние вступления (room_id, is_admin, from_user) сохраняем
+    state_data = {key: value for key, value in user_states.get(user_id, {}).items() if key not in ('step', 'editing_field')}
+    user_states[user_id] = dict(
+        state_data,
+        state='joining_profile_confirm',
+        name=name,
+        wish=wish,
+        anti_wish=anti_wish
+    )
     
     keyboard = create_profile_confirmation_keyboard()
     
@@ -930,7 +1584,7 @@ def show_profile_confirmation(user_id, name, wish, anti_wish):
         reply_markup=keyboard
     )
 
-def join_room_final(user_id, chat_id, message_id):
+def join_room_final(user_id, chat_id, message_id, data=None):
     state_data = user_states.get(user_id, {})
     room_id = state_data.get('room_id')
     is_admin = state_data.get('is_admin', False)
@@ -960,6 +1614,8 @@ def join_room_final(user_id, chat_id, message_id):
     participant.anti_wishlist = anti_wish
     
     room.participants[user_id] = participant
+    room.touch()
+    add_membership(user_id, room_id)
     if not is_admin:
         set_active_room(user_id, room_id)  # Устанавливаем активную комнату
     
@@ -1022,7 +1678,7 @@ def handle_room_management(user_id):
         reply_markup=keyboard
     )
 
-def handle_delete_room(user_id, chat_id, message_id):
+def handle_delete_room(user_id, chat_id, message_id, data=None):
     if user_id not in user_rooms:
         edit_message_text(chat_id, message_id, "❌ Вы не в комнате.")
         return
@@ -1034,11 +1690,15 @@ def handle_delete_room(user_id, chat_id, message_id):
         edit_message_text(chat_id, message_id, "❌ Только организатор может удалить комнату.")
         return
     
-    for participant_id in room.participants:
-        if participant_id != user_id:
-            send_message(participant_id, f"❌ Комната \"{room.title}\" была удалена организатором.")
+    broadcast_to_room(
+        room,
+        f"❌ Комната \"{room.title}\" была удалена организатором.",
+        exclude=user_id,
+        name=f"delete-{room_id}"
+    )
     
-    for participant_id in room.participants:
+    for participant_id in list(room.participants):
+        remove_membership(participant_id, room_id)
         if participant_id in user_rooms and user_rooms[participant_id] == room_id:
             del user_rooms[participant_id]
     
@@ -1051,7 +1711,123 @@ def handle_delete_room(user_id, chat_id, message_id):
     edit_message_text(chat_id, message_id, "🗑️ Комната удалена.")
     send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
 
-def handle_room_stats(user_id, chat_id, message_id):
+# --- Объявления организатора ---
+ANNOUNCE_PROGRESS_INTERVAL = 2  # Не чаще одного обновления счетчиков в 2 секунды
+
+def get_admin_rooms(user_id):
+    return [room_id for room_id in get_user_rooms(user_id) if rooms[room_id].admin_id == user_id]
+
+def announcement_recipients(user_id, room_ids):
+    """Участники комнат без повторов; отдаются по мере обхода"""
+    seen = {user_id}
+    for room_id in room_ids:
+        room = rooms.get(room_id)
+        if not room:
+            continue
+        for participant_id in list(room.participants):
+            if participant_id not in seen:
+                seen.add(participant_id)
+                yield participant_id
+
+def show_announcement_confirmation(user_id):
+    state_data = user_states[user_id]
+    room = rooms.get(state_data.get('room_id'))
+    if not room:
+        user_states[user_id] = {'state': 'main_menu'}
+        send_message(user_id, "❌ Комната не найдена", reply_markup=create_main_keyboard(user_id))
+        return
+    
+    # Считаем так же, как будем рассылать: организатор мог и не быть участником
+    in_room = sum(1 for pid in list(room.participants) if pid != user_id)
+    keyboard = [[{'text': f"📤 В эту комнату ({in_room})", 'callback_data': "announce_room"}]]
+    admin_rooms = get_admin_rooms(user_id)
+    if len(admin_rooms) > 1:
+        total = sum(1 for _ in announcement_recipients(user_id, admin_rooms))
+        keyboard.append([{'text': f"📤 Во все мои комнаты ({total})", 'callback_data': "announce_all"}])
+    keyboard.append([{'text': "❌ Отмена", 'callback_data': "announce_cancel"}])
+    
+    send_message(
+        user_id,
+        f"📢 Ваше объявление:\n\n{state_data['text']}\n\nКому отправить?",
+        reply_markup={'inline_keyboard': keyboard}
+    )
+
+def handle_announcement_callback(user_id, chat_id, message_id, data):
+    if data == 'announce':
+        room_id = user_rooms.get(user_id)
+        if not room_id or room_id not in rooms or rooms[room_id].admin_id != user_id:
+            edit_message_text(chat_id, message_id, "❌ Только организатор может делать объявления.")
+            return
+        user_states[user_id] = {'state': 'announcing', 'room_id': room_id}
+        edit_message_text(chat_id, message_id, f"📢 Объявление для комнаты \"{rooms[room_id].title}\"")
+        send_message(user_id, "✏️ Введите текст объявления:", reply_markup=create_back_keyboard())
+        return
+    
+    state_data = user_states.get(user_id, {})
+    user_states[user_id] = {'state': 'main_menu'}
+    
+    if data == 'announce_cancel' or state_data.get('state') != 'announcing' or not state_data.get('text'):
+        edit_message_text(chat_id, message_id, "✅ Объявление отменено")
+        send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
+        return
+    
+    room_id = state_data.get('room_id')
+    if data == 'announce_all':
+        room_ids = get_admin_rooms(user_id)
+    elif room_id in rooms and rooms[room_id].admin_id == user_id:
+        room_ids = [room_id]
+    else:
+        room_ids = []
+    if not room_ids:
+        edit_message_text(chat_id, message_id, "❌ Комната не найдена")
+        return
+    
+    text = fit_message(f"{announcement_header(room_ids)}\n\n{state_data['text']}")
+    
+    progress_lock = threading.Lock()
+    last_progress = [time.monotonic()]
+    done = [False]
+    
+    def on_progress(result):
+        # Счетчики в сообщении организатора, не чаще раза в ANNOUNCE_PROGRESS_INTERVAL.
+        # Правка отправляется под блокировкой, иначе запоздавший прогресс затрет итог.
+        # Зовется из воркеров рассылки: если правка уже идет, не ждем ее, а пропускаем
+        if not progress_lock.acquire(blocking=False):
+            return
+        try:
+            if done[0]:
+                return
+            now = time.monotonic()
+            if now - last_progress[0] < ANNOUNCE_PROGRESS_INTERVAL:
+                return
+            last_progress[0] = now
+            edit_message_text(chat_id, message_id, f"📤 Отправка объявления...\n✅ Доставлено: {result.sent}\n⏳ Отложено: {result.deferred}\n❌ Ошибок: {result.failed}")
+        finally:
+            progress_lock.release()
+    
+    def on_done(result):
+        with progress_lock:
+            done[0] = True
+            edit_message_text(
+                chat_id, message_id,
+                f"📢 Объявление отправлено за {result.elapsed:.1f} с\n"
+                f"✅ Доставлено: {result.sent}/{result.total}\n"
+                f"⏳ Отложено до восстановления API: {result.deferred}\n"
+                f"❌ Ошибок: {result.failed}"
+            )
+    
+    edit_message_text(chat_id, message_id, "📤 Отправка объявления...")
+    # Иначе эта правка уйдет после первых правок прогресса и затрет их
+    flush_outbound()
+    broadcaster.broadcast(
+        ((pid, text) for pid in announcement_recipients(user_id, room_ids)),
+        name=f"announce-{user_id}",
+        on_done=on_done,
+        on_progress=on_progress
+    )
+    send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
+
+def handle_room_stats(user_id, chat_id, message_id, data=None):
     if user_id not in user_rooms:
         edit_message_text(chat_id, message_id, "❌ Вы не в комнате.")
         return
@@ -1059,25 +1835,14 @@ def handle_room_stats(user_id, chat_id, message_id):
     room_id = user_rooms[user_id]
     room = rooms[room_id]
     
-    admin = room.participants.get(room.admin_id)
-    admin_mention = format_user_mention(room.admin_id, admin.full_name if admin else "Неизвестно", admin.username if admin else "")
-    
-    stats_text = (
-        f"📊 Статистика комнаты: {room.title}\n\n"
-        f"👥 Участников: {len(room.participants)}\n"
-        f"💰 Бюджет: {room.budget} руб.\n"
-        f"📅 Дата: {room.gift_date}\n"
-        f"🎲 Жеребьевка: {'✅ Проведена' if room.raffle_done else '❌ Не проведена'}\n"
-        f"🔑 Код для вступления: {room.join_code}\n\n"
-        f"Организатор:\n{admin_mention}"
-    )
+    stats_text = render_room_text(room, 'room_stats')
     
     edit_message_text(chat_id, message_id, stats_text, parse_mode='HTML')
 
 def handle_switch_room(user_id):
     user_room_ids = get_user_rooms(user_id)
     
-    if len(user_room_ids) <= 1:
+    if len(user_room_ids) <= 1 and not get_external_rooms(user_id):
         send_message(user_id, "❌ Вы состоите только в одной комнате.")
         return
     
@@ -1087,23 +1852,27 @@ def handle_switch_room(user_id):
 def show_room_info(user_id, room):
     role = "👑 Организатор" if room.admin_id == user_id else "👤 Участник"
     
-    admin = room.participants.get(room.admin_id)
-    admin_mention = format_user_mention(room.admin_id, admin.full_name if admin else "Неизвестно", admin.username if admin else "")
-    
-    info_text = (
-        f"🏠 Информация о комнате:\n\n"
-        f"Название: {room.title}\n"
-        f"Роль: {role}\n"
-        f"💰 Бюджет: {room.budget} руб.\n"
-        f"📅 Дата: {room.gift_date}\n"
-        f"👥 Участников: {len(room.participants)}\n"
-        f"🎲 Жеребьевка: {'✅ Проведена' if room.raffle_done else '❌ Не проведена'}\n"
-        f"🔑 Код для друзей: {room.join_code}\n\n"
-        f"Организатор:\n{admin_mention}"
-    )
+    info_text = render_room_text(room, 'room_info', role=role)
     
     send_message(user_id, info_text, parse_mode='HTML')
 
+def draw_targets(participant_ids):
+    """Случайное распределение без подарков самому себе: targets[i] - получатель participant_ids[i]"""
+    targets = participant_ids.copy()
+    
+    max_attempts = 100
+    for attempt in range(max_attempts):
+        random.shuffle(targets)
+        valid = True
+        for i, pid in enumerate(participant_ids):
+            if pid == targets[i]:
+                valid = False
+                break
+        if valid:
+            return targets
+    
+    return participant_ids[1:] + [participant_ids[0]]
+
 def handle_raffle(user_id):
     if user_id not in user_rooms:
         send_message(user_id, "❌ Вы не в комнате.")
@@ -1125,61 +1894,88 @@ def handle_raffle(user_id):
         return
     
     participant_ids = list(room.participants.keys())
-    targets = participant_ids.copy()
-    
-    max_attempts = 100
-    for attempt in range(max_attempts):
-        random.shuffle(targets)
-        valid = True
-        for i, pid in enumerate(participant_ids):
-            if pid == targets[i]:
-                valid = False
-                break
-        if valid:
-            break
-    else:
-        targets = participant_ids[1:] + [participant_ids[0]]
+    targets = draw_targets(participant_ids)
     
     for i, pid in enumerate(participant_ids):
         room.participants[pid].target_id = targets[i]
     
     room.raffle_done = True
+    room.touch()
     save_data()
     
-    print("\n" + "="*50)
-    print("🎲 ЖЕРЕБЬЕВКА ПРОВЕДЕНА!")
-    print(f"Комната: {room.title}")
-    print(f"Участников: {len(participant_ids)}")
-    print("-" * 50)
-    
-    for i, pid in enumerate(participant_ids):
-        giver = room.participants[pid]
-        receiver = room.participants[targets[i]]
-        print(f"{giver.full_name} -> {receiver.full_name}")
+    # Сами пары не логируем: это секрет участников
+    logger.info(f"🎲 Жеребьевка проведена в комнате {room_id}: {len(participant_ids)} участников",
+                extra={'room_id': room_id})
+    
+    # Пары фиксируем сразу: пока идет рассылка, кто-то может выйти из комнаты
+    pairs = [(pid, room.participants[targets[i]]) for i, pid in enumerate(participant_ids)]
+    
+    def raffle_messages():
+        # Тексты рендерятся по мере отправки, а не все сразу
+        for pid, target in pairs:
+            yield pid, render(
+                'raffle_result',
+                target_mention=format_user_mention(target.user_id, target.full_name, target.username),
+                wishlist=target.wishlist or 'Не указано',
+                anti_wishlist=target.anti_wishlist or 'Не указано',
+                budget=room.budget
+            )
     
-    print("="*50 + "\n")
+    def report(result):
+        text = f"✅ Жеребьевка проведена! Уведомления отправлены {result.sent}/{result.total} участникам."
+        if result.deferred:
+            text += f"\n⏳ Еще {result.deferred} будут досланы, когда Telegram снова станет доступен."
+        send_message(user_id, text)
     
-    def send_raffle_result(pid):
-        participant = room.participants[pid]
-        target = room.participants[participant.target_id]
-        
-        target_mention = format_user_mention(target.user_id, target.full_name, target.username)
-        
-        message_text = (
-            f"🎉 Жеребьевка проведена!\n\n"
-            f"🎁 Вы дарите подарок: {target_mention}\n\n"
-            f"Пожелания:\n{target.wishlist or 'Не указано'}\n\n"
-            f"Не дарить:\n{target.anti_wishlist or 'Не указано'}\n\n"
-            f"💰 Бюджет: {room.budget} руб.\n"
-            f"Удачи в выборе подарка! 🎄"
+    send_message(user_id, f"🎲 Жеребьевка проведена, рассылаю результаты {len(participant_ids)} участникам...")
+    # Организатор видит "рассылаю..." до начала рассылки, а не вместе с итогом
+    flush_outbound()
+    broadcaster.broadcast(raffle_messages(), name=f"raffle-{room_id}", parse_mode='HTML', on_done=report)
+
+# --- Постраничный список участников ---
+PARTICIPANTS_PAGE_SIZE = 50
+PARTICIPANTS_PAGE_CHARS = 3500  # Запас до лимита в 4096 символов на заголовок и подвал
+
+def get_participant_pages(room):
+    """Разбивает список участников на страницы; результат кэшируется до room.touch()"""
+    revision, pages = room._participant_pages
+    if revision == room.revision:
+        return pages
+    
+    pages, page, page_chars = [], [], 0
+    for participant in list(room.participants.values()):
+        role = "👑" if participant.user_id == room.admin_id else "👤"
+        user_mention = format_user_mention(participant.user_id, participant.full_name, participant.username)
+        line = render('participant_line', role=role, mention=user_mention)
+        if page and (len(page) >= PARTICIPANTS_PAGE_SIZE or page_chars + len(line) > PARTICIPANTS_PAGE_CHARS):
+            pages.append(page)
+            page, page_chars = [], 0
+        page.append(line)
+        page_chars += len(line) + 1
+    pages.append(page)
+    
+    total = len(pages)
+    rendered = []
+    for number, lines in enumerate(pages):
+        text = render(
+            'participants',
+            title=room.title,
+            participants="\n".join(lines),
+            participants_count=len(room.participants)
         )
+        if total > 1:
+            text += f"\nСтраница {number + 1}/{total}"
         
-        return send_message(pid, message_text, parse_mode='HTML')
-    
-    futures = [executor.submit(send_raffle_result, pid) for pid in participant_ids]
-    success_count = sum(1 for future in futures if future.result())
-    
-    send_message(user_id, f"✅ Жеребьевка проведена! Уведомления отправлены {success_count}/{len(participant_ids)} участникам.")
+        nav = []
+        if number > 0:
+            nav.append({'text': "◀️ Назад", 'callback_data': f"participants_{room.room_id}_{number - 1}"})
+        if number < total - 1:
+            nav.append({'text': "Вперед ▶️", 'callback_data': f"participants_{room.room_id}_{number + 1}"})
+        keyboard = _encode_keyboard({'inline_keyboard': [nav]}) if nav else None
+        rendered.append((text, keyboard))
+    
+    room._participant_pages = (room.revision, rendered)
+    return rendered
 
 def handle_show_participants(user_id):
     if user_id not in user_rooms:
@@ -1189,20 +1985,22 @@ def handle_show_participants(user_id):
     room_id = user_rooms[user_id]
     room = rooms[room_id]
     
-    participants_list = []
-    for participant in room.participants.values():
-        role = "👑" if participant.user_id == room.admin_id else "👤"
-        user_mention = format_user_mention(participant.user_id, participant.full_name, participant.username)
-        participants_list.append(f"{role} {user_mention}")
-    
-    participants_text = "\n".join(participants_list)
+    text, keyboard = get_participant_pages(room)[0]
+    send_message(user_id, text, reply_markup=keyboard, parse_mode='HTML')
+
+def handle_participants_page(user_id, chat_id, message_id, room_id, page):
+    room = rooms.get(room_id)
+    if not room or user_id not in room.participants:
+        edit_message_text(chat_id, message_id, "❌ Комната не найдена")
+        return
     
-    send_message(
-        user_id,
-        f"👥 Участники комнаты \"{room.title}\":\n\n{participants_text}\n\n"
-        f"Всего: {len(room.participants)} человек",
-        parse_mode='HTML'
-    )
+    pages = get_participant_pages(room)
+    # Пока листали, список мог укоротиться
+    shown = max(0, min(page, len(pages) - 1))
+    text, keyboard = pages[shown]
+    edit_message_text(chat_id, message_id, text, reply_markup=keyboard, parse_mode='HTML')
+    if shown != page:
+        return "🔄 Список участников обновился"
 
 def handle_invite_players(user_id):
     if user_id not in user_rooms:
@@ -1212,26 +2010,59 @@ def handle_invite_players(user_id):
     room_id = user_rooms[user_id]
     room = rooms[room_id]
     
-    try:
-        bot_info = requests.get(f"{BASE_URL}/getMe").json()
-        bot_username = bot_info['result']['username']
-    except:
-        bot_username = "your_bot"
+    bot_username = get_bot_username()
+    if not bot_username:
+        # Кэш еще пуст: ссылку не даем, но и обработчик сетью не блокируем
+        runtime.executor.try_submit(refresh_bot_identity)
+        send_message(
+            user_id,
+            render('invite_code_only', title=room.title, join_code=room.join_code, participants_count=len(room.participants)),
+            parse_mode='HTML'
+        )
+        return
     
     invite_link = room.get_invite_link(bot_username)
     
     send_message(
         user_id,
-        f"📨 Пригласите друзей в комнату \"{room.title}\":\n\n"
-        f"🔗 Ссылка:\n<code>{invite_link}</code>\n\n"
-        f"🔑 Или код:\n<code>{room.join_code}</code>\n\n"
-        f"👥 Участников: {len(room.participants)}",
+        render(
+            'invite',
+            title=room.title,
+            invite_link=invite_link,
+            join_code=room.join_code,
+            participants_count=len(room.participants)
+        ),
+        parse_mode='HTML'
+    )
+
+def show_archived_recipient(user_id):
+    """Показывает получателя из последней архивной комнаты пользователя"""
+    room_data = room_archive.latest_for_user(user_id)
+    if not room_data or not room_data['raffle_done']:
+        return False
+    
+    participant = room_data['participants'].get(str(user_id))
+    target = room_data['participants'].get(str(participant['target_id'])) if participant else None
+    if not target:
+        return False
+    
+    send_message(
+        user_id,
+        render(
+            'archived_recipient',
+            title=room_data['title'],
+            gift_date=room_data['gift_date'],
+            target_mention=format_user_mention(target['user_id'], target['full_name'], target['username']),
+            wishlist=target['wishlist'] or 'Не указано'
+        ),
         parse_mode='HTML'
     )
+    return True
 
 def handle_show_recipient(user_id):
     if user_id not in user_rooms:
-        send_message(user_id, "❌ Вы не в комнате.")
+        if not show_archived_recipient(user_id):
+            send_message(user_id, "❌ Вы не в комнате.")
         return
     
     room_id = user_rooms[user_id]
@@ -1247,14 +2078,13 @@ def handle_show_recipient(user_id):
         return
     
     target = room.participants[participant.target_id]
-    target_mention = format_user_mention(target.user_id, target.full_name, target.username)
-    
-    message_text = (
-        f"🎁 Ваш получатель: {target_mention}\n\n"
-        f"🎁 Пожелания:\n{target.wishlist or 'Не указано'}\n\n"
-        f"🚫 Не дарить:\n{target.anti_wishlist or 'Не указано'}\n\n"
-        f"💰 Бюджет: {room.budget} руб.\n"
-        f"Удачи в выборе подарка! 🎄"
+    
+    message_text = render(
+        'recipient',
+        target_mention=format_user_mention(target.user_id, target.full_name, target.username),
+        wishlist=target.wishlist or 'Не указано',
+        anti_wishlist=target.anti_wishlist or 'Не указано',
+        budget=room.budget
     )
     
     send_message(user_id, message_text, parse_mode='HTML')
@@ -1272,6 +2102,8 @@ def handle_leave_room(user_id):
         return
     
     del room.participants[user_id]
+    room.touch()
+    remove_membership(user_id, room_id)
     del user_rooms[user_id]
     
     user_room_count = get_user_rooms(user_id)
@@ -1282,42 +2114,325 @@ def handle_leave_room(user_id):
     send_message(user_id, "👋 Вы вышли из комнаты.")
     send_message(user_id, "Главное меню:", reply_markup=create_main_keyboard(user_id))
 
+# --- Защита от флуда ---
+FLOOD_RATE = float(os.environ.get('FLOOD_RATE', 1.0))     # Запросов в секунду в среднем
+FLOOD_BURST = float(os.environ.get('FLOOD_BURST', 6))     # Сколько можно нажать подряд
+FLOOD_MAX_USERS = 10000                                   # Сколько корзин держим в памяти
+
+class FloodControl:
+    """Token bucket на каждого пользователя.
+    
+    Корзины хранятся в LRU-словаре ограниченного размера: давно молчавшие
+    пользователи вытесняются и при возвращении получают полную корзину.
+    """
+    
+    def __init__(self, rate, burst, max_users):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.buckets = OrderedDict()  # user_id -> [токены, время, предупрежден]
+        self.lock = threading.Lock()
+        self.dropped = 0
+    
+    def check(self, user_id):
+        """Возвращает (можно ли обработать, нужно ли предупредить пользователя)"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = [self.burst, now, False]
+                self.buckets[user_id] = bucket
+                if len(self.buckets) > self.max_users:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(user_id)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                bucket[2] = False
+                return True, False
+            
+            self.dropped += 1
+            # Предупреждаем один раз за эпизод флуда
+            notify = not bucket[2]
+            bucket[2] = True
+            return False, notify
+
+flood_control = FloodControl(FLOOD_RATE, FLOOD_BURST, FLOOD_MAX_USERS)
+
+def update_handler_label(update):
+    """Имя обработчика для метрик; число значений ограничено кнопками, состояниями и префиксами callback"""
+    if 'callback_query' in update:
+        return 'callback:' + update['callback_query'].get('data', '').split('_')[0]
+    message = update.get('message', {})
+    text = message.get('text')
+    if text is None:
+        return 'other'
+    if text.startswith('/start') and text.split(None, 1)[0] == '/start':
+        return 'start'
+    if text in MENU_BUTTONS:
+        return 'menu:' + text
+    state = user_states.get(message.get('from', {}).get('id'), {}).get('state', 'main_menu')
+    return 'text:' + state
+
 def process_update(update):
+    handler = update_handler_label(update)
+    if update_recorder is not None:
+        update_recorder.record(update)
     try:
-        update_id = update.get('update_id')
-        
+        # Корневой спан трассы; ожидание в очереди, обработчик, вызовы API и сохранение - его потомки
+        with tracing.start_span('process_update', handler=handler, update_id=update.get('update_id', 0)):
+            tracing.record_queue_wait()
+            try:
+                router.dispatch(update, label=handler)
+            except Exception as e:
+                tracing.current_span().set_error(e)
+                logger.error(f"❌ Ошибка обработки update: {e}")
+    finally:
+        if update_recorder is not None:
+            update_recorder.finish()
+
+# --- Middleware ---
+# Выполняются по одному разу на update в порядке подключения (см. блок маршрутов)
+
+def metrics_middleware(request, call_next):
+    """Время обработки update по обработчикам, включая отправку ответов"""
+    started = time.perf_counter()
+    try:
+        return call_next(request)
+    finally:
+        update_duration.labels(request.label).observe(time.perf_counter() - started)
+
+def outbound_middleware(request, call_next):
+    """Сообщения копятся в буфере потока и уходят одной пачкой после обработчика"""
+    _outbound.buffer = OutboundBuffer()
+    try:
+        return call_next(request)
+    finally:
+        buffer, _outbound.buffer = _outbound.buffer, None
+        with tracing.start_span('outbound.flush', messages=len(buffer.messages)):
+            buffer.flush()
+
+def dedup_middleware(request, call_next):
+    update_id = request.update.get('update_id')
+    
+    with last_updates_lock:
         if update_id in last_updates:
-            return
-        
-        last_updates[update_id] = time.time()
+            return None
         
         current_time = time.time()
-        for uid, timestamp in list(last_updates.items()):
-            if current_time - timestamp > 300:
-                del last_updates[uid]
-        
-        if 'message' in update:
-            message = update['message']
-            user_id = message['from']['id']
-            if 'text' in message and message['text'].startswith('/start'):
-                handle_start(message, user_id)
-            elif 'text' in message:
-                handle_text_message(message, user_id)
+        last_updates[update_id] = current_time
         
-        elif 'callback_query' in update:
-            callback_query = update['callback_query']
-            user_id = callback_query['from']['id']
-            handle_callback_query(callback_query, user_id)
-            
+        while last_updates:
+            uid, timestamp = next(iter(last_updates.items()))
+            if current_time - timestamp <= 300:
+                break
+            last_updates.pop(uid, None)
+    
+    return call_next(request)
+
+def flood_middleware(request, call_next):
+    """Лишние update отбрасываются до обработчика. На нажатие отвечаем всегда (иначе у кнопки
+    крутится индикатор), предупреждение - один раз за эпизод флуда. Если отброшен ответ
+    в диалоге (имя, дата), предупреждение просит отправить его еще раз"""
+    if request.from_user:
+        allowed, notify = flood_control.check(request.user_id)
+        if not allowed:
+            slow_down = "⏳ Слишком много запросов. Подождите пару секунд."
+            if request.kind == 'callback':
+                answer_callback_query_async(request.callback_id, slow_down if notify else None)
+            elif notify:
+                if router.state_of(request.user_id) != 'main_menu':
+                    slow_down += "\nПоследние сообщения не приняты - отправьте ответ еще раз."
+                send_message(request.user_id, slow_down)
+            return None
+    return call_next(request)
+
+def callback_answer_middleware(request, call_next):
+    """На каждое нажатие отвечаем answerCallbackQuery, даже если обработчик упал"""
+    if request.kind != 'callback':
+        return call_next(request)
+    toast = None
+    try:
+        toast = call_next(request)
     except Exception as e:
-        logger.error(f"❌ Ошибка обработки update: {e}")
+        logger.error(f"❌ Ошибка обработки callback: {e}")
+        # Пытаемся отправить сообщение об ошибке пользователю
+        try:
+            send_message(request.user_id, "❌ Произошла ошибка. Попробуйте еще раз.")
+        except:
+            pass
+    finally:
+        # Ответ на callback уходит в фоне и не задерживает обработку нажатия
+        answer_callback_query_async(request.callback_id, toast)
+    return toast
+
+def profile_middleware(request, call_next):
+    """Имя и username пользователя могли поменяться - обновляем их в комнатах"""
+    if request.text is not None or request.data is not None:
+        user_id = request.user_id
+        from_user = request.from_user
+        full_name = from_user.get('first_name', '')
+        if from_user.get('last_name'):
+            full_name += f" {from_user['last_name']}"
+        update_participant_info(user_id, full_name or f"User_{user_id}", from_user.get('username', ''))
+        
+        if request.data is not None:
+            logger.info(f"👤 {user_id}: callback {request.data}", extra={'category': 'update', 'user_id': user_id})
+        elif request.text in MENU_BUTTONS:
+            logger.info(f"👤 {user_id}: {request.text}", extra={'category': 'update', 'user_id': user_id})
+    return call_next(request)
+
+def trace_middleware(request, call_next):
+    with tracing.start_span('handler', handler=request.label):
+        return call_next(request)
+
+def state_lock_middleware(request, call_next):
+    """Обработчики меняют общее состояние по одному: per-user очереди не мешают двум участникам
+    одной комнаты (вступление и жеребьевка, удаление и вступление) идти одновременно.
+    Сообщения копятся в буфере и уходят после снятия блокировки (outbound_middleware)"""
+    with processing_lock:
+        return call_next(request)
+
+# --- Профилирование горячего пути ---
+# Включается переменной PROFILING=1 при runtime.start(); без нее функции не оборачиваются и накладных расходов нет.
+# Отчет: сигнал SIGUSR1 (в лог) или команда /profile от пользователей из PROFILE_ADMINS
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.01))
+PROFILE_ADMINS = {int(uid) for uid in os.environ.get('PROFILE_ADMINS', '').split(',') if uid.strip()}
+PROFILED_FUNCTIONS = [
+    'telegram_api_call', 'send_message', 'edit_message_text', 'answer_callback_query',
+    'save_data', 'create_main_keyboard', 'render_room_text'
+]
+
+profiler = None
+
+def enable_profiling(sample_rate=PROFILE_SAMPLE_RATE):
+    """Оборачивает process_update, все handle_* и вызовы Telegram API"""
+    global profiler
+    # cProfile и pstats импортируются, только если профилирование включено
+    from profiling import HotPathProfiler
+    if profiler is None:
+        profiler = HotPathProfiler(sample_rate=sample_rate)
+    module = sys.modules[__name__]
+    names = ['process_update'] + PROFILED_FUNCTIONS + [
+        name for name, value in vars(module).items()
+        if name.startswith('handle_') and callable(value)
+    ]
+    originals = {name: getattr(module, name) for name in names if hasattr(module, name)}
+    profiler.instrument(module, names, sampled=('process_update',))
+    # Таблицы маршрутов держат ссылки на сами функции - подставляем туда обертки
+    router.replace_handlers({func: getattr(module, name) for name, func in originals.items()})
+    logger.info(f"🔬 Профилирование включено: {len(names)} функций, выборка cProfile {sample_rate:.1%}")
+    return profiler
+
+def handle_profile_command(message, user_id):
+    text = message.get('text', '')
+    if profiler is None:
+        send_message(user_id, "🔬 Профилирование выключено (PROFILING=1 в окружении)")
+        return
+    if text.strip() == '/profile reset':
+        profiler.reset()
+        send_message(user_id, "🔬 Статистика профилирования сброшена")
+        return
+    send_message(user_id, fit_message(profiler.report()))
+
+# --- Маршруты update ---
+# Текст: словарь (состояние, текст) -> обработчик, затем префиксы и обработчик ввода состояния.
+# Callback: точное значение data, затем самый длинный префикс ("switch_back" не уходит в "switch_")
+router = Router(state_of=lambda user_id: user_states.get(user_id, {}).get('state', 'main_menu'))
+
+router.command('/start', handle_start)
+router.command('/profile', handle_profile_command, when=lambda request: request.user_id in PROFILE_ADMINS)
+
+MAIN_MENU_ROUTES = {
+    "🎯 Создать комнату": start_room_creation,
+    "🔍 Присоединиться": start_join_by_code,
+    "🔙 Назад": show_main_menu,
+    "🔄 Сменить комнату": handle_switch_room,
+    "🎲 Жеребьевка": handle_raffle,
+    "👥 Участники": handle_show_participants,
+    "📨 Пригласить": handle_invite_players,
+    "⚙️ Управление": handle_room_management,
+    "👤 Мой профиль": handle_show_my_profile,
+    "🎁 Мой получатель": handle_show_recipient,
+    "🚪 Выйти": handle_leave_room,
+}
+for text, handler in MAIN_MENU_ROUTES.items():
+    router.text('main_menu', text, handler)
+router.text_prefix('main_menu', "🏠 ", handle_room_button)
+router.text_input('main_menu', handle_unknown_text)
+
+# Ввод в диалогах; "🔙 Назад" в любом из них возвращает в главное меню
+DIALOG_ROUTES = {
+    'creating_room': (handle_room_creation_input, "✅ Создание комнаты отменено"),
+    'joining_by_code': (handle_join_code_input, "✅ Присоединение отменено"),
+    'joining_profile': (handle_profile_input, "✅ Регистрация отменена"),
+    'announcing': (handle_announcement_input, "✅ Объявление отменено"),
+    'editing_profile': (handle_profile_edit_input, "✅ Редактирование отменено"),
+}
+for state, (handler, cancel_notice) in DIALOG_ROUTES.items():
+    router.text_input(state, handler)
+    router.text(state, "🔙 Назад", cancel_to_main_menu(cancel_notice))
+
+CALLBACK_ROUTES = {
+    'create_confirm': create_room_final,
+    'create_back': handle_create_back,
+    'join_yes': handle_join_confirm,
+    'join_no': handle_join_cancel,
+    'profile_back': handle_join_cancel,
+    'profile_confirm': join_room_final,
+    'profile_edit': handle_profile_edit_menu,
+    'edit_back': handle_edit_back,
+    'switch_back': handle_inline_back,
+    'manage_back': handle_inline_back,
+    'delete_room': handle_delete_room,
+    'room_stats': handle_room_stats,
+}
+CALLBACK_PREFIX_ROUTES = {
+    'budget_': handle_budget_choice,
+    'edit_': handle_edit_field,
+    'switch_': handle_switch_choice,
+    'announce': handle_announcement_callback,
+    'participants_': handle_participants_callback,
+}
+for data, handler in CALLBACK_ROUTES.items():
+    router.callback(data, handler)
+for prefix, handler in CALLBACK_PREFIX_ROUTES.items():
+    router.callback_prefix(prefix, handler)
+
+# Порядок важен: повторы отсекаются до всего остального, метрики охватывают отправку ответов,
+# антифлуд срабатывает до обновления профиля, блокировка состояния - внутри буфера исходящих
+for middleware in (dedup_middleware, metrics_middleware, outbound_middleware, flood_middleware,
+                   callback_answer_middleware, state_lock_middleware, profile_middleware, trace_middleware):
+    router.use(middleware)
+
+# --- Запись входящих update ---
+# RECORD_UPDATES=путь.jsonl.gz включает при runtime.start() запись обезличенного потока update для benchmarks/replay.py.
+# RECORD_SALT задает соль псевдонимов: с одной солью записи разных дней ссылаются на одних пользователей
+RECORD_UPDATES = os.environ.get('RECORD_UPDATES')
+
+update_recorder = None
+
+def enable_update_recording(path):
+    global update_recorder
+    update_recorder = UpdateRecorder(
+        path,
+        keep_texts=MENU_BUTTONS + ["🔙 Назад"],
+        is_room=lambda room_id: room_id in rooms,
+        room_by_code=lambda code: join_codes.get(code),
+        salt=os.environ.get('RECORD_SALT')
+    )
+    room_created_callbacks.append(lambda room: update_recorder.note_room_created(room.room_id))
+    return update_recorder
 
 def main():
     offset = 0
     while True:  # ← ВАЖНО: бесконечный цикл!
         try:
             # Получаем обновления от Telegram
-            response = requests.get(f"{BASE_URL}/getUpdates", params={
+            response = runtime.session.get(f"{BASE_URL}/getUpdates", params={
                 'offset': offset + 1,
                 'timeout': 25,
                 'limit': 50
@@ -1326,11 +2441,8 @@ def main():
         except Exception as e:
             # ... обработка ошибок ...
             time.sleep(5)
-    print("Загрузка данных...")
-    load_data()
-    
-    print("Проверка токена бота...")
-    if not check_bot_token():
+    print("Загрузка данных и проверка токена бота...")
+    if not runtime.start():
         print("❌ ОШИБКА: Неверный токен бота!")
         print("Убедитесь, что:")
         print("1. Вы получили токен от @BotFather")
@@ -1357,7 +2469,7 @@ def main():
                 'timeout': 25,
                 'limit': 50
             }
-            response = requests.get(url, params=params, timeout=30)
+            response = runtime.session.get(url, params=params, timeout=30)
             
             if response.status_code == 200:
                 data = response.json()
@@ -1395,11 +2507,8 @@ def main():
 # В КОНЦЕ SantOS.py
 def start_bot():
     """Функция для запуска бота (оставьте как есть)"""
-    print("Загрузка данных...")
-    load_data()
-    
-    print("Проверка токена бота...")
-    if not check_bot_token():
+    print("Загрузка данных и проверка токена бота...")
+    if not runtime.start():
         print("❌ ОШИБКА: Неверный токен бота!")
         return
     
@@ -1420,7 +2529,7 @@ def start_bot():
                 'timeout': 25,
                 'limit': 50
             }
-            response = requests.get(url, params=params, timeout=30)
+            response = runtime.session.get(url, params=params, timeout=30)
             
             if response.status_code == 200:
                 data = response.json()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+bench_core.py - Микробенчмарки основных операций бота на синтетических данных
+Комнаты и участники генерируются в памяти, сеть заглушена. Результаты сравниваются
+с сохраненной базой (benchmarks/baselines/bench_core.json), замедления отмечаются
+
+    python benchmarks/bench_core.py                      # 1k, 10k и 100k комнат, сравнение с базой
+    python benchmarks/bench_core.py --sizes 1000 --save  # записать новую базу
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+BASELINE_PATH = os.path.join(ROOT, 'benchmarks', 'baselines', 'bench_core.json')
+
+def measure(func, min_time=0.2, max_runs=10000):
+    """Гоняет func, пока не наберется min_time секунд; возвращает времена в микросекундах"""
+    times = []
+    total = 0.0
+    while (total < min_time or len(times) < 3) and len(times) < max_runs:
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        times.append(elapsed)
+        total += elapsed
+        # Тяжелые операции (сохранение 100k комнат) хватит прогнать один раз
+        if elapsed > 1.0:
+            break
+    times.sort()
+    return {
+        'runs': len(times),
+        'min_us': round(times[0] * 1e6, 2),
+        'median_us': round(times[len(times) // 2] * 1e6, 2),
+        'mean_us': round(total / len(times) * 1e6, 2)
+    }
+
+def stub_network(SantOS):
+    """Никаких запросов к Telegram: любой вызов API успешен"""
+    SantOS.telegram_api_call = lambda method, payload, timeout, attempts=None: (SantOS.API_OK, {'message_id': 1})
+    SantOS.refresh_bot_identity = lambda: True
+    SantOS.bot_identity.update({'id': 1, 'username': 'bench_bot'})
+
+def build_state(SantOS, room_count, room_size):
+    """Синтетическое состояние: room_count комнат по room_size участников,
+    часть пользователей состоит в нескольких комнатах"""
+    rng = random.Random(42)
+    SantOS.rooms.clear()
+    SantOS.user_rooms.clear()
+    SantOS.join_codes.clear()
+    SantOS.last_updates.clear()
+    user_pool = max(room_size, int(room_count * room_size * 0.8))
+    gift_date = time.strftime('%d.%m.%Y', time.localtime(time.time() + 365 * 86400))
+
+    for i in range(room_count):
+        room_id = f"{i:08x}"
+        admin_id = rng.randrange(1, user_pool)
+        room = SantOS.Room(room_id, f"Комната {i}", admin_id, 1000, gift_date)
+        members = {admin_id} | set(rng.sample(range(1, user_pool), room_size - 1))
+        for user_id in list(members)[:room_size]:
+            participant = SantOS.Participant(user_id, f"Участник {user_id}", f"user{user_id}")
+            participant.wishlist = "Книгу и шоколад"
+            participant.anti_wishlist = "Носки"
+            room.participants[user_id] = participant
+            SantOS.user_rooms[user_id] = room_id
+        SantOS.rooms[room_id] = room
+        SantOS.join_codes[room.join_code] = room_id
+
+    SantOS.rebuild_memberships()
+    return sorted(SantOS.user_rooms)
+
+def run_size(SantOS, room_count, room_size, min_time):
+    user_ids = build_state(SantOS, room_count, room_size)
+    rng = random.Random(7)
+    sample_users = [rng.choice(user_ids) for _ in range(1000)]
+    sample_rooms = [SantOS.rooms[SantOS.user_rooms[u]] for u in sample_users]
+    room_dicts = [room.to_dict() for room in sample_rooms]
+    cursor = {'i': 0}
+
+    def next_index():
+        cursor['i'] = (cursor['i'] + 1) % len(sample_users)
+        return cursor['i']
+
+    def keyboard_cold():
+        user_id = sample_users[next_index()]
+        SantOS._main_keyboard_cache.pop(user_id, None)
+        SantOS.create_main_keyboard(user_id)
+
+    def participant_rename():
+        i = next_index()
+        user_id = sample_users[i]
+        SantOS.update_participant_info(user_id, f"Участник {user_id} {i % 2}", f"user{user_id}")
+
+    # Окно дедупликации: столько update_id, сколько бот видел за последние 5 минут
+    now = time.time()
+    for update_id in range(room_count):
+        SantOS.last_updates[update_id] = now
+    next_update = {'id': room_count}
+
+    def process_new_update():
+        next_update['id'] += 1
+        SantOS.process_update({'update_id': next_update['id']})
+
+    big_room = list(range(1, 1001))
+    cases = [
+        ('save_data', SantOS.save_data),
+        ('load_data', SantOS.load_data),
+        ('room_to_dict', lambda: sample_rooms[next_index()].to_dict()),
+        ('room_from_dict', lambda: SantOS.Room.from_dict(room_dicts[next_index()])),
+        ('create_main_keyboard_cold', keyboard_cold),
+        ('create_main_keyboard_cached', lambda: SantOS.create_main_keyboard(sample_users[next_index()])),
+        ('get_user_rooms', lambda: SantOS.get_user_rooms(sample_users[next_index()])),
+        ('update_participant_info_same', lambda: SantOS.update_participant_info(
+            sample_users[next_index()], f"Участник {sample_users[cursor['i']]}", '')),
+        ('update_participant_info_changed', participant_rename),
+        (f'draw_targets_{room_size}', lambda: SantOS.draw_targets(list(sample_rooms[next_index()].participants))),
+        ('draw_targets_1000', lambda: SantOS.draw_targets(big_room)),
+        ('process_update_duplicate', lambda: SantOS.process_update({'update_id': 1})),
+        ('process_update_new', process_new_update),
+    ]
+
+    results = {}
+    for name, func in cases:
+        results[name] = measure(func, min_time=min_time)
+        # load_data заменяет словари комнат - выборку берем заново
+        if name == 'load_data':
+            sample_rooms = [SantOS.rooms[SantOS.user_rooms[u]] for u in sample_users]
+        print(f"  {name:<34} {results[name]['median_us']:>12.1f} мкс  (мин {results[name]['min_us']:.1f}, прогонов {results[name]['runs']})")
+    return results
+
+def compare(results, baseline, threshold):
+    """Сравнивает медианы с базой; возвращает список регрессий"""
+    regressions = []
+    for size, cases in results.items():
+        base_cases = baseline.get('results', {}).get(size, {})
+        for name, stats in cases.items():
+            base = base_cases.get(name)
+            if not base:
+                continue
+            ratio = stats['median_us'] / base['median_us'] if base['median_us'] else 1.0
+            if ratio > 1 + threshold:
+                regressions.append((size, name, base['median_us'], stats['median_us'], ratio))
+            elif ratio < 1 - threshold:
+                print(f"  🟢 {size}/{name}: {base['median_us']:.1f} -> {stats['median_us']:.1f} мкс (x{ratio:.2f})")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарки основных операций бота")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help="Число комнат")
+    parser.add_argument('--room-size', type=int, default=8, help="Участников в комнате")
+    parser.add_argument('--min-time', type=float, default=0.2, help="Минимальное время замера одной операции, с")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help="Сохранить результаты как новую базу")
+    parser.add_argument('--threshold', type=float, default=0.25, help="Допустимое замедление (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    # Бот пишет данные и логи в текущую папку - уводим их во временную
+    os.chdir(tempfile.mkdtemp(prefix='santa-bench-'))
+    os.environ.setdefault('BOT_TOKEN', '123456:BENCH')
+    import SantOS
+    logging.getLogger().setLevel(logging.WARNING)
+    stub_network(SantOS)
+
+    results = {}
+    for size in args.sizes:
+        print(f"\n📊 {size} комнат по {args.room_size} участников")
+        results[str(size)] = run_size(SantOS, size, args.room_size, args.min_time)
+
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'room_size': args.room_size,
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'results': results
+    }
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 База сохранена: {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"\nℹ️ Базы нет ({args.baseline}), запустите с --save")
+        return 0
+
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\n🔍 Сравнение с базой от {baseline.get('created')} (Python {baseline.get('python')})")
+    regressions = compare(results, baseline, args.threshold)
+    for size, name, before, after, ratio in regressions:
+        print(f"  🔺 {size}/{name}: {before:.1f} -> {after:.1f} мкс (x{ratio:.2f})")
+    if regressions:
+        print(f"❌ Замедлений больше {args.threshold:.0%}: {len(regressions)}")
+        return 1
+    print("✅ Замедлений нет")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
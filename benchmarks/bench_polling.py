@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+bench_polling.py - Сравнение задержки последовательного и конвейерного polling
+Работает против локального fake_telegram, сеть не нужна
+
+    python benchmarks/bench_polling.py --updates 500 --rate 200 --latency 0.05 --handler-ms 2
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from fake_telegram import FakeTelegramAPI
+from poller import UpdatePoller
+from update_queue import UpdateQueue
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def inject(api, count, rate):
+    """Подкладывает update с заданной скоростью (шт/сек)"""
+    for i in range(count):
+        api.push_update({'message': {'message_id': i, 'from': {'id': i % 50}, 'chat': {'id': i % 50}, 'text': 'x'}})
+        time.sleep(1 / rate)
+
+def run_sequential(api, count, handler_cost, latencies):
+    """Старая схема из bot_launcher: опрос и обработка строго по очереди"""
+    session = requests.Session()
+    offset = 0
+    while len(latencies) < count:
+        response = session.get(f"{api.base_url}/getUpdates",
+                               params={'offset': offset + 1, 'timeout': 50, 'limit': 100}, timeout=55)
+        updates = response.json()['result']
+        if not updates:
+            time.sleep(0.5)
+            continue
+        for update in updates:
+            offset = max(offset, update['update_id'])
+            latencies.append(time.perf_counter() - api.pushed_at[update['update_id']])
+            time.sleep(handler_cost)
+
+def run_pipelined(api, count, handler_cost, latencies):
+    updates_queue = UpdateQueue(maxsize=1000)
+    poller = UpdatePoller(api.base_url, updates_queue)
+    poller.start()
+    while len(latencies) < count:
+        update = updates_queue.get()
+        latencies.append(time.perf_counter() - api.pushed_at[update['update_id']])
+        time.sleep(handler_cost)
+    poller.stop()
+
+def bench(mode, args):
+    api = FakeTelegramAPI(latency=args.latency).start()
+    latencies = []
+    runner = run_sequential if mode == 'sequential' else run_pipelined
+    started = time.perf_counter()
+    injector = threading.Thread(target=inject, args=(api, args.updates, args.rate), daemon=True)
+    injector.start()
+    runner(api, args.updates, args.handler_ms / 1000, latencies)
+    elapsed = time.perf_counter() - started
+    api.stop()
+
+    print(f"{mode:>11}: {args.updates / elapsed:7.1f} upd/s | "
+          f"p50 {percentile(latencies, 50) * 1000:7.1f} ms | "
+          f"p95 {percentile(latencies, 95) * 1000:7.1f} ms | "
+          f"p99 {percentile(latencies, 99) * 1000:7.1f} ms | "
+          f"getUpdates: {api.calls.get('getUpdates', 0)}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарк задержки polling")
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=200, help="update в секунду")
+    parser.add_argument('--latency', type=float, default=0.05, help="задержка фейкового API, сек")
+    parser.add_argument('--handler-ms', type=float, default=2, help="стоимость обработки одного update, мс")
+    args = parser.parse_args()
+
+    for mode in ('sequential', 'pipelined'):
+        bench(mode, args)
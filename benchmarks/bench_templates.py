@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+bench_templates.py - Стоимость рендера одного сообщения: f-string с .replace против шаблонов
+
+    python benchmarks/bench_templates.py --number 100000
+"""
+
+import os
+import sys
+import timeit
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('BOT_TOKEN', '123456:BENCH')
+
+from templates import render
+import SantOS
+
+NAME = 'Иван <Дед Мороз> & Co'
+WISH = 'Книгу про <Python> & шоколад'
+
+def old_mention(user_id, full_name):
+    safe_name = full_name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    mention = f'<a href="tg://user?id={user_id}">{safe_name}</a>'
+    safe_display_name = full_name.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return f"{mention} ({safe_display_name})"
+
+def old_raffle_result():
+    target_mention = old_mention(42, NAME)
+    return (
+        f"🎉 Жеребьевка проведена!\n\n"
+        f"🎁 Вы дарите подарок: {target_mention}\n\n"
+        f"Пожелания:\n{WISH}\n\n"
+        f"Не дарить:\n{'Не указано'}\n\n"
+        f"💰 Бюджет: {1000} руб.\n"
+        f"Удачи в выборе подарка! 🎄"
+    )
+
+def new_mention(user_id, full_name):
+    mention = render('user_mention_link', user_id=user_id, full_name=full_name)
+    return render('user_mention_name', mention=mention, full_name=full_name)
+
+def new_raffle_result():
+    return render(
+        'raffle_result',
+        target_mention=new_mention(42, NAME),
+        wishlist=WISH,
+        anti_wishlist='Не указано',
+        budget=1000
+    )
+
+def make_room():
+    room = SantOS.Room('bench', 'Офис <2026>', 1, 1000, '25.12.2026')
+    room.participants[1] = SantOS.Participant(1, NAME)
+    return room
+
+def old_room_info(room):
+    admin = room.participants.get(room.admin_id)
+    admin_mention = old_mention(room.admin_id, admin.full_name)
+    return (
+        f"🏠 Информация о комнате:\n\n"
+        f"Название: {room.title}\n"
+        f"Роль: {'👑 Организатор'}\n"
+        f"💰 Бюджет: {room.budget} руб.\n"
+        f"📅 Дата: {room.gift_date}\n"
+        f"👥 Участников: {len(room.participants)}\n"
+        f"🎲 Жеребьевка: {'✅ Проведена' if room.raffle_done else '❌ Не проведена'}\n"
+        f"🔑 Код для друзей: {room.join_code}\n\n"
+        f"Организатор:\n{admin_mention}"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Микробенчмарк рендера сообщений")
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    room = make_room()
+    cases = [
+        ('mention (f-string)', lambda: old_mention(42, NAME)),
+        ('mention (template)', lambda: new_mention(42, NAME)),
+        ('raffle_result (f-string)', old_raffle_result),
+        ('raffle_result (template)', new_raffle_result),
+        ('room_info (f-string)', lambda: old_room_info(room)),
+        ('room_info (cached)', lambda: SantOS.render_room_text(room, 'room_info', role='👑 Организатор')),
+    ]
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=args.number, repeat=3))
+        print(f"{name:>26}: {best / args.number * 1e6:6.2f} мкс/сообщение")
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+"""
+load_test.py - Нагрузочный тест настоящего кода бота против локального fake_telegram
+Симулирует N пользователей: организаторы создают комнаты, участники вступают по коду,
+заполняют и правят профиль, организатор проводит жеребьевку. Сеть не нужна
+
+    python benchmarks/load_test.py --users 200 --room-size 10 --latency 0.03 --rate-limit 0.01 --workers 8
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_telegram import FakeTelegramAPI
+
+JOIN_CODE_RE = re.compile(r'<code>([0-9A-F]{6})</code>')
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+class ProcessedUpdates:
+    """Отмечает, когда бот закончил обработку update (все ответы к этому моменту уже отправлены)"""
+
+    def __init__(self):
+        self.done = {}
+        self.cond = threading.Condition()
+
+    def mark(self, update_id):
+        with self.cond:
+            self.done[update_id] = time.perf_counter()
+            self.cond.notify_all()
+
+    def wrap(self, process_func):
+        def process(update):
+            try:
+                process_func(update)
+            finally:
+                self.mark(update['update_id'])
+        return process
+
+    def wait(self, update_id, timeout=60):
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while update_id not in self.done:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+            return self.done.pop(update_id)
+
+class SimulatedUser:
+    """Пользователь Telegram: отправляет update и ждет, пока бот его обработает.
+    Задержка - от постановки update в фейковый API до конца обработки"""
+
+    def __init__(self, api, processed, user_id, results, think_time=0.0):
+        self.api = api
+        self.processed = processed
+        self.user_id = user_id
+        self.results = results
+        self.think_time = think_time
+        self.callback_seq = 0
+
+    def _wait(self, action, update_id, since):
+        finished = self.processed.wait(update_id)
+        if finished is None:
+            self.results.record(action, None)
+            raise TimeoutError(f"{self.user_id}: бот не обработал {action}")
+        self.results.record(action, finished - self.api.pushed_at[update_id])
+        if self.think_time:
+            time.sleep(random.uniform(0, self.think_time))
+        with self.api.cond:
+            replies = self.api.replies.get(self.user_id, [])[since:]
+        return '\n'.join(params.get('text', '') for _, method, params in replies if method != 'answerCallbackQuery')
+
+    def text(self, action, text):
+        since = self.api.reply_count(self.user_id)
+        update_id = self.api.push_update({'message': {
+            'message_id': random.randint(1, 10 ** 9), 'date': int(time.time()),
+            'from': {'id': self.user_id, 'first_name': f'User{self.user_id}', 'username': f'user{self.user_id}'},
+            'chat': {'id': self.user_id, 'type': 'private'}, 'text': text
+        }})
+        return self._wait(action, update_id, since)
+
+    def press(self, action, data):
+        self.callback_seq += 1
+        since = self.api.reply_count(self.user_id)
+        update_id = self.api.push_update({'callback_query': {
+            'id': f'{self.user_id}-{self.callback_seq}',
+            'from': {'id': self.user_id, 'first_name': f'User{self.user_id}', 'username': f'user{self.user_id}'},
+            # Фейковый API редактирует любое сообщение, поэтому message_id условный
+            'message': {'message_id': self.callback_seq, 'chat': {'id': self.user_id, 'type': 'private'}},
+            'data': data
+        }})
+        return self._wait(action, update_id, since)
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.timeouts = 0
+        self.errors = []
+
+    def record(self, action, latency):
+        with self.lock:
+            if latency is None:
+                self.timeouts += 1
+            else:
+                self.latencies.setdefault(action, []).append(latency)
+
+class SimulatedRoom:
+    def __init__(self, size):
+        self.size = size
+        self.join_code = None
+        self.code_ready = threading.Event()
+        self.joined = threading.Semaphore(0)
+        self.raffle_done = threading.Event()
+
+    def abort(self):
+        """Сценарий организатора сорвался - отпускаем участников"""
+        self.code_ready.set()
+        self.raffle_done.set()
+
+def organizer_flow(user, room, gift_date):
+    user.text('start', '/start')
+    user.text('create_room', '🎯 Создать комнату')
+    user.text('room_title', f'Комната {user.user_id}')
+    user.press('budget', 'budget_1000')
+    user.text('gift_date', gift_date)
+    user.press('create_confirm', 'create_confirm')
+    user.text('profile_name', f'Организатор {user.user_id}')
+    user.text('profile_wish', 'Книгу')
+    user.text('profile_anti_wish', 'Носки')
+    user.press('profile_confirm', 'profile_confirm')
+
+    invite = user.text('invite', '📨 Пригласить')
+    match = JOIN_CODE_RE.search(invite)
+    if not match:
+        raise RuntimeError(f"{user.user_id}: в приглашении нет кода")
+    room.join_code = match.group(1)
+    room.code_ready.set()
+
+    for _ in range(room.size - 1):
+        # Кто-то из участников мог сорваться - не ждем вечно
+        room.joined.acquire(timeout=60)
+    user.text('participants', '👥 Участники')
+    user.text('raffle', '🎲 Жеребьевка')
+    room.raffle_done.set()
+
+def participant_flow(user, room):
+    user.text('start', '/start')
+    user.text('join', '🔍 Присоединиться')
+    room.code_ready.wait()
+    if room.join_code is None:
+        raise RuntimeError(f"{user.user_id}: комната не создана")
+    user.text('join_code', room.join_code)
+    user.press('join_yes', 'join_yes')
+    user.text('profile_name', f'Участник {user.user_id}')
+    user.text('profile_wish', 'Шоколад')
+    user.text('profile_anti_wish', 'Ничего')
+    user.press('profile_edit', 'profile_edit')
+    user.press('edit_wish', 'edit_wish')
+    user.text('profile_edit_text', 'Настольную игру')
+    user.press('profile_confirm', 'profile_confirm')
+    room.joined.release()
+
+    room.raffle_done.wait()
+    user.text('recipient', '🎁 Мой получатель')
+
+def run_user(flow, results, user, room, *args):
+    try:
+        flow(user, room, *args)
+    except Exception as e:
+        with results.lock:
+            results.errors.append(str(e))
+        if flow is organizer_flow:
+            room.abort()
+        else:
+            room.joined.release()
+
+def start_bot(api, workers, processed):
+    """Поднимает настоящий конвейер бота (poller + очередь) против фейкового API"""
+    import SantOS
+    from poller import UpdatePoller
+    from update_queue import UpdateQueue, UpdateWorkers
+
+    if not SantOS.runtime.start():
+        raise RuntimeError("бот не принял токен фейкового API")
+    updates_queue = UpdateQueue(maxsize=10000, collapsible_texts=SantOS.MENU_BUTTONS,
+                                on_discard=SantOS.answer_discarded_update)
+    poller = UpdatePoller(SantOS.BASE_URL, updates_queue)
+    poller.start()
+
+    process = processed.wrap(SantOS.process_update)
+    if workers <= 1:
+        # Как run_bot: один поток разбирает очередь
+        target = lambda: [process(updates_queue.get()) for _ in iter(int, 1)]
+    else:
+        # Как webhook: update раскладываются по очередям воркеров по user_id
+        update_workers = UpdateWorkers(process, workers, maxsize=10000, on_discard=SantOS.answer_discarded_update)
+        update_workers.start()
+        target = lambda: [update_workers.submit(updates_queue.get(), block=True) for _ in iter(int, 1)]
+    threading.Thread(target=target, name='load-consumer', daemon=True).start()
+    return SantOS, poller
+
+def start_cluster(shards, workers, processed, log_level):
+    """Как SHARDS=N в bot_launcher: poller в этом процессе, обработка в N процессах-шардах"""
+    import SantOS
+    from poller import UpdatePoller
+    from sharding import Cluster
+
+    SantOS.configure()
+    # О конце обработки шарды сообщают координатору, а он отмечает update как обработанный
+    cluster = Cluster(shards, workers=max(1, workers), on_processed=processed.mark, log_level=log_level)
+    if not cluster.start():
+        cluster.stop()
+        raise RuntimeError("шарды не запустились")
+    poller = UpdatePoller(SantOS.BASE_URL, cluster)
+    poller.start()
+    return cluster, poller
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота")
+    parser.add_argument('--users', type=int, default=100, help="Всего пользователей")
+    parser.add_argument('--room-size', type=int, default=10, help="Участников в комнате, включая организатора")
+    parser.add_argument('--workers', type=int, default=1, help="1 - как polling, больше - как webhook с воркерами")
+    parser.add_argument('--shards', type=int, default=1, help="Больше 1 - процессы-шарды (sharding.py), --workers потоков в каждом")
+    parser.add_argument('--latency', type=float, default=0.02, help="Задержка ответа фейкового API, с")
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument('--think-time', type=float, default=0.0, help="Пауза пользователя между шагами, с")
+    parser.add_argument('--verbose', action='store_true', help="Не глушить логи бота")
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI(latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit).start()
+
+    # Бот пишет данные и логи в текущую папку - уводим их во временную
+    workdir = tempfile.mkdtemp(prefix='santa-load-')
+    os.chdir(workdir)
+    os.environ['BOT_TOKEN'] = api.token
+    os.environ['TELEGRAM_API_URL'] = api.api_url
+    # Симулированные пользователи жмут быстрее людей, антифлуд им не нужен
+    os.environ.setdefault('FLOOD_RATE', '1000')
+    os.environ.setdefault('FLOOD_BURST', '1000')
+
+    processed = ProcessedUpdates()
+    cluster = None
+    if args.shards > 1:
+        cluster, poller = start_cluster(args.shards, args.workers, processed,
+                                        logging.INFO if args.verbose else logging.WARNING)
+    else:
+        SantOS, poller = start_bot(api, args.workers, processed)
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    results = Results()
+    gift_date = (date.today() + timedelta(days=365)).strftime('%d.%m.%Y')
+    room_count = max(1, args.users // args.room_size)
+    threads = []
+    next_user_id = 1000
+    for _ in range(room_count):
+        room = SimulatedRoom(args.room_size)
+        organizer = SimulatedUser(api, processed, next_user_id, results, args.think_time)
+        threads.append(threading.Thread(target=run_user, args=(organizer_flow, results, organizer, room, gift_date)))
+        next_user_id += 1
+        for _ in range(args.room_size - 1):
+            user = SimulatedUser(api, processed, next_user_id, results, args.think_time)
+            threads.append(threading.Thread(target=run_user, args=(participant_flow, results, user, room)))
+            next_user_id += 1
+
+    print(f"🧪 {len(threads)} пользователей, {room_count} комнат, воркеров {args.workers}, шардов {args.shards}, "
+          f"задержка API {args.latency * 1000:.0f}±{args.jitter * 1000:.0f} мс, 429: {args.rate_limit:.1%}")
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    poller.stop()
+    if not cluster:
+        # Рассылки жеребьевки и ответы на callback идут в фоне - дожидаемся их до остановки API.
+        # Шарды делают это сами при cluster.stop()
+        SantOS.broadcaster.join(timeout=30)
+        SantOS.runtime.executor.shutdown(wait=True)
+
+    all_latencies = [v for values in results.latencies.values() for v in values]
+    print(f"\n⏱ {len(all_latencies)} update за {elapsed:.1f} с: {len(all_latencies) / elapsed:.1f} update/с")
+    print(f"{'действие':<20} {'кол-во':>7} {'p50 мс':>8} {'p90 мс':>8} {'p99 мс':>8} {'макс мс':>8}")
+    for action, values in sorted(results.latencies.items(), key=lambda item: -percentile(item[1], 99)):
+        print(f"{action:<20} {len(values):>7} {percentile(values, 50) * 1000:>8.1f} {percentile(values, 90) * 1000:>8.1f} "
+              f"{percentile(values, 99) * 1000:>8.1f} {max(values) * 1000:>8.1f}")
+    print(f"{'ВСЕГО':<20} {len(all_latencies):>7} {percentile(all_latencies, 50) * 1000:>8.1f} "
+          f"{percentile(all_latencies, 90) * 1000:>8.1f} {percentile(all_latencies, 99) * 1000:>8.1f} "
+          f"{max(all_latencies, default=0) * 1000:>8.1f}")
+
+    print(f"\n📡 Вызовы API: {dict(sorted(api.calls.items()))}, ответов 429: {api.rate_limited}")
+    if cluster:
+        shards = cluster.summary()
+        stats = cluster.stats()
+        for shard, summary in sorted(shards.items()):
+            print(f"🔀 Шард {shard}: комнат {summary['rooms']}, участников {summary['participants']}, "
+                  f"жеребьевок {summary['raffled']}, update {stats['routed'].get(shard, 0)}, "
+                  f"переходов сюда {stats['transfers'].get(shard, 0)}")
+        room_total = sum(summary['rooms'] for summary in shards.values())
+        raffled = sum(summary['raffled'] for summary in shards.values())
+        cluster.stop()
+    else:
+        room_total = len(SantOS.rooms)
+        raffled = sum(1 for room in SantOS.rooms.values() if room.raffle_done)
+    print(f"🏠 Комнат в боте: {room_total}, жеребьевка проведена: {raffled}")
+    if results.timeouts or results.errors:
+        print(f"⚠️ Таймаутов: {results.timeouts}, ошибок сценария: {len(results.errors)}")
+        for error in results.errors[:5]:
+            print(f"   {error}")
+    api.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+replay.py - Воспроизведение записанного потока update (RECORD_UPDATES) через настоящие обработчики
+Бот стартует с пустым состоянием во временной папке, Telegram API заглушен. Ссылки на комнаты
+из записи (<room:...>, <code:...>) подменяются на комнаты, созданные при воспроизведении
+
+    python benchmarks/replay.py updates.jsonl.gz                     # в реальном темпе
+    python benchmarks/replay.py updates.jsonl.gz --speed 10          # в 10 раз быстрее
+    python benchmarks/replay.py updates.jsonl.gz --speed 0 --save-state before.json
+    python benchmarks/replay.py updates.jsonl.gz --speed 0 --compare-state before.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import itertools
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from update_recorder import read_recording
+from load_test import percentile
+
+TOKEN_RE = re.compile(r'<(room|code):([^>]+)>')
+
+def stub_api(SantOS, latency):
+    """Заглушка Telegram API: считает вызовы по методам, отвечает успехом через latency секунд"""
+    calls = Counter()
+    lock = threading.Lock()
+    message_ids = itertools.count(1)
+
+    def call(method, payload, timeout, attempts=None):
+        with lock:
+            calls[method] += 1
+        if latency:
+            time.sleep(latency)
+        return SantOS.API_OK, {'message_id': next(message_ids)}
+
+    SantOS.telegram_api_call = call
+    SantOS.refresh_bot_identity = lambda: True
+    SantOS.bot_identity.update({'id': 1, 'username': 'replay_bot'})
+    return calls
+
+class RoomMap:
+    """Соответствие room_id из записи комнатам, созданным при воспроизведении.
+
+    Комнату создает update с rooms_created; пока он не обработан, ссылки на нее
+    из других update ждут (при --speed 0 участник может обогнать организатора)
+    """
+
+    def __init__(self, SantOS, wait_timeout=10.0):
+        self.SantOS = SantOS
+        self.wait_timeout = wait_timeout
+        self.mapping = {}
+        self.pending = set()
+        self.cond = threading.Condition()
+        self.unresolved = Counter()
+
+    def expect(self, recorded_ids):
+        with self.cond:
+            self.pending.update(recorded_ids)
+
+    def created(self, recorded_ids, admin_id):
+        """Вызывается после обработки update, создавшего комнаты"""
+        with self.cond:
+            mapped = set(self.mapping.values())
+            fresh = sorted((room for room in list(self.SantOS.rooms.values())
+                            if room.admin_id == admin_id and room.room_id not in mapped),
+                           key=lambda room: room.room_id)
+            for recorded_id in recorded_ids:
+                self.pending.discard(recorded_id)
+                if fresh:
+                    self.mapping[recorded_id] = fresh.pop(0).room_id
+            self.cond.notify_all()
+
+    def resolve(self, recorded_id):
+        with self.cond:
+            deadline = time.monotonic() + self.wait_timeout
+            while recorded_id in self.pending and recorded_id not in self.mapping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.mapping.get(recorded_id)
+
+    def substitute(self, value):
+        """Подменяет ссылки во всех строках update"""
+        if isinstance(value, dict):
+            return {k: self.substitute(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [self.substitute(v) for v in value]
+        if isinstance(value, str) and '<' in value:
+            return TOKEN_RE.sub(self._replace, value)
+        return value
+
+    def _replace(self, match):
+        kind, recorded_id = match.groups()
+        room_id = self.resolve(recorded_id)
+        room = self.SantOS.rooms.get(room_id) if room_id else None
+        if room is None:
+            # Комната создана до начала записи - ссылку оставляем как есть, бот ответит ошибкой
+            self.unresolved[kind] += 1
+            return match.group(0)
+        return room.join_code if kind == 'code' else room.room_id
+
+class Replay:
+    def __init__(self, SantOS, room_map):
+        self.SantOS = SantOS
+        self.room_map = room_map
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.done = threading.Semaphore(0)
+
+    def process(self, item):
+        scheduled, entry = item['scheduled'], item['entry']
+        try:
+            update = self.room_map.substitute(entry['update'])
+            handler = self.SantOS.update_handler_label(update)
+            self.SantOS.process_update(update)
+            if entry.get('rooms_created'):
+                sender = (update.get('message') or update.get('callback_query') or {}).get('from', {})
+                self.room_map.created(entry['rooms_created'], sender.get('id'))
+            with self.lock:
+                self.latencies.setdefault(handler, []).append(time.perf_counter() - scheduled)
+        finally:
+            self.done.release()
+
+def state_summary(SantOS, room_map):
+    """Нормализованное состояние: комнаты под room_id из записи, без случайных кодов и пар"""
+    reverse = {room_id: recorded_id for recorded_id, room_id in room_map.mapping.items()}
+    summary = {}
+    for room in list(SantOS.rooms.values()):
+        key = reverse.get(room.room_id, f"new:{room.admin_id}:{room.title}")
+        summary[key] = {
+            'admin_id': room.admin_id,
+            'budget': room.budget,
+            'gift_date': room.gift_date,
+            'active': room.is_active,
+            'raffle_done': room.raffle_done,
+            'participants': sorted(room.participants),
+            'profiles_filled': sum(1 for p in room.participants.values() if p.wishlist),
+            'targets_assigned': sum(1 for p in room.participants.values() if p.target_id)
+        }
+    return summary
+
+def print_state(title, SantOS):
+    participants = sum(len(room.participants) for room in SantOS.rooms.values())
+    raffled = sum(1 for room in SantOS.rooms.values() if room.raffle_done)
+    print(f"{title}: комнат {len(SantOS.rooms)}, участников {participants}, "
+          f"жеребьевок {raffled}, пользователей с состоянием {len(SantOS.user_states)}")
+
+def diff_state(before, after):
+    """Список расхождений между двумя нормализованными состояниями"""
+    lines = []
+    for key in sorted(set(before) | set(after)):
+        if key not in after:
+            lines.append(f"  - {key}: комнаты нет")
+        elif key not in before:
+            lines.append(f"  + {key}: новая комната")
+        else:
+            for field in sorted(set(before[key]) | set(after[key])):
+                if before[key].get(field) != after[key].get(field):
+                    lines.append(f"  ~ {key}.{field}: {before[key].get(field)} -> {after[key].get(field)}")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанного потока update")
+    parser.add_argument('recording', help="Файл записи (RECORD_UPDATES)")
+    parser.add_argument('--speed', type=float, default=1.0, help="Ускорение: 1 - реальный темп, 10 - в 10 раз быстрее, 0 - без пауз")
+    parser.add_argument('--workers', type=int, default=8, help="Воркеров UpdateWorkers")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="Задержка заглушки API, с")
+    parser.add_argument('--limit', type=int, default=0, help="Воспроизвести только первые N update")
+    parser.add_argument('--seed', type=int, default=1, help="Зерно random (коды комнат, жеребьевка)")
+    parser.add_argument('--save-state', help="Записать итоговое состояние в JSON")
+    parser.add_argument('--compare-state', help="Сравнить итоговое состояние с сохраненным")
+    parser.add_argument('--verbose', action='store_true', help="Не глушить логи бота")
+    args = parser.parse_args()
+
+    # Строка пишется после обработки, а t - момент ее начала: восстанавливаем порядок поступления
+    entries = sorted(read_recording(args.recording), key=lambda entry: entry['t'])
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        print(f"❌ В {args.recording} нет записей")
+        return 1
+
+    # Бот пишет данные и логи в текущую папку - уводим их во временную
+    recording = os.path.abspath(args.recording)
+    save_state = os.path.abspath(args.save_state) if args.save_state else None
+    compare_state = os.path.abspath(args.compare_state) if args.compare_state else None
+    os.chdir(tempfile.mkdtemp(prefix='santa-replay-'))
+    os.environ.pop('RECORD_UPDATES', None)
+    os.environ.setdefault('BOT_TOKEN', '123456:REPLAY')
+    if args.speed != 1:
+        # В ускоренном темпе антифлуд резал бы то, что в записи прошло
+        os.environ.setdefault('FLOOD_RATE', '1000')
+        os.environ.setdefault('FLOOD_BURST', '1000')
+    random.seed(args.seed)
+
+    import SantOS
+    from update_queue import UpdateWorkers
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    calls = stub_api(SantOS, args.api_latency)
+
+    print(f"📼 {recording}: {len(entries)} update за {entries[-1]['t'] - entries[0]['t']:.1f} с записи, "
+          f"скорость {'макс.' if args.speed <= 0 else f'x{args.speed:g}'}, воркеров {args.workers}")
+    print_state("До", SantOS)
+
+    room_map = RoomMap(SantOS)
+    replay = Replay(SantOS, room_map)
+    workers = UpdateWorkers(replay.process, args.workers, maxsize=max(1000, len(entries)),
+                            on_discard=SantOS.answer_discarded_update)
+    workers.start()
+
+    first_t = entries[0]['t']
+    collapsed = 0
+    started = time.perf_counter()
+    for entry in entries:
+        if args.speed > 0:
+            delay = started + (entry['t'] - first_t) / args.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if entry.get('rooms_created'):
+            room_map.expect(entry['rooms_created'])
+        # UpdateWorkers раскладывает по user_id, обертка ему не мешает
+        item = {'scheduled': time.perf_counter(), 'entry': entry}
+        item.update(entry['update'])
+        if workers.submit(item, block=True) is False:
+            # Повторное нажатие той же кнопки схлопнуто очередью, как было бы в боте
+            collapsed += 1
+            replay.done.release()
+    for _ in entries:
+        replay.done.acquire()
+    elapsed = time.perf_counter() - started
+
+    all_latencies = [v for values in replay.latencies.values() for v in values]
+    print(f"\n⏱ {len(all_latencies)} update за {elapsed:.2f} с: {len(all_latencies) / elapsed:.1f} update/с")
+    print(f"{'обработчик':<32} {'кол-во':>7} {'p50 мс':>8} {'p90 мс':>8} {'p99 мс':>8} {'макс мс':>8}")
+    for handler, values in sorted(replay.latencies.items(), key=lambda item: -percentile(item[1], 99)):
+        print(f"{handler[:32]:<32} {len(values):>7} {percentile(values, 50) * 1000:>8.2f} {percentile(values, 90) * 1000:>8.2f} "
+              f"{percentile(values, 99) * 1000:>8.2f} {max(values) * 1000:>8.2f}")
+    print(f"{'ВСЕГО':<32} {len(all_latencies):>7} {percentile(all_latencies, 50) * 1000:>8.2f} "
+          f"{percentile(all_latencies, 90) * 1000:>8.2f} {percentile(all_latencies, 99) * 1000:>8.2f} "
+          f"{max(all_latencies, default=0) * 1000:>8.2f}")
+    print(f"\n📡 Вызовы API: {dict(sorted(calls.items()))}, схлопнуто в очереди: {collapsed}")
+    if room_map.unresolved:
+        print(f"⚠️ Неразрешенных ссылок на комнаты (созданы до записи): {dict(room_map.unresolved)}")
+    print_state("После", SantOS)
+
+    summary = state_summary(SantOS, room_map)
+    if save_state:
+        with open(save_state, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"💾 Состояние сохранено: {save_state}")
+    if compare_state:
+        with open(compare_state, 'r', encoding='utf-8') as f:
+            expected = json.load(f)
+        differences = diff_state(expected, json.loads(json.dumps(summary)))
+        if differences:
+            print(f"❌ Состояние отличается ({len(differences)}):")
+            for line in differences[:50]:
+                print(line)
+            return 1
+        print("✅ Состояние совпадает с сохраненным")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
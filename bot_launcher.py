@@ -12,17 +12,30 @@ import logging
 import threading
 from datetime import datetime
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - BOT - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler(sys.stdout)]
-)
+import metrics
+from log_pipeline import setup_logging, logging_stats
+
 logger = logging.getLogger(__name__)
 
 # Глобальная переменная для остановки
 stop_requested = False
 
+# Источник статистики очереди входящих update (задается режимом запуска)
+queue_stats = None
+# Состояние предохранителя Telegram API
+api_stats = None
+
+metrics.gauge('santa_update_queue_depth', 'update в очереди на обработку', lambda: queue_stats()['depth'] if queue_stats else 0)
+metrics.gauge('santa_update_queue_dropped', 'update, не принятые из-за переполнения очереди', lambda: queue_stats()['dropped'] if queue_stats else 0)
+metrics.gauge('santa_update_queue_collapsed', 'Схлопнутые повторные нажатия', lambda: queue_stats()['collapsed'] if queue_stats else 0)
+metrics.gauge('santa_log_queue_depth', 'Записи лога, ожидающие записи на диск', lambda: logging_stats()['queued'])
+metrics.gauge('santa_log_dropped', 'Записи лога, отброшенные из-за переполнения очереди', lambda: logging_stats()['dropped_full'])
+metrics.gauge('santa_log_sampled_out', 'Записи лога, отброшенные выборкой', lambda: logging_stats()['dropped_sampled'])
+metrics_server = None
+# Приложение webhook создается один раз: перезапуски из main() используют его же,
+# а не плодят новые пулы воркеров
+webhook_app = None
+
 def signal_handler(sig, frame):
     """Обработчик сигналов остановки"""
     global stop_requested
@@ -30,14 +43,25 @@ def signal_handler(sig, frame):
     stop_requested = True
     sys.exit(0)
 
-# Регистрируем обработчики сигналов
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
 def heartbeat():
     """Периодический heartbeat для мониторинга"""
     while not stop_requested:
-        logger.info("💓 Бот активен")
+        if queue_stats:
+            stats = queue_stats()
+            logger.info(
+                f"💓 Бот активен | очередь {stats['depth']}/{stats['capacity']} (макс {stats['max_depth']}), "
+                f"ожидание ср {stats['avg_wait_ms']} мс / макс {stats['max_wait_ms']} мс, "
+                f"схлопнуто {stats['collapsed']}, отброшено {stats['dropped']}"
+            )
+        else:
+            logger.info("💓 Бот активен")
+        if api_stats:
+            stats = api_stats()
+            if stats['state'] != 'closed' or stats['rejected']:
+                logger.warning(
+                    f"🔌 Telegram API: {stats['state']}, открывался {stats['times_opened']} раз, "
+                    f"отклонено запросов {stats['rejected']}, отложено сообщений {stats['deferred']}"
+                )
         time.sleep(60)  # Логируем каждую минуту
 
 def save_data_periodically(save_func, interval=300):
@@ -50,8 +74,9 @@ def save_data_periodically(save_func, interval=300):
         except Exception as e:
             logger.error(f"❌ Ошибка автосохранения: {e}")
 
-def run_bot():
-    """Запускает бота в бесконечном цикле"""
+def prepare_bot():
+    """Загружает модуль бота, проверяет токен и поднимает фоновые потоки.
+    Возвращает модуль SantOS или None при ошибке"""
     
     logger.info("=" * 60)
     logger.info("🎅 ЗАПУСК БОТА ТАЙНОГО САНТЫ")
@@ -64,35 +89,44 @@ def run_bot():
         logger.info("✅ Модуль SantOS загружен")
     except ImportError as e:
         logger.error(f"❌ Не удалось импортировать SantOS: {e}")
-        return False
-    
-    # Проверяем токен
-    if not os.environ.get('BOT_TOKEN'):
-        logger.error("❌ BOT_TOKEN не установлен!")
-        return False
+        return None
     
-    # Проверяем токен через функцию бота
+    # Токен проверяется по сети одновременно с чтением данных с диска
     try:
-        if not SantOS.check_bot_token():
-            logger.error("❌ Неверный токен бота!")
-            return False
-        logger.info("✅ Токен бота проверен")
+        if not SantOS.runtime.start():
+            logger.error("❌ Бот не запущен: токена нет или он неверный")
+            return None
+        logger.info(f"✅ Токен бота проверен, данные загружены: {len(SantOS.rooms)} комнат")
     except Exception as e:
-        logger.error(f"❌ Ошибка проверки токена: {e}")
-        return False
+        logger.error(f"❌ Ошибка запуска: {e}")
+        return None
     
-    # Загружаем данные
-    try:
-        SantOS.load_data()
-        logger.info(f"✅ Данные загружены: {len(SantOS.rooms)} комнат")
-    except Exception as e:
-        logger.error(f"❌ Ошибка загрузки данных: {e}")
-        # Не прерываем работу, продолжаем с пустыми данными
+    global api_stats
+    api_stats = SantOS.api_health
+    
+    # При PROFILING=1 отчет о горячем пути можно снять сигналом SIGUSR1
+    if SantOS.profiler and SantOS.profiler.install_signal():
+        logger.info(f"🔬 Отчет профилирования: kill -USR1 {os.getpid()}")
+    
+    # Запускаем планировщик напоминаний и закрытия комнат
+    SantOS.date_scheduler.start()
+    
+    # Данные о боте (getMe) получены при проверке токена, дальше обновляем в фоне
+    SantOS.start_identity_refresher()
     
     # Запускаем heartbeat в отдельном потоке
     heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
     heartbeat_thread.start()
     
+    # В режиме polling метрики отдаются отдельным HTTP-сервером (в webhook - через /metrics приложения)
+    global metrics_server
+    metrics_port = os.environ.get('METRICS_PORT')
+    if metrics_port and not os.environ.get('WEBHOOK_URL') and metrics_server is None:
+        try:
+            metrics_server = metrics.start_http_server(int(metrics_port))
+        except OSError as e:
+            logger.error(f"❌ Не удалось поднять сервер метрик: {e}")
+    
     # Запускаем автосохранение
     save_thread = threading.Thread(
         target=save_data_periodically, 
@@ -101,71 +135,99 @@ def run_bot():
     )
     save_thread.start()
     
-    # Основной цикл polling
-    offset = 0
-    import requests
+    return SantOS
+
+def run_webhook():
+    """Запускает бота в режиме webhook (WEBHOOK_URL задан в окружении)"""
+    SantOS = prepare_bot()
+    if not SantOS:
+        return False
+    
+    import webhook_server
+    from poller import save_pending, load_pending
+    
+    secret = os.environ.get('WEBHOOK_SECRET') or webhook_server.derive_secret(SantOS.BOT_TOKEN)
+    webhook_url = os.environ['WEBHOOK_URL'].rstrip('/') + webhook_server.WEBHOOK_PATH
+    workers = int(os.environ.get('WEBHOOK_WORKERS', 8))
+    port = int(os.environ.get('PORT', 8080))
+    
+    global webhook_app, queue_stats
+    if webhook_app is None:
+        webhook_app = webhook_server.create_app(
+            SantOS.process_update, secret, workers=workers,
+            maxsize=int(os.environ.get('UPDATE_QUEUE_SIZE', 1000)),
+            collapsible_texts=SantOS.MENU_BUTTONS,
+            on_discard=SantOS.answer_discarded_update
+        )
+    update_workers = webhook_app.config['UPDATE_WORKERS']
+    update_workers.start()
+    queue_stats = update_workers.stats
+    
+    try:
+        # Сначала то, что не успели обработать перед прошлой остановкой
+        for update in load_pending():
+            update_workers.submit(update, block=True)
+        
+        if not webhook_server.set_webhook(SantOS.BASE_URL, webhook_url, secret):
+            return False
+        
+        logger.info(f"⏳ Бот запущен в режиме webhook на порту {port}...")
+        webhook_server.serve(webhook_app, port, threads=int(os.environ.get('WEBHOOK_HTTP_THREADS', 8)))
+        return True
+    
+    finally:
+        # На 200 Telegram больше не повторит эти update - сохраняем их до следующего запуска
+        save_pending(update_workers.stop())
+
+def run_bot():
+    """Запускает бота в бесконечном цикле"""
+    SantOS = prepare_bot()
+    if not SantOS:
+        return False
+    
+    # Если раньше был установлен webhook, getUpdates вернет 409
+    import webhook_server
+    webhook_server.delete_webhook(SantOS.BASE_URL)
+    
+    # Конвейерный polling: поток опроса наполняет очередь, основной поток ее разбирает
+    from poller import UpdatePoller, save_pending, load_pending
+    from update_queue import UpdateQueue
+    
+    updates_queue = UpdateQueue(
+        maxsize=int(os.environ.get('UPDATE_QUEUE_SIZE', 1000)),
+        collapsible_texts=SantOS.MENU_BUTTONS,
+        on_discard=SantOS.answer_discarded_update
+    )
+    # Сначала то, что не успели обработать перед прошлой остановкой
+    pending = load_pending()
+    for update in pending:
+        if len(updates_queue) >= updates_queue.maxsize:
+            SantOS.process_update(update)
+        else:
+            updates_queue.put(update)
+    global queue_stats
+    queue_stats = updates_queue.stats
+    poller = UpdatePoller(SantOS.BASE_URL, updates_queue)
+    poller.start()
     
     logger.info("⏳ Бот запущен, ожидание сообщений...")
     
     try:
         while not stop_requested:
-            try:
-                # Получаем обновления с увеличенным timeout
-                response = requests.get(
-                    f"{SantOS.BASE_URL}/getUpdates",
-                    params={
-                        'offset': offset + 1,
-                        'timeout': 50,  # Увеличенный timeout
-                        'limit': 100
-                    },
-                    timeout=55  # Чуть больше чем timeout в параметрах
-                )
-                
-                if response.status_code != 200:
-                    logger.error(f"❌ HTTP ошибка: {response.status_code}")
-                    time.sleep(5)
-                    continue
-                
-                data = response.json()
-                
-                if not data.get('ok'):
-                    logger.error(f"❌ Telegram API error: {data}")
-                    time.sleep(5)
-                    continue
-                
-                updates = data.get('result', [])
-                
-                if updates:
-                    logger.info(f"📨 Получено {len(updates)} сообщений")
-                    
-                    # Обрабатываем каждое обновление
-                    for update in updates:
-                        current_offset = update['update_id']
-                        if current_offset > offset:
-                            offset = current_offset
-                        
-                        # Обрабатываем в основном потоке для простоты
-                        try:
-                            SantOS.process_update(update)
-                        except Exception as e:
-                            logger.error(f"❌ Ошибка обработки update: {e}")
-                            # Продолжаем обработку остальных сообщений
-                
-                # Короткая пауза если нет сообщений
-                elif not updates and not stop_requested:
-                    time.sleep(0.5)
-                    
-            except requests.exceptions.Timeout:
-                # Таймаут - нормальная ситуация при long polling
+            if not poller.is_alive():
+                logger.error("❌ Поток polling остановился")
+                return False
+            
+            update = updates_queue.get(timeout=1)
+            if update is None:
                 continue
-                
-            except requests.exceptions.ConnectionError:
-                logger.error("🔌 Ошибка соединения, переподключение...")
-                time.sleep(5)
-                
+            
+            # Обрабатываем в основном потоке для простоты
+            try:
+                SantOS.process_update(update)
             except Exception as e:
-                logger.error(f"❌ Ошибка в цикле polling: {e}")
-                time.sleep(5)
+                logger.error(f"❌ Ошибка обработки update: {e}")
+                # Продолжаем обработку остальных сообщений
         
         logger.info("👋 Основной цикл завершен")
         return True
@@ -175,6 +237,62 @@ def run_bot():
         import traceback
         traceback.print_exc()
         return False
+    
+    finally:
+        poller.stop()
+        poller.join(timeout=5)
+        save_pending(poller.unqueued + updates_queue.drain())
+
+def run_sharded(shards):
+    """Запускает бота в несколько процессов (SHARDS > 1): этот процесс опрашивает
+    getUpdates и раздает update шардам, каждый шард - отдельный процесс со своими данными"""
+    import SantOS
+    from sharding import Cluster
+    
+    if not SantOS.configure():
+        SantOS.print_token_help()
+        logger.error("❌ BOT_TOKEN не установлен!")
+        return False
+    
+    cluster = Cluster(
+        shards,
+        data_dir=os.environ.get('SHARD_DATA_DIR', '.'),
+        workers=int(os.environ.get('SHARD_WORKERS', 4))
+    )
+    poller = None
+    try:
+        if not cluster.start():
+            return False
+        
+        import webhook_server
+        webhook_server.delete_webhook(SantOS.BASE_URL)
+        
+        # Поток опроса складывает update прямо в кластер, очередь ему не нужна
+        from poller import UpdatePoller
+        poller = UpdatePoller(SantOS.BASE_URL, cluster)
+        poller.start()
+        logger.info(f"⏳ Бот запущен на {shards} шардах, ожидание сообщений...")
+        
+        last_report = time.monotonic()
+        while not stop_requested:
+            if not poller.is_alive():
+                logger.error("❌ Поток polling остановился")
+                return False
+            if not cluster.alive():
+                logger.error("❌ Один из шардов остановился")
+                return False
+            if time.monotonic() - last_report >= 60:
+                stats = cluster.stats()
+                logger.info(f"💓 Шарды: update {stats['routed']}, переходов {stats['transfers']}, "
+                            f"гостей {stats['guests']}, комнат {stats['rooms']}")
+                last_report = time.monotonic()
+            time.sleep(1)
+        return True
+    
+    finally:
+        if poller:
+            poller.stop()
+        cluster.stop()
 
 def main():
     """Главная функция с контролируемым перезапуском"""
@@ -197,7 +315,13 @@ def main():
         
         try:
             # Запускаем бота
-            success = run_bot()
+            shards = int(os.environ.get('SHARDS', 1))
+            if shards > 1:
+                success = run_sharded(shards)
+            elif os.environ.get('WEBHOOK_URL'):
+                success = run_webhook()
+            else:
+                success = run_bot()
             
             if stop_requested:
                 logger.info("👋 Завершение работы по запросу")
@@ -228,6 +352,14 @@ def main():
         last_restart_time = current_time
 
 if __name__ == "__main__":
+    # Логирование (запись на диск и в консоль в фоновом потоке) и сигналы - только при запуске
+    # скрипта: процессы шардов импортируют этот модуль заново как __mp_main__ и настраивают их сами
+    setup_logging()
+    
+    # Регистрируем обработчики сигналов
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
     main()
     
     # Финализация
@@ -0,0 +1,157 @@
+"""
+broadcast.py - Массовые рассылки
+Общий ограничитель скорости и пул воркеров для уведомлений всей комнате
+"""
+
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+    """Token bucket: не больше rate отправок в секунду, всплеск до burst"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Ждет, пока не появится свободный токен"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+DEFERRED = 'deferred'  # send_func вернул: сообщение не ушло сейчас, но будет дослано позже
+
+class BroadcastResult:
+    """Итог рассылки; счетчики обновляются по мере доставки"""
+
+    def __init__(self, name):
+        self.name = name
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.deferred = 0
+        self.started = time.monotonic()
+        self.finished = None
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+
+    def _record(self, ok):
+        with self.lock:
+            if ok is DEFERRED:
+                self.deferred += 1
+            elif ok:
+                self.sent += 1
+            else:
+                self.failed += 1
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.monotonic()) - self.started
+
+    def __repr__(self):
+        return f"<Broadcast {self.name}: {self.sent}/{self.total}, отложено {self.deferred}, ошибок {self.failed}, {self.elapsed:.1f} с>"
+
+class Broadcaster:
+    """Рассылка через ограниченный пул воркеров под общим RateLimiter.
+
+    Получатели читаются из итератора по мере отправки (весь список не материализуется),
+    в полете одновременно не больше max_in_flight сообщений. broadcast() возвращает
+    управление сразу, итог приходит в on_done и в BroadcastResult.
+    send_func возвращает True/False или DEFERRED, если сообщение будет дослано позже.
+    """
+
+    def __init__(self, send_func, limiter, max_workers=8, max_in_flight=32):
+        self.send_func = send_func
+        self.limiter = limiter
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='broadcast')
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.active = set()  # BroadcastResult незавершенных рассылок
+        self.lock = threading.Lock()
+
+    def join(self, timeout=None):
+        """Ждет завершения всех начатых рассылок (при остановке); False, если не дождались"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.lock:
+            active = list(self.active)
+        for result in active:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not result.wait(remaining):
+                return False
+        return True
+
+    def broadcast(self, messages, name='broadcast', parse_mode=None, on_done=None, on_progress=None):
+        """messages - итерируемое из пар (chat_id, text)"""
+        result = BroadcastResult(name)
+        with self.lock:
+            self.active.add(result)
+        feeder = threading.Thread(
+            target=tracing.wrap(self._feed),
+            args=(messages, result, parse_mode, on_done, on_progress),
+            name=f'broadcast-{name}',
+            daemon=True
+        )
+        feeder.start()
+        return result
+
+    def _feed(self, messages, result, parse_mode, on_done, on_progress):
+        pending = []
+        try:
+            for chat_id, text in messages:
+                self.in_flight.acquire()
+                self.limiter.acquire()
+                result.total += 1
+                pending.append(self.pool.submit(tracing.wrap(self._send_one), chat_id, text, parse_mode, result, on_progress))
+                # Не копим завершенные future
+                if len(pending) > 256:
+                    pending = [f for f in pending if not f.done()]
+        except Exception as e:
+            logger.error(f"❌ Ошибка формирования рассылки {result.name}: {e}")
+
+        for future in pending:
+            future.result()
+        result.finished = time.monotonic()
+        with self.lock:
+            self.active.discard(result)
+        result.done.set()
+        logger.info(f"📣 {result!r}")
+
+        if on_done:
+            try:
+                on_done(result)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработчика завершения рассылки {result.name}: {e}")
+
+    def _send_one(self, chat_id, text, parse_mode, result, on_progress):
+        try:
+            ok = self.send_func(chat_id, text, parse_mode=parse_mode)
+        except Exception as e:
+            logger.error(f"❌ Ошибка рассылки {result.name} для {chat_id}: {e}")
+            ok = False
+        finally:
+            self.in_flight.release()
+        result._record(ok)
+        if on_progress:
+            try:
+                on_progress(result)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработчика прогресса рассылки {result.name}: {e}")
+        return ok
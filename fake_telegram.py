@@ -0,0 +1,231 @@
+"""
+fake_telegram.py - Локальная замена Telegram Bot API для бенчмарков и нагрузочных тестов
+Поднимает HTTP-сервер на 127.0.0.1 и отвечает на методы бота как настоящий API.
+Бот направляется сюда переменной TELEGRAM_API_URL (см. fake_telegram.api_url)
+
+    python fake_telegram.py --port 8081 --latency 0.05 --rate-limit 0.01
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class FakeTelegramAPI:
+    """Фейковый Bot API в отдельном потоке.
+
+    update подкладываются через push_update(), бот забирает их через getUpdates
+    с настоящим long polling. latency - искусственная задержка каждого ответа в секундах
+    (плюс случайная добавка до jitter), rate_limit - доля запросов бота, на которые
+    отвечаем 429 с retry_after.
+
+    Ответы бота копятся по чатам: wait_reply() ждет следующего сообщения в чат,
+    так нагрузочный тест меряет задержку от update до ответа.
+    """
+
+    def __init__(self, token='123456:FAKE', host='127.0.0.1', port=0, latency=0.0,
+                 jitter=0.0, rate_limit=0.0, retry_after=1, username='fake_santa_bot'):
+        self.token = token
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.username = username
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.pushed_at = {}   # update_id -> время постановки
+        self.calls = {}       # method -> количество вызовов
+        self.rate_limited = 0
+        self.sent = []        # (method, params)
+        self.replies = {}     # chat_id -> [(время, method, params)]
+        self.callback_chats = {}  # callback_query_id -> chat_id
+        self.cond = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self._make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_url(self):
+        """Значение для TELEGRAM_API_URL"""
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def base_url(self):
+        return f"{self.api_url}/bot{self.token}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-telegram', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, update):
+        """Кладет update в очередь; update_id проставляется автоматически"""
+        with self.cond:
+            update = dict(update, update_id=self.next_update_id)
+            self.next_update_id += 1
+            self.pushed_at[update['update_id']] = time.perf_counter()
+            if 'callback_query' in update:
+                callback_query = update['callback_query']
+                self.callback_chats[callback_query['id']] = callback_query.get('message', {}).get('chat', {}).get('id')
+            self.updates.append(update)
+            self.cond.notify_all()
+            return update['update_id']
+
+    def reply_count(self, chat_id):
+        with self.cond:
+            return len(self.replies.get(chat_id, ()))
+
+    def wait_reply(self, chat_id, since, timeout=30, methods=('sendMessage', 'editMessageText')):
+        """Ждет ответа бота в чат после позиции since; возвращает (позиция, время, method, params) или None"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                replies = self.replies.get(chat_id, ())
+                for index in range(since, len(replies)):
+                    if replies[index][1] in methods:
+                        return (index,) + replies[index]
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+    def _record_reply(self, chat_id, method, params):
+        with self.cond:
+            self.replies.setdefault(chat_id, []).append((time.perf_counter(), method, params))
+            self.cond.notify_all()
+
+    # --- Методы API ---
+    def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+        with self.cond:
+            # Подтвержденные update больше не нужны
+            self.updates = [u for u in self.updates if u['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self.cond.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    def _message(self, params, message_id=None):
+        with self.cond:
+            if message_id is None:
+                message_id = self.next_message_id
+                self.next_message_id += 1
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': params.get('chat_id'), 'type': 'private'},
+            'text': params.get('text')
+        }
+
+    def send_message(self, params):
+        chat_id = int(params.get('chat_id'))
+        message = self._message(params)
+        self._record_reply(chat_id, 'sendMessage', params)
+        return message
+
+    def edit_message_text(self, params):
+        chat_id = int(params.get('chat_id'))
+        message = self._message(params, int(params.get('message_id', 0)))
+        self._record_reply(chat_id, 'editMessageText', params)
+        return message
+
+    def answer_callback_query(self, params):
+        chat_id = self.callback_chats.pop(params.get('callback_query_id'), None)
+        if chat_id is not None:
+            self._record_reply(chat_id, 'answerCallbackQuery', params)
+        return True
+
+    def get_me(self, params):
+        return {'id': int(self.token.split(':')[0]), 'is_bot': True, 'first_name': 'Santa', 'username': self.username}
+
+    def dispatch(self, method, params):
+        with self.cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(params)}
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': self.get_me(params)}
+
+        if self.rate_limit and random.random() < self.rate_limit:
+            with self.cond:
+                self.rate_limited += 1
+            return 429, {
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after}
+            }
+
+        self.sent.append((method, params))
+        if method == 'sendMessage':
+            return 200, {'ok': True, 'result': self.send_message(params)}
+        if method == 'editMessageText':
+            return 200, {'ok': True, 'result': self.edit_message_text(params)}
+        if method == 'answerCallbackQuery':
+            return 200, {'ok': True, 'result': self.answer_callback_query(params)}
+        if method in ('setWebhook', 'deleteWebhook'):
+            return 200, {'ok': True, 'result': True}
+        return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                url = urlparse(self.path)
+                prefix, _, method = url.path.rpartition('/')
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update({k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()})
+
+                if prefix != f"/bot{api.token}":
+                    status, data = 401, {'ok': False, 'error_code': 401, 'description': 'Unauthorized'}
+                else:
+                    if api.latency or api.jitter:
+                        time.sleep(api.latency + random.uniform(0, api.jitter))
+                    status, data = api.dispatch(method, params)
+
+                payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _handle
+            do_POST = _handle
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальный фейковый Telegram Bot API")
+    parser.add_argument('--token', default='123456:FAKE')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="Задержка ответа, с")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Случайная добавка к задержке, с")
+    parser.add_argument('--rate-limit', type=float, default=0.0, help="Доля запросов с ответом 429")
+    args = parser.parse_args()
+
+    api = FakeTelegramAPI(args.token, port=args.port, latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit)
+    print(f"🧪 Фейковый Bot API: TELEGRAM_API_URL={api.api_url} BOT_TOKEN={args.token}")
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
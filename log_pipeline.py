@@ -0,0 +1,136 @@
+"""
+log_pipeline.py - Неблокирующее логирование
+Обработчики только кладут записи в очередь, на диск и в консоль их пишет фоновый поток.
+В файл идут JSON lines с ротацией по размеру, болтливые категории прореживаются
+"""
+
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FILE = os.environ.get('LOG_FILE', 'santa_bot.log')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.environ.get('LOG_BACKUPS', 5))
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+# Доля сохраняемых записей по категориям: "update=0.1,api=0.5"
+LOG_SAMPLING = os.environ.get('LOG_SAMPLING', 'update=0.1')
+
+# Стандартные атрибуты LogRecord, все остальное пришло через extra
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+_lock = threading.Lock()
+
+def parse_sampling(spec):
+    rates = {}
+    for item in spec.split(','):
+        if '=' in item:
+            category, rate = item.split('=', 1)
+            rates[category.strip()] = float(rate)
+    return rates
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON; поля из extra попадают в объект как есть"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'msg': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Пропускает только долю записей категории (extra={'category': ...}).
+    Предупреждения и ошибки не прореживаются никогда"""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.dropped = 0
+
+    def filter(self, record):
+        rate = self.rates.get(getattr(record, 'category', None))
+        if rate is None or rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        if random.random() < rate:
+            return True
+        self.dropped += 1
+        return False
+
+class NonBlockingQueueHandler(QueueHandler):
+    """Если фоновый поток не успевает, запись отбрасывается, а не задерживает обработчик"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def setup_logging(level=logging.INFO, path=LOG_FILE, console=True, force=False):
+    """Настраивает корневой логгер один раз за процесс; повторные вызовы ничего не делают.
+    force=True заменяет уже настроенное логирование (например, после смены рабочей папки)"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            if not force:
+                return _listener
+            atexit.unregister(_listener.stop)
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+
+        handlers = []
+        try:
+            file_handler = RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding='utf-8')
+            file_handler.setFormatter(JsonFormatter())
+            handlers.append(file_handler)
+        except OSError as e:
+            print(f"⚠️ Не удалось открыть {path}: {e}", file=sys.stderr)
+        if console:
+            stream_handler = logging.StreamHandler(sys.stdout)
+            stream_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+            handlers.append(stream_handler)
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        queue_handler = NonBlockingQueueHandler(log_queue)
+        queue_handler.addFilter(SamplingFilter(parse_sampling(LOG_SAMPLING)))
+
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(queue_handler)
+        root.setLevel(level)
+
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        # Дописываем хвост очереди при выходе
+        atexit.register(_listener.stop)
+        return _listener
+
+def logging_stats():
+    """Сколько записей отброшено выборкой и из-за переполнения очереди"""
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if isinstance(handler, NonBlockingQueueHandler):
+            sampled = sum(f.dropped for f in handler.filters if isinstance(f, SamplingFilter))
+            return {'queued': handler.queue.qsize(), 'dropped_full': handler.dropped, 'dropped_sampled': sampled}
+    return {'queued': 0, 'dropped_full': 0, 'dropped_sampled': 0}
@@ -0,0 +1,243 @@
+"""
+metrics.py - Метрики бота в формате Prometheus
+Счетчики и гистограммы без блокировок на горячем пути и маленький HTTP-сервер для /metrics
+"""
+
+import time
+import logging
+import threading
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Границы по умолчанию: от миллисекунд до десятков секунд
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class _ThreadShards:
+    """Значения метрики, разложенные по потокам.
+
+    Каждый поток пишет только в свой список, поэтому inc()/observe() обходятся
+    без блокировок. Блокировка берется, только когда поток пишет впервые
+    и когда метрики собираются для выдачи. Списки завершившихся потоков
+    при сборе складываются в общий итог и забываются.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.shards = []  # (поток, значения)
+        self.retired = [0] * size
+        self.lock = threading.Lock()
+
+    def get(self):
+        try:
+            return self.local.values
+        except AttributeError:
+            values = [0] * self.size
+            with self.lock:
+                self.shards.append((threading.current_thread(), values))
+            self.local.values = values
+            return values
+
+    def collect(self):
+        with self.lock:
+            total = list(self.retired)
+            alive = []
+            for thread, values in self.shards:
+                for i, value in enumerate(values):
+                    total[i] += value
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    for i, value in enumerate(values):
+                        self.retired[i] += value
+            self.shards = alive
+        return total
+
+class _CounterValue:
+    def __init__(self):
+        self.shards = _ThreadShards(1)
+
+    def inc(self, amount=1):
+        self.shards.get()[0] += amount
+
+    def samples(self, name, labels):
+        return [(name + '_total', labels, self.shards.collect()[0])]
+
+class _HistogramValue:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Счетчики по корзинам (+Inf последней), затем сумма и количество
+        self.shards = _ThreadShards(len(buckets) + 3)
+
+    def observe(self, value):
+        values = self.shards.get()
+        values[bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        values = self.shards.collect()
+        result = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), values):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            result.append((name + '_bucket', labels + (('le', le),), cumulative))
+        result.append((name + '_sum', labels, values[-2]))
+        result.append((name + '_count', labels, values[-1]))
+        return result
+
+class _GaugeValue:
+    def __init__(self, func=None):
+        self.func = func
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        value = self.value
+        if self.func:
+            try:
+                value = self.func()
+            except Exception as e:
+                logger.error(f"❌ Ошибка вычисления метрики {name}: {e}")
+                return []
+        return [(name, labels, value)]
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+class Metric:
+    """Метрика с именем, описанием и, возможно, метками.
+
+    Без меток методы значения (inc, observe, set) вызываются прямо у метрики,
+    с метками - у дочернего значения: metric.labels('sendMessage').inc()
+    """
+
+    def __init__(self, kind, name, documentation, labelnames, factory):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.factory = factory
+        self.children = {}
+        self.by_raw = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            # У метрики без меток методы значения (inc, observe, set, time) доступны напрямую
+            child = self.children[()] = factory()
+            for attr in ('inc', 'observe', 'set', 'time'):
+                if hasattr(child, attr):
+                    setattr(self, attr, getattr(child, attr))
+
+    def labels(self, *values):
+        # Быстрый путь - по исходным значениям, без приведения к строкам
+        child = self.by_raw.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}")
+            with self.lock:
+                child = self.children.setdefault(tuple(str(v) for v in values), self.factory())
+                self.by_raw[values] = child
+        return child
+
+    def samples(self):
+        result = []
+        for values, child in list(self.children.items()):
+            result.extend(child.samples(self.name, tuple(zip(self.labelnames, values))))
+        return result
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing:
+                # Повторная регистрация (например, при перезапуске бота) возвращает ту же метрику
+                if existing.kind != metric.kind:
+                    raise ValueError(f"Метрика {metric.name} уже зарегистрирована как {existing.kind}")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ','.join(f'{key}="{_escape_label(val)}"' for key, val in labels)
+                    lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+REGISTRY = Registry()
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Metric('counter', name, documentation, labelnames, _CounterValue))
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    buckets = tuple(sorted(buckets))
+    return REGISTRY.register(Metric('histogram', name, documentation, labelnames, lambda: _HistogramValue(buckets)))
+
+def gauge(name, documentation, func=None, labelnames=()):
+    """Gauge со значением через set() или вычисляемый функцией func в момент выдачи"""
+    return REGISTRY.register(Metric('gauge', name, documentation, labelnames, lambda: _GaugeValue(func)))
+
+def render():
+    return REGISTRY.render()
+
+def start_http_server(port, host='0.0.0.0'):
+    """Отдает /metrics на отдельном порту (для режима polling, где нет веб-сервера)"""
+    # http.server нужен только здесь - не тянем его в каждый импорт метрик
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            payload = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f"📈 Метрики доступны на http://{host}:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,156 @@
+"""
+poller.py - Конвейерный long polling
+Поток опроса сразу же запрашивает следующую пачку, пока обработчики разбирают текущую
+"""
+
+import os
+import json
+import logging
+import threading
+
+import requests
+
+from update_queue import QueueFull
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MIN_LIMIT = 10
+MAX_LIMIT = 100        # Максимум, который разрешает Telegram
+LONG_POLL_TIMEOUT = 50
+# Update, полученные (а значит, подтвержденные Telegram), но не обработанные к остановке
+PENDING_FILE = 'pending_updates.json'
+
+batch_sizes = metrics.histogram(
+    'santa_getupdates_batch_size', 'Число update в ответе getUpdates',
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100)
+)
+
+class UpdatePoller(threading.Thread):
+    """Поток, который опрашивает getUpdates и складывает update в UpdateQueue.
+
+    Offset сдвигается сразу после получения пачки, поэтому следующий запрос уходит,
+    не дожидаясь обработки. Если очередь заполнена, put() блокирует поток -
+    опрос приостанавливается, пока обработчики не догонят.
+
+    limit подстраивается под средний размер пачки, а timeout падает до 0,
+    когда пачка пришла полной (значит, на сервере есть еще update).
+    """
+
+    def __init__(self, base_url, updates_queue, stop_event=None, session=None):
+        super().__init__(name='update-poller', daemon=True)
+        self.base_url = base_url
+        self.updates_queue = updates_queue
+        self.stop_event = stop_event or threading.Event()
+        self.session = session or requests.Session()
+        self.offset = 0
+        self.limit = MAX_LIMIT
+        self.timeout = LONG_POLL_TIMEOUT
+        self.avg_batch = 0.0
+        self.polls = 0
+        self.unqueued = []  # Остаток пачки, не попавший в очередь из-за остановки
+
+    def stop(self):
+        self.stop_event.set()
+
+    def _tune(self, batch_size):
+        was_full = batch_size >= self.limit
+        # Экспоненциальное сглаживание, чтобы один всплеск не дергал параметры
+        self.avg_batch = 0.8 * self.avg_batch + 0.2 * batch_size
+        if was_full:
+            # Пачка полная - на сервере есть еще update, забираем без ожидания
+            self.limit = MAX_LIMIT
+            self.timeout = 0
+        else:
+            self.limit = max(MIN_LIMIT, min(MAX_LIMIT, int(self.avg_batch * 2) + MIN_LIMIT))
+            self.timeout = LONG_POLL_TIMEOUT
+
+    def poll_once(self):
+        """Один запрос getUpdates; возвращает список update или None при ошибке"""
+        response = self.session.get(
+            f"{self.base_url}/getUpdates",
+            params={
+                'offset': self.offset + 1,
+                'timeout': self.timeout,
+                'limit': self.limit
+            },
+            timeout=self.timeout + 5
+        )
+
+        if response.status_code != 200:
+            logger.error(f"❌ HTTP ошибка: {response.status_code}")
+            return None
+
+        data = response.json()
+        if not data.get('ok'):
+            logger.error(f"❌ Telegram API error: {data}")
+            return None
+
+        return data.get('result', [])
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                updates = self.poll_once()
+            except requests.exceptions.Timeout:
+                # Таймаут - нормальная ситуация при long polling
+                continue
+            except requests.exceptions.ConnectionError:
+                logger.error("🔌 Ошибка соединения, переподключение...")
+                self.stop_event.wait(5)
+                continue
+            except Exception as e:
+                logger.error(f"❌ Ошибка в цикле polling: {e}")
+                self.stop_event.wait(5)
+                continue
+
+            if updates is None:
+                self.stop_event.wait(5)
+                continue
+
+            self.polls += 1
+            batch_sizes.observe(len(updates))
+            for update in updates:
+                if update['update_id'] > self.offset:
+                    self.offset = update['update_id']
+            self._tune(len(updates))
+
+            for i, update in enumerate(updates):
+                # Блокирующий put - это и есть обратное давление на опрос,
+                # схлопнутые повторные нажатия просто не попадают в очередь
+                while not self.stop_event.is_set():
+                    try:
+                        self.updates_queue.put(update, timeout=1)
+                        break
+                    except QueueFull:
+                        continue
+                else:
+                    # offset уже сдвинут - Telegram этих update больше не отдаст
+                    self.unqueued = updates[i:]
+                    break
+
+def save_pending(updates, path=PENDING_FILE):
+    """Сохраняет необработанные update при остановке: offset для них уже подтвержден,
+    и getUpdates их не вернет. При аварийном завершении процесса они все равно теряются"""
+    if not updates:
+        return
+    try:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(updates, f, ensure_ascii=False)
+        logger.info(f"💾 Необработанных update сохранено: {len(updates)}")
+    except OSError as e:
+        logger.error(f"❌ Не удалось сохранить необработанные update: {e}")
+
+def load_pending(path=PENDING_FILE):
+    """Update, оставшиеся с прошлой остановки; файл удаляется, чтобы не обработать их дважды"""
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            updates = json.load(f)
+        os.remove(path)
+    except (OSError, ValueError) as e:
+        logger.error(f"❌ Не удалось прочитать {path}: {e}")
+        return []
+    logger.info(f"📥 Необработанных update с прошлой остановки: {len(updates)}")
+    return updates
@@ -0,0 +1,131 @@
+"""
+profiling.py - Профилирование горячего пути по запросу
+Обертки считают wall/CPU время функций, часть update прогоняется под cProfile.
+Включается только явно: без включения функции бота не оборачиваются вовсе
+"""
+
+import io
+import time
+import random
+import signal
+import pstats
+import cProfile
+import logging
+import threading
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+class HotPathProfiler:
+    """Накопитель времени по функциям и выборочный cProfile.
+
+    instrument() подменяет функции модуля обертками. Для каждой функции
+    копятся вызовы, суммарное и максимальное wall время и CPU время потока.
+    Функции из sampled с вероятностью sample_rate целиком выполняются под
+    cProfile, результаты складываются в общий pstats.Stats.
+    """
+
+    def __init__(self, sample_rate=0.01, top=20):
+        self.sample_rate = sample_rate
+        self.top = top
+        self.lock = threading.Lock()
+        self.timings = {}  # имя -> [вызовы, wall, cpu, max wall]
+        self.started = time.time()
+        # cProfile нельзя запускать в нескольких потоках сразу, поэтому один образец за раз
+        self.sample_lock = threading.Lock()
+        self.sampled_stats = None
+        self.samples = 0
+
+    def _record(self, name, wall, cpu):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = [0, 0.0, 0.0, 0.0]
+            timing[0] += 1
+            timing[1] += wall
+            timing[2] += cpu
+            if wall > timing[3]:
+                timing[3] = wall
+
+    def _run_sampled(self, func, args, kwargs):
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(func, *args, **kwargs)
+        finally:
+            with self.lock:
+                if self.sampled_stats is None:
+                    self.sampled_stats = pstats.Stats(profile)
+                else:
+                    self.sampled_stats.add(profile)
+                self.samples += 1
+
+    def wrap(self, name, func, sampled=False):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                if sampled and random.random() < self.sample_rate and self.sample_lock.acquire(blocking=False):
+                    try:
+                        return self._run_sampled(func, args, kwargs)
+                    finally:
+                        self.sample_lock.release()
+                return func(*args, **kwargs)
+            finally:
+                self._record(name, time.perf_counter() - wall_start, time.thread_time() - cpu_start)
+        wrapper.__wrapped_by_profiler__ = True
+        return wrapper
+
+    def instrument(self, module, names, sampled=()):
+        """Подменяет функции модуля обертками (повторный вызов ничего не оборачивает дважды)"""
+        for name in names:
+            func = getattr(module, name, None)
+            if func is None or getattr(func, '__wrapped_by_profiler__', False):
+                continue
+            setattr(module, name, self.wrap(name, func, sampled=name in sampled))
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}
+            self.sampled_stats = None
+            self.samples = 0
+            self.started = time.time()
+
+    def report(self, top=None):
+        """Текстовый отчет: top-N функций по суммарному времени и top-N из образцов cProfile"""
+        top = top or self.top
+        with self.lock:
+            rows = sorted(self.timings.items(), key=lambda item: item[1][1], reverse=True)[:top]
+            sampled_stats = self.sampled_stats
+            samples = self.samples
+
+        lines = [f"⏱ Профиль за {time.time() - self.started:.0f} с"]
+        lines.append(f"{'функция':<32} {'вызовы':>8} {'wall мс':>10} {'ср мс':>8} {'макс мс':>8} {'cpu %':>6}")
+        for name, (calls, wall, cpu, max_wall) in rows:
+            cpu_share = cpu / wall * 100 if wall else 0.0
+            lines.append(
+                f"{name[:32]:<32} {calls:>8} {wall * 1000:>10.1f} {wall / calls * 1000:>8.2f} "
+                f"{max_wall * 1000:>8.1f} {cpu_share:>6.0f}"
+            )
+
+        if sampled_stats is not None:
+            stream = io.StringIO()
+            with self.lock:
+                sampled_stats.stream = stream
+                sampled_stats.sort_stats('cumulative').print_stats(top)
+            lines.append(f"\n🔬 cProfile, образцов: {samples}")
+            lines.append(stream.getvalue().strip())
+        return '\n'.join(lines)
+
+    def install_signal(self, signum=None):
+        """Отчет в лог по сигналу (по умолчанию SIGUSR1). Работает только из главного потока"""
+        signum = signum or getattr(signal, 'SIGUSR1', None)
+        if signum is None or threading.current_thread() is not threading.main_thread():
+            return False
+
+        def dump(sig, frame):
+            # Отчет строится в отдельном потоке, чтобы не держать блокировки внутри обработчика сигнала
+            threading.Thread(target=lambda: logger.info(self.report()), daemon=True).start()
+
+        signal.signal(signum, dump)
+        return True
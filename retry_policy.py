@@ -0,0 +1,99 @@
+"""
+retry_policy.py - Повторы с экспоненциальной задержкой и circuit breaker для Telegram API
+"""
+
+import time
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class RetryPolicy:
+    """Экспоненциальная задержка с полным джиттером: sleep = random(0, min(cap, base * 2^attempt))"""
+
+    def __init__(self, attempts=3, base=0.5, cap=8.0):
+        self.attempts = attempts
+        self.base = base
+        self.cap = cap
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.cap, self.base * (2 ** attempt)))
+
+class CircuitBreaker:
+    """Предохранитель для внешнего API.
+
+    closed    - запросы идут как обычно, считаем ошибки подряд;
+    open      - после failure_threshold ошибок подряд запросы сразу отклоняются;
+    half_open - через recovery_timeout пропускаем один пробный запрос:
+                успех закрывает предохранитель, ошибка снова открывает.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30.0, on_close=None):
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.on_close = on_close
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+        # Метрики
+        self.times_opened = 0
+        self.rejected = 0
+        self.total_failures = 0
+        self.total_successes = 0
+
+    def allow(self):
+        """Можно ли сейчас отправить запрос"""
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+                logger.info("🟡 Telegram API: пробный запрос после паузы")
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.total_successes += 1
+            self.failures = 0
+            recovered = self.state != self.CLOSED
+            self.state = self.CLOSED
+            self.probe_in_flight = False
+        if recovered:
+            logger.info("🟢 Telegram API снова доступен")
+            if self.on_close:
+                self.on_close()
+
+    def record_failure(self):
+        with self.lock:
+            self.total_failures += 1
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self.times_opened += 1
+                logger.error(f"🔴 Telegram API недоступен, запросы приостановлены на {self.recovery_timeout:.0f} с")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.failures,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+                'failures': self.total_failures,
+                'successes': self.total_successes
+            }
@@ -0,0 +1,128 @@
+"""
+room_archive.py - Холодный архив завершенных комнат
+Комнаты дописываются в конец файла отдельными сжатыми записями,
+рядом лежит небольшой индекс для редкого чтения
+"""
+
+import os
+import json
+import zlib
+import struct
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Заголовок записи: длина сжатых данных (4 байта, big-endian)
+RECORD_HEADER = struct.Struct('>I')
+
+class RoomArchive:
+    """Append-only архив комнат.
+
+    Формат файла: [длина][zlib(JSON комнаты)] подряд, старые записи никогда не переписываются.
+    Индекс хранит room_id -> (смещение, длина) и user_id -> [room_id],
+    поэтому чтение одной комнаты - это один seek и одно чтение.
+    """
+
+    def __init__(self, path='santa_archive.bin', index_path='santa_archive_index.json'):
+        self.path = path
+        self.index_path = index_path
+        self.rooms = {}   # room_id -> [offset, length]
+        self.users = {}   # user_id -> [room_id, ...] в порядке архивации
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Загружает индекс; если он потерян - восстанавливает по файлу архива"""
+        with self.lock:
+            self.rooms, self.users = {}, {}
+            if os.path.exists(self.index_path):
+                try:
+                    with open(self.index_path, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                    self.rooms = data['rooms']
+                    self.users = {int(k): v for k, v in data['users'].items()}
+                    return
+                except Exception as e:
+                    logger.error(f"❌ Индекс архива поврежден, восстанавливаю: {e}")
+            if os.path.exists(self.path):
+                self._rebuild_index()
+
+    def _rebuild_index(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                offset = f.tell()
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, = RECORD_HEADER.unpack(header)
+                blob = f.read(length)
+                if len(blob) < length:
+                    logger.warning(f"⚠️ Обрезанная запись в архиве на смещении {offset}")
+                    break
+                self._index_room(json.loads(zlib.decompress(blob)), offset + RECORD_HEADER.size, length)
+        self._save_index()
+        logger.info(f"✅ Индекс архива восстановлен: {len(self.rooms)} комнат")
+
+    def _index_room(self, room_data, offset, length):
+        room_id = room_data['room_id']
+        self.rooms[room_id] = [offset, length]
+        for user_id in room_data['participants']:
+            user_list = self.users.setdefault(int(user_id), [])
+            if room_id not in user_list:
+                user_list.append(room_id)
+
+    def _save_index(self):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'rooms': self.rooms, 'users': self.users}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.index_path)
+
+    def append(self, room_data):
+        """Дописывает комнату (результат Room.to_dict()) в архив"""
+        self.extend([room_data])
+
+    def extend(self, rooms_data):
+        """Дописывает пачку комнат: один fsync и одна запись индекса на всю пачку"""
+        blobs = [(room_data, zlib.compress(json.dumps(room_data, ensure_ascii=False).encode('utf-8'), 9))
+                 for room_data in rooms_data]
+        if not blobs:
+            return
+        with self.lock:
+            positions = []
+            with open(self.path, 'ab') as f:
+                for room_data, blob in blobs:
+                    offset = f.tell()
+                    f.write(RECORD_HEADER.pack(len(blob)))
+                    f.write(blob)
+                    positions.append((room_data, offset + RECORD_HEADER.size, len(blob)))
+                f.flush()
+                os.fsync(f.fileno())
+            for room_data, offset, length in positions:
+                self._index_room(room_data, offset, length)
+            self._save_index()
+
+    def get(self, room_id):
+        """Читает комнату из архива, None если ее там нет"""
+        position = self.rooms.get(room_id)
+        if not position:
+            return None
+        offset, length = position
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(zlib.decompress(f.read(length)))
+
+    def has_user(self, user_id):
+        return user_id in self.users
+
+    def latest_for_user(self, user_id):
+        """Последняя архивная комната пользователя"""
+        room_ids = self.users.get(user_id)
+        if not room_ids:
+            return None
+        return self.get(room_ids[-1])
+
+    def __contains__(self, room_id):
+        return room_id in self.rooms
+
+    def __len__(self):
+        return len(self.rooms)
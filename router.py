@@ -0,0 +1,183 @@
+"""
+router.py - Таблица маршрутов для update
+Текст ищется в словаре по (состояние, текст), callback_data - в словаре точных значений,
+затем в префиксном дереве. Общие шаги (антифлуд, метрики, обновление профиля) подключаются
+как middleware и выполняются один раз на update
+"""
+
+from functools import partial
+
+class PrefixTrie:
+    """Префиксное дерево: находит самый длинный зарегистрированный префикс строки"""
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, value):
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        # Ключи узлов - символы, поэтому None свободен под значение
+        node[None] = value
+
+    def longest(self, key):
+        node = self.root
+        found = node.get(None)
+        for char in key:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found = node[None]
+        return found
+
+    def nodes(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(child for char, child in node.items() if char is not None)
+
+class Request:
+    """Разобранный update: кто прислал, куда и что"""
+
+    __slots__ = ('update', 'kind', 'from_user', 'user_id', 'chat_id', 'message_id',
+                 'text', 'data', 'callback_id', 'label')
+
+    def __init__(self, update, label=None):
+        self.update = update
+        self.label = label
+        self.text = self.data = self.callback_id = None
+        message = update.get('message')
+        callback_query = update.get('callback_query')
+        if message is not None:
+            self.kind = 'message'
+            self.from_user = message.get('from', {})
+            self.chat_id = message.get('chat', {}).get('id')
+            self.message_id = message.get('message_id')
+            self.text = message.get('text')
+        elif callback_query is not None:
+            self.kind = 'callback'
+            self.from_user = callback_query.get('from', {})
+            callback_message = callback_query.get('message', {})
+            self.chat_id = callback_message.get('chat', {}).get('id')
+            self.message_id = callback_message.get('message_id')
+            self.data = callback_query.get('data', '')
+            self.callback_id = callback_query['id']
+        else:
+            self.kind = None
+            self.from_user = {}
+            self.chat_id = self.message_id = None
+        self.user_id = self.from_user.get('id')
+
+class Router:
+    """Маршрутизатор update.
+
+    Сигнатуры обработчиков по виду маршрута:
+      command(text_command)      -> handler(message, user_id)
+      text(state, text)          -> handler(user_id)
+      text_prefix(state, prefix) -> handler(user_id)
+      text_input(state)          -> handler(user_id, text)   любой другой текст в этом состоянии
+      callback(data)             -> handler(user_id, chat_id, message_id, data)
+      callback_prefix(prefix)    -> handler(user_id, chat_id, message_id, data)
+    Точное совпадение callback_data важнее префикса. Обработчик callback может вернуть
+    текст всплывающего уведомления.
+
+    Middleware - функция (request, call_next), вызывается в порядке добавления;
+    не вызвав call_next(request), она прерывает обработку. Цепочка собирается
+    один раз при use(), на каждый update новых функций не создается.
+    """
+
+    def __init__(self, state_of):
+        self.state_of = state_of    # user_id -> имя состояния диалога
+        self.commands = {}          # '/start' -> (handler, when)
+        self.texts = {}             # (state, text) -> handler
+        self.text_prefixes = {}     # state -> PrefixTrie
+        self.inputs = {}            # state -> handler
+        self.callbacks = {}         # data -> handler
+        self.callback_prefixes = PrefixTrie()
+        self.middleware = []
+        self._chain = self.route
+
+    # --- Регистрация ---
+    def command(self, name, handler, when=None):
+        """when(request) - дополнительное условие; если оно ложно, текст идет по обычным маршрутам"""
+        self.commands[name] = (handler, when)
+
+    def text(self, state, text, handler):
+        self.texts[(state, text)] = handler
+
+    def text_prefix(self, state, prefix, handler):
+        self.text_prefixes.setdefault(state, PrefixTrie()).add(prefix, handler)
+
+    def text_input(self, state, handler):
+        self.inputs[state] = handler
+
+    def callback(self, data, handler):
+        self.callbacks[data] = handler
+
+    def callback_prefix(self, prefix, handler):
+        self.callback_prefixes.add(prefix, handler)
+
+    def use(self, middleware, before=None):
+        """Добавляет middleware в конец цепочки или перед уже подключенной before"""
+        if before is None:
+            self.middleware.append(middleware)
+        else:
+            self.middleware.insert(self.middleware.index(before), middleware)
+        chain = self.route
+        for layer in reversed(self.middleware):
+            chain = partial(layer, call_next=chain)
+        self._chain = chain
+
+    def replace_handlers(self, replacements):
+        """Подменяет обработчики во всех таблицах (например, обертками профилировщика)"""
+        def swap(handler):
+            return replacements.get(handler, handler)
+
+        self.commands = {name: (swap(handler), when) for name, (handler, when) in self.commands.items()}
+        for table in (self.texts, self.inputs, self.callbacks):
+            for key, handler in table.items():
+                table[key] = swap(handler)
+        for trie in [self.callback_prefixes, *self.text_prefixes.values()]:
+            for node in trie.nodes():
+                if None in node:
+                    node[None] = swap(node[None])
+
+    # --- Обработка ---
+    def dispatch(self, update, label=None):
+        return self._chain(Request(update, label))
+
+    def route(self, request):
+        """Вызывает обработчик запроса; без подходящего маршрута ничего не делает"""
+        if request.kind == 'callback':
+            data = request.data
+            handler = self.callbacks.get(data) or self.callback_prefixes.longest(data)
+            if handler is not None:
+                return handler(request.user_id, request.chat_id, request.message_id, data)
+            return None
+
+        text = request.text
+        if text is None:
+            return None
+        user_id = request.user_id
+
+        if text.startswith('/'):
+            command = self.commands.get(text.split(maxsplit=1)[0])
+            if command is not None:
+                handler, when = command
+                if when is None or when(request):
+                    return handler(request.update['message'], user_id)
+
+        state = self.state_of(user_id)
+        handler = self.texts.get((state, text))
+        if handler is None:
+            trie = self.text_prefixes.get(state)
+            handler = trie.longest(text) if trie is not None else None
+        if handler is not None:
+            return handler(user_id)
+
+        handler = self.inputs.get(state)
+        if handler is not None:
+            return handler(user_id, text)
+        return None
@@ -0,0 +1,551 @@
+"""
+sharding.py - Многопроцессный режим: один процесс принимает update, N процессов-шардов их обрабатывают
+Комнаты распределены по шардам консистентным хешированием room_id, у каждого шарда свой
+santa_data.json в папке shard-<номер>. Пользователь обрабатывается на шарде, где его активная
+комната; переход к комнате другого шарда (приглашение, код, кнопка) идет через координатор.
+Координатор знает все комнаты каждого пользователя и прикладывает к update те, что лежат
+на других шардах, - они видны в меню и в списке "🔄 Сменить комнату".
+Все общение - очереди multiprocessing, поэтому режим проверяется на одной машине:
+
+    SHARDS=4 python bot_launcher.py
+    python benchmarks/load_test.py --users 200 --shards 4
+"""
+
+import os
+import json
+import time
+import bisect
+import signal
+import hashlib
+import logging
+import threading
+import multiprocessing
+from collections import Counter
+
+from update_queue import update_user_id
+
+logger = logging.getLogger(__name__)
+
+# Служебные ключи update, которые координатор добавляет при передаче пользователя между шардами
+STATE_KEY = '_shard_state'      # состояние диалога, с которым пользователь приходит на шард
+GUEST_KEY = '_shard_guest'      # шард не домашний: вернуть пользователя, когда диалог закончится
+CHECKED_KEY = '_shard_checked'  # владелец комнаты уже найден, повторно не проверять
+ROOMS_KEY = '_shard_rooms'      # комнаты пользователя на других шардах: {room_id: (название, организатор ли)}
+
+class HashRing:
+    """Консистентное хеширование: ключ -> узел.
+
+    Каждый узел занимает replicas точек на кольце; при изменении числа узлов
+    переезжает только доля ключей, соответствующая добавленному или убранному узлу.
+    """
+
+    def __init__(self, nodes, replicas=64):
+        self.nodes = list(nodes)
+        points = sorted((self._hash(f"{node}:{i}"), node) for node in self.nodes for i in range(replicas))
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    @staticmethod
+    def _hash(key):
+        # hash() строк случайный в каждом процессе - нужен одинаковый во всех шардах
+        return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+
+    def node_for(self, key):
+        index = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[index]
+
+def shard_dir(data_dir, shard):
+    return os.path.join(data_dir, f"shard-{shard}")
+
+def split_legacy_data(data_dir, ring):
+    """Раскладывает santa_data.json однопроцессного бота по шардам (один раз, пока шардов нет).
+
+    Комната уходит на шард ring(room_id), активная комната пользователя - туда же.
+    Архив (santa_archive.bin) не делится: завершенные комнаты остаются в старом файле.
+    """
+    legacy = os.path.join(data_dir, 'santa_data.json')
+    targets = {shard: os.path.join(shard_dir(data_dir, shard), 'santa_data.json') for shard in ring.nodes}
+    if not os.path.exists(legacy) or any(os.path.exists(path) for path in targets.values()):
+        return False
+
+    with open(legacy, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    parts = {shard: {'rooms': {}, 'user_rooms': {}} for shard in ring.nodes}
+    for room_id, room in data['rooms'].items():
+        parts[ring.node_for(room_id)]['rooms'][room_id] = room
+    for user_id, room_id in data['user_rooms'].items():
+        parts[ring.node_for(room_id)]['user_rooms'][user_id] = room_id
+
+    for shard, part in parts.items():
+        os.makedirs(shard_dir(data_dir, shard), exist_ok=True)
+        with open(targets[shard], 'w', encoding='utf-8') as f:
+            json.dump(part, f, ensure_ascii=False, indent=2)
+    logger.info(f"🔀 {legacy} разложен по {len(parts)} шардам: "
+                f"{', '.join(str(len(part['rooms'])) for part in parts.values())} комнат")
+    return True
+
+class Cluster:
+    """Процесс приема update и координатор шардов.
+
+    submit() отправляет update шарду пользователя: сначала шард, куда пользователь
+    передан на время диалога, затем шард его активной комнаты, затем ring(user_id).
+    Поток управления разбирает сообщения шардов:
+
+      ready/failed  шард запустился (со списком комнат, кодов и пользователей) или нет
+      room          создана комната - пополняем справочник room_id и кодов
+      resolve       пользователь обратился к чужой комнате: передаем update и состояние
+                    диалога владельцу (неизвестную комнату - обратно отправителю)
+      release       диалог гостя закончился: следующий update уйдет на домашний шард
+      reroute       update пришел на шард, откуда пользователь уже передан
+      active        у пользователя сменилась активная комната; старый шард ее забывает
+      member        пользователь вступил в комнату или вышел из нее - справочник комнат пользователя
+      done          update обработан (для on_processed)
+      summary       ответ на summary()
+    """
+
+    def __init__(self, shards, data_dir='.', workers=4, on_processed=None, start_timeout=60, log_level=logging.INFO):
+        self.shards = shards
+        self.data_dir = os.path.abspath(data_dir)
+        self.workers = workers
+        self.on_processed = on_processed
+        self.start_timeout = start_timeout
+        self.log_level = log_level
+        self.ring = HashRing(range(shards))
+        self.context = multiprocessing.get_context('spawn')
+        self.inboxes = [self.context.Queue() for _ in range(shards)]
+        self.outbox = self.context.Queue()
+        self.processes = []
+
+        self.lock = threading.Lock()
+        self.affinity = {}       # user_id -> шард, куда пользователь передан на время диалога
+        self.homes = {}          # user_id -> шард активной комнаты
+        self.pending_state = {}  # user_id -> состояние диалога для следующего update
+        self.directory = {'room': {}, 'code': {}}  # room_id / код -> шард
+        self.memberships = {}    # user_id -> {room_id: (название, организатор ли)} на всех шардах
+        self.routed = Counter()
+        self.transfers = Counter()
+
+        self.ready = set()
+        self.failed = set()
+        self.summaries = {}
+        self.cond = threading.Condition()
+        self.control = None
+
+    # --- Запуск и остановка ---
+    def start(self):
+        """Поднимает шарды и ждет их готовности; False, если хоть один не запустился"""
+        split_legacy_data(self.data_dir, self.ring)
+        report_done = self.on_processed is not None
+        for shard in range(self.shards):
+            process = self.context.Process(
+                target=worker_main, name=f'santa-shard-{shard}',
+                args=(shard, self.shards, self.data_dir, self.workers, self.inboxes[shard], self.outbox,
+                      report_done, self.log_level)
+            )
+            process.start()
+            self.processes.append(process)
+        self.control = threading.Thread(target=self._control_loop, name='shard-control', daemon=True)
+        self.control.start()
+
+        deadline = time.monotonic() + self.start_timeout
+        with self.cond:
+            while len(self.ready) + len(self.failed) < self.shards and self.alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(min(remaining, 1.0))
+            ok = len(self.ready) == self.shards
+        if ok:
+            logger.info(f"🔀 Запущено шардов: {self.shards}, комнат в справочнике: {len(self.directory['room'])}")
+        else:
+            logger.error(f"❌ Не запустились шарды: {sorted(set(range(self.shards)) - self.ready)}")
+        return ok
+
+    def stop(self, timeout=30):
+        """Просит шарды сохранить данные и завершиться; зависшие завершаются принудительно"""
+        for inbox in self.inboxes:
+            inbox.put(('stop',))
+        deadline = time.monotonic() + timeout
+        for process in self.processes:
+            process.join(max(0.1, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.error(f"❌ Шард {process.name} не завершился, останавливаю принудительно")
+                process.terminate()
+                process.join(5)
+        self.outbox.put(None)
+        if self.control:
+            self.control.join(5)
+
+    def alive(self):
+        return bool(self.processes) and all(process.is_alive() for process in self.processes)
+
+    # --- Маршрутизация ---
+    def home_of(self, user_id):
+        return self.homes.get(user_id, self.ring.node_for(user_id))
+
+    def submit(self, update):
+        user_id = update_user_id(update)
+        with self.lock:
+            shard = self.affinity.get(user_id)
+            if shard is None:
+                shard = self.home_of(user_id)
+            if user_id in self.pending_state:
+                update[STATE_KEY] = self.pending_state.pop(user_id)
+                update[GUEST_KEY] = shard != self.home_of(user_id)
+            self._attach_rooms(update, user_id, shard)
+            self.routed[shard] += 1
+        self.inboxes[shard].put(('update', update))
+        return True
+
+    def _attach_rooms(self, update, user_id, shard):
+        """Прикладывает к update комнаты пользователя, которых нет на шарде shard (под self.lock)"""
+        update.pop(ROOMS_KEY, None)
+        elsewhere = {room_id: info for room_id, info in self.memberships.get(user_id, {}).items()
+                     if self.directory['room'].get(room_id) != shard}
+        if elsewhere:
+            update[ROOMS_KEY] = elsewhere
+
+    def put(self, update, block=True, timeout=None):
+        """Интерфейс UpdateQueue: UpdatePoller складывает update прямо в кластер"""
+        return self.submit(update)
+
+    def _transfer(self, user_id, shard, update, state):
+        """Передает пользователя шарду shard вместе с update и состоянием диалога"""
+        with self.lock:
+            if shard == self.home_of(user_id):
+                self.affinity.pop(user_id, None)
+            else:
+                self.affinity[user_id] = shard
+            update[STATE_KEY] = state
+            update[GUEST_KEY] = shard != self.home_of(user_id)
+            update[CHECKED_KEY] = True
+            self._attach_rooms(update, user_id, shard)
+            self.routed[shard] += 1
+            self.transfers[shard] += 1
+        self.inboxes[shard].put(('update', update))
+
+    def _control_loop(self):
+        while True:
+            message = self.outbox.get()
+            if message is None:
+                break
+            try:
+                self._handle(message)
+            except Exception as e:
+                logger.error(f"❌ Ошибка координатора шардов ({message[0]}): {e}")
+
+    def _handle(self, message):
+        kind = message[0]
+        if kind == 'done':
+            if self.on_processed:
+                self.on_processed(message[1])
+        elif kind == 'reroute':
+            self.submit(message[1])
+        elif kind == 'resolve':
+            _, sender, user_id, key_kind, key, update, state = message
+            with self.lock:
+                owner = self.directory[key_kind].get(key, sender)
+            self._transfer(user_id, owner, update, state)
+        elif kind == 'release':
+            _, sender, user_id, state = message
+            with self.lock:
+                self.affinity.pop(user_id, None)
+                self.pending_state[user_id] = state
+        elif kind == 'active':
+            _, shard, user_id = message
+            with self.lock:
+                previous = self.homes.get(user_id)
+                self.homes[user_id] = shard
+                if self.affinity.get(user_id) == shard:
+                    del self.affinity[user_id]
+            if previous is not None and previous != shard:
+                self.inboxes[previous].put(('forget', user_id))
+        elif kind == 'member':
+            _, shard, user_id, room_id, title, is_admin, joined = message
+            with self.lock:
+                if joined:
+                    self.memberships.setdefault(user_id, {})[room_id] = (title, is_admin)
+                else:
+                    user_memberships = self.memberships.get(user_id, {})
+                    user_memberships.pop(room_id, None)
+                    if not user_memberships:
+                        self.memberships.pop(user_id, None)
+        elif kind == 'room':
+            _, shard, room_id, code = message
+            with self.lock:
+                self.directory['room'][room_id] = shard
+                self.directory['code'][code] = shard
+        elif kind == 'ready':
+            _, shard, index = message
+            with self.lock:
+                for room_id, code in index['rooms']:
+                    self.directory['room'][room_id] = shard
+                    self.directory['code'][code] = shard
+                for user_id in index['users']:
+                    self.homes[user_id] = shard
+                for user_id, room_id, title, is_admin in index['members']:
+                    self.memberships.setdefault(user_id, {})[room_id] = (title, is_admin)
+            with self.cond:
+                self.ready.add(shard)
+                self.cond.notify_all()
+        elif kind == 'failed':
+            with self.cond:
+                self.failed.add(message[1])
+                self.cond.notify_all()
+        elif kind == 'summary':
+            with self.cond:
+                self.summaries[message[1]] = message[2]
+                self.cond.notify_all()
+
+    # --- Статистика ---
+    def summary(self, timeout=10):
+        """Состояние шардов: комнаты, участники, жеребьевки, гости. Шарды, не ответившие вовремя, пропускаются"""
+        with self.cond:
+            self.summaries = {}
+        for inbox in self.inboxes:
+            inbox.put(('summary',))
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while len(self.summaries) < self.shards:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return dict(self.summaries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'shards': self.shards,
+                'routed': dict(self.routed),
+                'transfers': dict(self.transfers),
+                'guests': len(self.affinity),
+                'rooms': len(self.directory['room'])
+            }
+
+# --- Процесс шарда ---
+
+def _exit_on_signal(signum, frame):
+    # SystemExit проходит через finally основного цикла - данные шарда сохраняются
+    raise SystemExit(0)
+
+def worker_main(shard, shards, data_dir, workers, inbox, outbox, report_done=False, log_level=logging.INFO):
+    """Точка входа процесса шарда: работает в своей папке со своим santa_data.json"""
+    # Ctrl+C получает вся группа процессов - останавливает шарды координатор через inbox
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+    os.makedirs(shard_dir(data_dir, shard), exist_ok=True)
+    os.chdir(shard_dir(data_dir, shard))
+    # Лимит рассылок Telegram общий на бота - делим его между шардами до импорта SantOS
+    os.environ['BROADCAST_RATE'] = str(float(os.environ.get('BROADCAST_RATE', 25)) / shards)
+
+    import SantOS
+    import metrics
+    from log_pipeline import setup_logging
+    from update_queue import UpdateWorkers
+
+    # santa_bot.log шарда - в его папке. force: если главный модуль координатора при импорте
+    # (spawn импортирует его заново) уже настроил логирование в чужой папке, заменяем его;
+    # runtime.start() после этого повторно логирование не настраивает
+    setup_logging(level=log_level, force=True)
+    if not SantOS.runtime.start():
+        outbox.put(('failed', shard))
+        return
+    worker = ShardWorker(SantOS, shard, HashRing(range(shards)), outbox, report_done)
+    worker.install()
+
+    SantOS.date_scheduler.start()
+    SantOS.start_identity_refresher()
+    metrics_port = os.environ.get('METRICS_PORT')
+    if metrics_port:
+        try:
+            metrics.start_http_server(int(metrics_port) + 1 + shard)
+        except OSError as e:
+            logger.error(f"❌ Шард {shard}: не удалось поднять сервер метрик: {e}")
+    threading.Thread(target=worker.autosave, name='shard-autosave', daemon=True).start()
+
+    local = UpdateWorkers(worker.process, workers, maxsize=10000, collapsible_texts=SantOS.MENU_BUTTONS,
+                          on_discard=SantOS.answer_discarded_update)
+    local.start()
+    outbox.put(('ready', shard, worker.index()))
+    logger.info(f"🔀 Шард {shard}/{shards} готов: {len(SantOS.rooms)} комнат, pid {os.getpid()}")
+
+    try:
+        while True:
+            message = inbox.get()
+            kind = message[0]
+            if kind == 'update':
+                local.submit(message[1], block=True)
+            elif kind == 'forget':
+                worker.forget(message[1])
+            elif kind == 'summary':
+                outbox.put(('summary', shard, worker.summary()))
+            elif kind == 'stop':
+                break
+        # Даем воркерам разобрать то, что уже принято
+        deadline = time.monotonic() + 10
+        while local.stats()['depth'] and time.monotonic() < deadline:
+            time.sleep(0.05)
+        # и дослать начатые рассылки (результаты жеребьевки)
+        SantOS.broadcaster.join(timeout=max(0, deadline - time.monotonic()))
+    finally:
+        worker.stopped = True
+        SantOS.save_data()
+        logger.info(f"💾 Шард {shard} сохранил данные и завершается")
+
+class ShardWorker:
+    """Шард внутри процесса: middleware проверки владельца комнаты и учет переданных пользователей"""
+
+    def __init__(self, SantOS, shard, ring, outbox, report_done=False):
+        self.SantOS = SantOS
+        self.shard = shard
+        self.ring = ring
+        self.outbox = outbox
+        self.report_done = report_done
+        self.moved = set()    # переданы на другой шард; их update, пришедшие сюда, отправляем назад координатору
+        self.guests = set()   # пришли сюда на время диалога с комнатой этого шарда
+        self.local = threading.local()  # .handed_off: текущий update передан другому шарду
+        self.remote = {}      # user_id -> комнаты пользователя на других шардах (из последнего update)
+        self.stopped = False
+
+    def install(self):
+        SantOS = self.SantOS
+        # Новая комната должна принадлежать этому шарду, иначе ссылки на нее уйдут не туда
+        SantOS.room_id_filter = lambda room_id: self.ring.node_for(room_id) == self.shard
+        SantOS.room_created_callbacks.append(
+            lambda room: self.outbox.put(('room', self.shard, room.room_id, room.join_code))
+        )
+        SantOS.membership_callbacks.append(self.on_membership)
+        SantOS.external_rooms = lambda user_id: self.remote.get(user_id, {})
+        # После дедупликации, но до антифлуда и метрик: переданный update считается на шарде-владельце
+        SantOS.router.use(self.middleware, before=SantOS.metrics_middleware)
+
+    def index(self):
+        """Комнаты с кодами, пользователи с активной комнатой и участники комнат - для справочника координатора"""
+        rooms = list(self.SantOS.rooms.items())
+        return {
+            'rooms': [(room_id, room.join_code) for room_id, room in rooms],
+            'users': list(self.SantOS.user_rooms),
+            'members': [(user_id, room_id, room.title, room.admin_id == user_id)
+                        for room_id, room in rooms for user_id in list(room.participants)]
+        }
+
+    def on_membership(self, user_id, room_id, joined):
+        room = self.SantOS.rooms.get(room_id)
+        title = room.title if room else ''
+        is_admin = bool(room) and room.admin_id == user_id
+        self.outbox.put(('member', self.shard, user_id, room_id, title, is_admin, joined))
+
+    def referenced_room(self, request):
+        """(вид, ключ) комнаты, к которой обращается update: room_id или код; None, если ни к какой"""
+        if request.kind == 'callback':
+            data = request.data
+            if data.startswith('switch_') and data != 'switch_back':
+                return 'room', data[len('switch_'):]
+            if data.startswith('participants_'):
+                return 'room', data[len('participants_'):].rsplit('_', 1)[0]
+            return None
+        text = request.text
+        if text is None:
+            return None
+        if text.startswith('/start '):
+            parts = text.split()
+            return ('room', parts[1]) if len(parts) > 1 else None
+        state = self.SantOS.user_states.get(request.user_id, {})
+        if state.get('state') == 'joining_by_code' and state.get('step') == 'enter_code' and text != "🔙 Назад":
+            return 'code', text.strip().upper()
+        return None
+
+    def middleware(self, request, call_next):
+        update = request.update
+        user_id = request.user_id
+        if user_id in self.moved:
+            # Пользователь уже передан, а этот update успел прийти сюда
+            self.local.handed_off = True
+            self.outbox.put(('reroute', update))
+            return None
+        if update.get(CHECKED_KEY):
+            return call_next(request)
+
+        reference = self.referenced_room(request)
+        if reference is not None:
+            kind, key = reference
+            local = self.SantOS.rooms if kind == 'room' else self.SantOS.join_codes
+            if key not in local:
+                self.local.handed_off = True
+                self.moved.add(user_id)
+                self.guests.discard(user_id)
+                state = self.SantOS.user_states.pop(user_id, None)
+                self.outbox.put(('resolve', self.shard, user_id, kind, key, update, state))
+                return None
+        return call_next(request)
+
+    def process(self, update):
+        """Обертка process_update для UpdateWorkers шарда"""
+        SantOS = self.SantOS
+        user_id = update_user_id(update)
+        rooms = update.pop(ROOMS_KEY, None)
+        if rooms:
+            self.remote[user_id] = rooms
+        else:
+            self.remote.pop(user_id, None)
+        if STATE_KEY in update:
+            # Пользователь пришел с другого шарда (или вернулся): принимаем его состояние диалога
+            state = update.pop(STATE_KEY)
+            if state:
+                SantOS.user_states[user_id] = state
+            else:
+                SantOS.user_states.pop(user_id, None)
+            self.moved.discard(user_id)
+            if update.pop(GUEST_KEY, False):
+                self.guests.add(user_id)
+            else:
+                self.guests.discard(user_id)
+            # Шард мог уже видеть этот update_id, когда передавал пользователя
+            with SantOS.last_updates_lock:
+                SantOS.last_updates.pop(update.get('update_id'), None)
+
+        active_before = SantOS.user_rooms.get(user_id)
+        self.local.handed_off = False
+        SantOS.process_update(update)
+        if self.local.handed_off:
+            # Очередь multiprocessing сериализует update в фоне - после передачи его не трогаем
+            return
+
+        active = SantOS.user_rooms.get(user_id)
+        if active is not None and active != active_before:
+            self.guests.discard(user_id)
+            self.outbox.put(('active', self.shard, user_id))
+        elif user_id in self.guests and active is None and \
+                SantOS.user_states.get(user_id, {}).get('state', 'main_menu') == 'main_menu':
+            # Диалог с комнатой этого шарда закончился ничем - возвращаем пользователя домой
+            self.guests.discard(user_id)
+            self.moved.add(user_id)
+            self.outbox.put(('release', self.shard, user_id, SantOS.user_states.pop(user_id, None)))
+        if self.report_done:
+            self.outbox.put(('done', update.get('update_id')))
+
+    def forget(self, user_id):
+        """Активная комната пользователя теперь на другом шарде"""
+        if self.SantOS.user_rooms.pop(user_id, None) is not None:
+            self.SantOS._main_keyboard_cache.pop(user_id, None)
+
+    def summary(self):
+        rooms = list(self.SantOS.rooms.values())
+        return {
+            'rooms': len(rooms),
+            'participants': sum(len(room.participants) for room in rooms),
+            'raffled': sum(1 for room in rooms if room.raffle_done),
+            'users': len(self.SantOS.user_rooms),
+            'guests': len(self.guests),
+            'moved': len(self.moved)
+        }
+
+    def autosave(self, interval=300):
+        while not self.stopped:
+            time.sleep(interval)
+            try:
+                self.SantOS.save_data()
+            except Exception as e:
+                logger.error(f"❌ Ошибка автосохранения шарда {self.shard}: {e}")
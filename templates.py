@@ -0,0 +1,155 @@
+"""
+templates.py - Шаблоны исходящих сообщений
+Шаблоны разбираются один раз при импорте, при отправке остается только str.format
+"""
+
+import re
+from string import Formatter
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+def escape_html(text):
+    """Экранирует HTML один раз для всего текста.
+    Обычно экранировать нечего, и проверка наличия символов дешевле любой замены;
+    цепочка .replace на CPython быстрее str.translate со словарем"""
+    text = str(text)
+    if '&' not in text and '<' not in text and '>' not in text:
+        return text
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+TAG_RE = re.compile(r'<(/?)([a-zA-Z-]+)[^>]*>')
+
+def fit_message(text, limit=TELEGRAM_MESSAGE_LIMIT, html=False):
+    """Обрезает текст под лимит Telegram, стараясь резать по границе строки.
+
+    html=True - текст уходит с parse_mode=HTML: разрез не попадает внутрь тега
+    или сущности (&amp;), а оставшиеся открытыми теги закрываются. Иначе Telegram
+    ответит 400 "can't parse entities" и сообщение не дойдет совсем"""
+    if len(text) <= limit:
+        return text
+    # Запас на многоточие и закрывающие теги
+    budget = limit - 1 - (64 if html else 0)
+    cut = text.rfind('\n', 0, budget)
+    if cut < budget // 2:
+        cut = budget
+    if not html:
+        return text[:cut] + '…'
+
+    head = text[:cut]
+    if head.rfind('<') > head.rfind('>'):
+        head = head[:head.rfind('<')]
+    amp = head.rfind('&')
+    if amp != -1 and ';' not in head[amp:]:
+        head = head[:amp]
+    open_tags = []
+    for match in TAG_RE.finditer(head):
+        closing, tag = match.group(1), match.group(2).lower()
+        if not closing:
+            open_tags.append(tag)
+        elif tag in open_tags:
+            del open_tags[len(open_tags) - 1 - open_tags[::-1].index(tag)]
+    return head + '…' + ''.join(f"</{tag}>" for tag in reversed(open_tags))
+
+class Template:
+    """Шаблон в синтаксисе str.format.
+
+    {name} подставляется как есть, {name!h} - с HTML-экранированием,
+    {name:spec} - через format(). Поддерживаются только простые имена полей,
+    лишние именованные аргументы при рендере игнорируются. Все шаблоны - HTML,
+    поэтому длинный результат обрезается с учетом разметки.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.fields = []
+        self.escaped = []
+        body = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if literal:
+                body.append(literal.replace('{', '{{').replace('}', '}}'))
+            if field is None:
+                continue
+            if not field.isidentifier():
+                raise ValueError(f"Неподдерживаемое поле шаблона: {field!r}")
+            if conversion not in (None, 'h'):
+                raise ValueError(f"Неподдерживаемое преобразование: !{conversion}")
+            if field not in self.fields:
+                self.fields.append(field)
+            if conversion == 'h' and field not in self.escaped:
+                self.escaped.append(field)
+            body.append(f"{{{field}:{spec}}}" if spec else f"{{{field}}}")
+        # Экранирование !h делается до подстановки, в самой строке остается обычный str.format
+        self.format_text = ''.join(body)
+
+    def render(self, **values):
+        for field in self.escaped:
+            values[field] = escape_html(values[field])
+        return fit_message(self.format_text.format_map(values), html=True)
+
+# --- Тексты сообщений ---
+MESSAGE_TEMPLATES = {
+    'user_mention_link': '<a href="tg://user?id={user_id}">{full_name!h}</a>',
+    'user_mention_name': '{mention} ({full_name!h})',
+
+    'room_info': (
+        "🏠 Информация о комнате:\n\n"
+        "Название: {title!h}\n"
+        "Роль: {role}\n"
+        "💰 Бюджет: {budget} руб.\n"
+        "📅 Дата: {gift_date!h}\n"
+        "👥 Участников: {participants_count}\n"
+        "🎲 Жеребьевка: {raffle_status}\n"
+        "🔑 Код для друзей: {join_code}\n\n"
+        "Организатор:\n{admin_mention}"
+    ),
+    'room_stats': (
+        "📊 Статистика комнаты: {title!h}\n\n"
+        "👥 Участников: {participants_count}\n"
+        "💰 Бюджет: {budget} руб.\n"
+        "📅 Дата: {gift_date!h}\n"
+        "🎲 Жеребьевка: {raffle_status}\n"
+        "🔑 Код для вступления: {join_code}\n\n"
+        "Организатор:\n{admin_mention}"
+    ),
+    'raffle_result': (
+        "🎉 Жеребьевка проведена!\n\n"
+        "🎁 Вы дарите подарок: {target_mention}\n\n"
+        "Пожелания:\n{wishlist!h}\n\n"
+        "Не дарить:\n{anti_wishlist!h}\n\n"
+        "💰 Бюджет: {budget} руб.\n"
+        "Удачи в выборе подарка! 🎄"
+    ),
+    'recipient': (
+        "🎁 Ваш получатель: {target_mention}\n\n"
+        "🎁 Пожелания:\n{wishlist!h}\n\n"
+        "🚫 Не дарить:\n{anti_wishlist!h}\n\n"
+        "💰 Бюджет: {budget} руб.\n"
+        "Удачи в выборе подарка! 🎄"
+    ),
+    'archived_recipient': (
+        "📦 Комната \"{title!h}\" ({gift_date!h}) в архиве.\n\n"
+        "🎁 Ваш получатель: {target_mention}\n\n"
+        "🎁 Пожелания:\n{wishlist!h}"
+    ),
+    'participant_line': "{role} {mention}",
+    'participants': (
+        "👥 Участники комнаты \"{title!h}\":\n\n{participants}\n\n"
+        "Всего: {participants_count} человек"
+    ),
+    'invite': (
+        "📨 Пригласите друзей в комнату \"{title!h}\":\n\n"
+        "🔗 Ссылка:\n<code>{invite_link!h}</code>\n\n"
+        "🔑 Или код:\n<code>{join_code}</code>\n\n"
+        "👥 Участников: {participants_count}"
+    ),
+    'invite_code_only': (
+        "📨 Пригласите друзей в комнату \"{title!h}\":\n\n"
+        "🔑 Код для вступления:\n<code>{join_code}</code>\n\n"
+        "👥 Участников: {participants_count}"
+    ),
+}
+
+TEMPLATES = {name: Template(text) for name, text in MESSAGE_TEMPLATES.items()}
+
+def render(name, **values):
+    return TEMPLATES[name].render(**values)
@@ -0,0 +1,189 @@
+"""
+tracing.py - Трассировка обработки update
+Спаны в формате, совместимом с OpenTelemetry (OTLP JSON): контекст живет в contextvars,
+завершенные спаны копятся в кольцевом буфере и, если задан TRACE_FILE, пишутся в файл
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import threading
+import contextvars
+from collections import deque
+
+TRACE_FILE = os.environ.get('TRACE_FILE')
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', 10000))
+
+# Выключенная трассировка стоит одной проверки флага
+enabled = os.environ.get('TRACING') == '1' or bool(TRACE_FILE)
+
+_current = contextvars.ContextVar('santa_span', default=None)
+_queue_wait = contextvars.ContextVar('santa_queue_wait', default=None)
+
+finished_spans = deque(maxlen=TRACE_BUFFER_SIZE)
+_file_queue = None
+
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {'key': key, 'value': {'boolValue': value}}
+    if isinstance(value, int):
+        return {'key': key, 'value': {'intValue': str(value)}}
+    if isinstance(value, float):
+        return {'key': key, 'value': {'doubleValue': value}}
+    return {'key': key, 'value': {'stringValue': str(value)}}
+
+class Span:
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns',
+                 'attributes', 'status', 'status_message', '_token')
+
+    def __init__(self, name, parent=None, start_ns=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.parent_id = parent.span_id if parent else None
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = attributes or {}
+        self.status = STATUS_UNSET
+        self.status_message = None
+        self._token = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, message):
+        self.status = STATUS_ERROR
+        self.status_message = str(message)
+
+    def end(self, end_ns=None):
+        self.end_ns = end_ns or time.time_ns()
+        _export(self)
+
+    @property
+    def duration_ms(self):
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc is not None:
+            self.set_error(exc)
+        _current.reset(self._token)
+        self.end()
+
+    def to_dict(self):
+        data = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [_attribute(k, v) for k, v in self.attributes.items()],
+            'status': {'code': self.status}
+        }
+        if self.parent_id:
+            data['parentSpanId'] = self.parent_id
+        if self.status_message:
+            data['status']['message'] = self.status_message
+        return data
+
+class _NoopSpan:
+    """Заглушка на случай выключенной трассировки"""
+
+    def set_attribute(self, key, value):
+        pass
+
+    def set_error(self, message):
+        pass
+
+    def end(self, end_ns=None):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+NOOP_SPAN = _NoopSpan()
+
+def start_span(name, **attributes):
+    """Дочерний спан текущего (или корневой новой трассы); используется как контекстный менеджер"""
+    if not enabled:
+        return NOOP_SPAN
+    return Span(name, _current.get(), attributes=attributes)
+
+def current_span():
+    return (_current.get() or NOOP_SPAN) if enabled else NOOP_SPAN
+
+def note_queue_wait(seconds):
+    """Вызывается потоком, который забрал update из очереди, перед его обработкой"""
+    if enabled:
+        _queue_wait.set(seconds)
+
+def record_queue_wait():
+    """Добавляет в текущую трассу спан ожидания в очереди, если оно было отмечено"""
+    if not enabled:
+        return
+    wait = _queue_wait.get()
+    if wait is None:
+        return
+    _queue_wait.set(None)
+    now = time.time_ns()
+    Span('queue.wait', _current.get(), start_ns=now - int(wait * 1e9)).end(now)
+
+def wrap(func):
+    """Переносит текущий контекст трассы в другой поток (пул, фоновая рассылка)"""
+    if not enabled:
+        return func
+    context = contextvars.copy_context()
+
+    def run_in_context(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+    return run_in_context
+
+def _export(span):
+    finished_spans.append(span)
+    if TRACE_FILE:
+        _file_queue_put(span)
+
+def _file_queue_put(span):
+    global _file_queue
+    if _file_queue is None:
+        _file_queue = queue.SimpleQueue()
+        threading.Thread(target=_file_writer, args=(_file_queue,), name='trace-writer', daemon=True).start()
+    _file_queue.put(span)
+
+def _file_writer(spans):
+    # Спаны одной строкой OTLP JSON: {"resourceSpans": [...]} на каждую пачку
+    with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+        while True:
+            batch = [spans.get()]
+            try:
+                while len(batch) < 500:
+                    batch.append(spans.get_nowait())
+            except queue.Empty:
+                pass
+            f.write(json.dumps({'resourceSpans': [{
+                'resource': {'attributes': [_attribute('service.name', 'santa-bot')]},
+                'scopeSpans': [{'scope': {'name': 'santa-bot'}, 'spans': [s.to_dict() for s in batch]}]
+            }]}, ensure_ascii=False) + '\n')
+            f.flush()
+
+def recent_traces(limit=20, min_duration_ms=0.0):
+    """Последние корневые спаны с дочерними, самые медленные первыми"""
+    spans = list(finished_spans)
+    children = {}
+    for span in spans:
+        if span.parent_id:
+            children.setdefault(span.trace_id, []).append(span)
+    roots = [s for s in spans if not s.parent_id and s.duration_ms >= min_duration_ms]
+    roots.sort(key=lambda s: s.duration_ms, reverse=True)
+    return [(root, children.get(root.trace_id, [])) for root in roots[:limit]]
@@ -0,0 +1,206 @@
+"""
+update_queue.py - Ограниченная очередь входящих update
+Обратное давление на источник, схлопывание повторных нажатий и статистика для подбора числа воркеров
+"""
+
+import time
+import logging
+import threading
+from collections import deque
+
+import tracing
+
+logger = logging.getLogger(__name__)
+
+def update_user_id(update):
+    """user_id отправителя update (0, если его нет)"""
+    for key in ('message', 'edited_message', 'callback_query'):
+        if key in update:
+            return update[key].get('from', {}).get('id', 0)
+    return 0
+
+class QueueFull(Exception):
+    """Очередь заполнена и update не был принят"""
+
+class UpdateQueue:
+    """Очередь update с ограниченной глубиной.
+
+    put() с block=True ждет свободного места (так poller приостанавливает опрос),
+    с block=False сразу бросает QueueFull (так webhook отвечает Telegram ошибкой,
+    и тот повторит доставку позже).
+
+    Повторное нажатие той же кнопки тем же пользователем, пока предыдущее еще
+    ждет в очереди, не ставится второй раз, а считается схлопнутым.
+
+    on_discard(update) вызывается для схлопнутого или не принятого update:
+    нажатию кнопки нужен ответ answerCallbackQuery, иначе у пользователя
+    крутится индикатор загрузки, пока Telegram не сдастся.
+    """
+
+    def __init__(self, maxsize=1000, collapsible_texts=(), on_discard=None):
+        self.maxsize = maxsize
+        self.collapsible_texts = frozenset(collapsible_texts)
+        self.on_discard = on_discard
+        self.items = deque()
+        self.pending_keys = {}
+        self.cond = threading.Condition()
+
+        # Статистика
+        self.enqueued = 0
+        self.processed = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _collapse_key(self, update):
+        if 'callback_query' in update:
+            callback_query = update['callback_query']
+            return (callback_query.get('from', {}).get('id'), 'cb', callback_query.get('data'))
+        message = update.get('message')
+        if message and message.get('text') in self.collapsible_texts:
+            return (message.get('from', {}).get('id'), 'text', message['text'])
+        return None
+
+    def put(self, update, block=True, timeout=None):
+        """Ставит update в очередь; возвращает False, если он был схлопнут"""
+        key = self._collapse_key(update)
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self.cond:
+            if key is not None and key in self.pending_keys:
+                self.collapsed += 1
+                collapsed = True
+            else:
+                collapsed = False
+                while len(self.items) >= self.maxsize:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if not block or (remaining is not None and remaining <= 0):
+                        self.dropped += 1
+                        break
+                    self.cond.wait(remaining)
+                else:
+                    self._append(update, key)
+                    return True
+
+        # Ответ на отброшенное нажатие - вне блокировки очереди. Таймаут блокирующего put
+        # не отбрасывает update: poller повторит попытку
+        if self.on_discard and (collapsed or not block):
+            self.on_discard(update)
+        if collapsed:
+            return False
+        raise QueueFull()
+
+    def _append(self, update, key):
+        self.items.append((update, key, time.monotonic()))
+        if key is not None:
+            self.pending_keys[key] = True
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, len(self.items))
+        self.cond.notify_all()
+
+    def get(self, timeout=None):
+        """Забирает update; возвращает None по таймауту"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.cond:
+            while not self.items:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+
+            update, key, enqueued_at = self.items.popleft()
+            if key is not None:
+                self.pending_keys.pop(key, None)
+
+            wait = time.monotonic() - enqueued_at
+            self.processed += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.cond.notify_all()
+        # Спан ожидания в очереди строится уже в трассе обработки
+        tracing.note_queue_wait(wait)
+        return update
+
+    def drain(self):
+        """Забирает все оставшиеся update (при остановке)"""
+        with self.cond:
+            items, self.items = [update for update, _, _ in self.items], deque()
+            self.pending_keys.clear()
+            self.cond.notify_all()
+            return items
+
+    def __len__(self):
+        return len(self.items)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'depth': len(self.items),
+                'max_depth': self.max_depth,
+                'capacity': self.maxsize,
+                'enqueued': self.enqueued,
+                'processed': self.processed,
+                'collapsed': self.collapsed,
+                'dropped': self.dropped,
+                'avg_wait_ms': round(self.total_wait / self.processed * 1000, 2) if self.processed else 0.0,
+                'max_wait_ms': round(self.max_wait * 1000, 2)
+            }
+
+class UpdateWorkers:
+    """Пул воркеров с отдельной очередью на каждый поток.
+
+    Update одного пользователя всегда попадает в одну и ту же очередь,
+    поэтому его сообщения обрабатываются строго по порядку.
+    """
+
+    def __init__(self, process_func, workers=8, maxsize=1000, collapsible_texts=(), on_discard=None):
+        self.process_func = process_func
+        per_worker = max(1, maxsize // workers)
+        self.queues = [UpdateQueue(per_worker, collapsible_texts, on_discard) for _ in range(workers)]
+        self.threads = []
+        self.stopping = threading.Event()
+
+    def start(self):
+        """Запускает воркеры; после stop() можно запустить снова"""
+        if self.threads:
+            return
+        self.stopping.clear()
+        for i, q in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(q,), name=f'update-worker-{i}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self, timeout=5):
+        """Останавливает воркеры (текущий update дорабатывается) и возвращает необработанные update"""
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        return [update for q in self.queues for update in q.drain()]
+
+    def submit(self, update, block=False):
+        """Ставит update в очередь его пользователя; QueueFull, если она заполнена"""
+        return self.queues[update_user_id(update) % len(self.queues)].put(update, block=block)
+
+    def _worker(self, q):
+        while not self.stopping.is_set():
+            update = q.get(timeout=0.5)
+            if update is None:
+                continue
+            try:
+                self.process_func(update)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки update: {e}")
+
+    def stats(self):
+        """Суммарная статистика по всем очередям"""
+        per_queue = [q.stats() for q in self.queues]
+        total = {key: sum(s[key] for s in per_queue)
+                 for key in ('depth', 'capacity', 'enqueued', 'processed', 'collapsed', 'dropped')}
+        total['max_depth'] = max(s['max_depth'] for s in per_queue)
+        total['max_wait_ms'] = max(s['max_wait_ms'] for s in per_queue)
+        waits = sum(q.total_wait for q in self.queues)
+        total['avg_wait_ms'] = round(waits / total['processed'] * 1000, 2) if total['processed'] else 0.0
+        return total
@@ -0,0 +1,166 @@
+"""
+update_recorder.py - Запись входящих update для последующего воспроизведения
+Пользователи обезличиваются, свободный текст вырезается, запись идет в сжатый JSONL
+в фоновом потоке. Воспроизведение - benchmarks/replay.py
+"""
+
+import re
+import hmac
+import gzip
+import json
+import time
+import queue
+import atexit
+import hashlib
+import logging
+import secrets
+import threading
+
+logger = logging.getLogger(__name__)
+
+DATE_RE = re.compile(r'^\d{1,2}\.\d{1,2}\.\d{4}$')
+NUMBER_RE = re.compile(r'^\d{1,9}$')
+
+def room_token(room_id):
+    return f"<room:{room_id}>"
+
+def code_token(room_id):
+    return f"<code:{room_id}>"
+
+class UpdateRecorder:
+    """Пишет обезличенные update в gzip JSONL.
+
+    Каждая строка: {"t": время приема, "update": {...}, "rooms_created": [...]}.
+    user_id и chat_id заменяются псевдонимами (HMAC с солью, один пользователь -
+    один псевдоним в пределах соли), имена - на условные. Текст сообщений
+    сохраняется только если он управляет ботом: кнопки меню, даты, числа;
+    коды комнат и room_id заменяются ссылками <code:...>/<room:...>, чтобы
+    при воспроизведении подставить коды заново созданных комнат. Остальной
+    текст превращается в строку той же длины из "x".
+    """
+
+    def __init__(self, path, keep_texts=(), is_room=None, room_by_code=None, salt=None):
+        self.path = path
+        self.keep_texts = frozenset(keep_texts)
+        # Бот заменяет словари комнат при загрузке, поэтому смотрим в них через функции
+        self.is_room = is_room or (lambda room_id: False)
+        self.room_by_code = room_by_code or (lambda code: None)
+        self.salt = (salt or secrets.token_hex(16)).encode('utf-8')
+        self.local = threading.local()
+        self.queue = queue.Queue(maxsize=10000)
+        self.recorded = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._writer, name='update-recorder', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+        logger.info(f"📼 Запись update в {path}")
+
+    # --- Обезличивание ---
+    def pseudonym(self, user_id):
+        digest = hmac.new(self.salt, str(user_id).encode('utf-8'), hashlib.sha256).digest()
+        return int.from_bytes(digest[:4], 'big') % 2_000_000_000 + 1
+
+    def _user(self, user):
+        pseudonym = self.pseudonym(user.get('id', 0))
+        anonymized = {'id': pseudonym, 'is_bot': user.get('is_bot', False), 'first_name': f"User{pseudonym}"}
+        if user.get('username'):
+            anonymized['username'] = f"u{pseudonym}"
+        return anonymized
+
+    def _chat(self, chat):
+        return {'id': self.pseudonym(chat.get('id', 0)), 'type': chat.get('type', 'private')}
+
+    def _text(self, text):
+        if text in self.keep_texts or DATE_RE.match(text) or NUMBER_RE.match(text):
+            return text
+        if text.startswith('/'):
+            command, _, payload = text.partition(' ')
+            if self.is_room(payload):
+                return f"{command} {room_token(payload)}"
+            return command if not payload else f"{command} {'x' * len(payload)}"
+        room_id = self.room_by_code(text.strip().upper())
+        if room_id:
+            return code_token(room_id)
+        if text.startswith('🏠 '):
+            # Кнопка комнаты: название - пользовательский текст
+            return '🏠 ' + 'x' * (len(text) - 2)
+        return 'x' * len(text)
+
+    def _callback_data(self, data):
+        return '_'.join(room_token(part) if self.is_room(part) else part for part in data.split('_'))
+
+    def anonymize(self, update):
+        result = {'update_id': update.get('update_id')}
+        message = update.get('message')
+        if message:
+            anonymized = {
+                'message_id': message.get('message_id'),
+                'date': message.get('date'),
+                'from': self._user(message.get('from', {})),
+                'chat': self._chat(message.get('chat', {}))
+            }
+            if 'text' in message:
+                anonymized['text'] = self._text(message['text'])
+            result['message'] = anonymized
+        callback_query = update.get('callback_query')
+        if callback_query:
+            callback_message = callback_query.get('message', {})
+            result['callback_query'] = {
+                'id': str(self.pseudonym(callback_query.get('id'))),
+                'from': self._user(callback_query.get('from', {})),
+                'message': {
+                    'message_id': callback_message.get('message_id'),
+                    'chat': self._chat(callback_message.get('chat', {}))
+                },
+                'data': self._callback_data(callback_query.get('data', ''))
+            }
+        return result
+
+    # --- Запись ---
+    def record(self, update):
+        """Начинает запись update; завершается вызовом finish() после обработки"""
+        try:
+            self.local.entry = {'t': round(time.time(), 3), 'update': self.anonymize(update)}
+        except Exception as e:
+            self.local.entry = None
+            logger.error(f"❌ Ошибка записи update: {e}")
+
+    def note_room_created(self, room_id):
+        """Комната создана обработкой текущего update - при воспроизведении ее room_id будет другим"""
+        entry = getattr(self.local, 'entry', None)
+        if entry is not None:
+            entry.setdefault('rooms_created', []).append(room_id)
+
+    def finish(self):
+        entry = getattr(self.local, 'entry', None)
+        self.local.entry = None
+        if entry is None:
+            return
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            self.dropped += 1
+
+    def _writer(self):
+        # gzip в режиме дозаписи: каждый запуск добавляет новый gzip-член, читается как один файл
+        with gzip.open(self.path, 'at', encoding='utf-8') as f:
+            while True:
+                entry = self.queue.get()
+                if entry is None:
+                    break
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                self.recorded += 1
+                if self.queue.empty():
+                    f.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+def read_recording(path):
+    """Записи из файла по порядку"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
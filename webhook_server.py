@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+webhook_server.py - Прием обновлений Telegram через webhook (Flask)
+Endpoint проверяет секретный токен, кладет update в очередь и сразу отвечает 200,
+обработка идет в фоновых воркерах (при переполнении очереди - 503, Telegram повторит)
+
+Локальная проверка без Telegram:
+    python webhook_server.py updates.json --url http://localhost:8080/telegram/webhook --secret SECRET
+"""
+
+import hmac
+import json
+import hashlib
+import logging
+import argparse
+
+from flask import Flask, Response, request, jsonify
+
+from update_queue import UpdateWorkers, QueueFull
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = '/telegram/webhook'
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+webhook_responses = metrics.counter('santa_webhook_responses', 'Ответы webhook endpoint по кодам', ['status'])
+
+def derive_secret(bot_token):
+    """Секрет по умолчанию, если WEBHOOK_SECRET не задан (Telegram разрешает A-Z, a-z, 0-9, _ и -)"""
+    return hashlib.sha256(f"webhook:{bot_token}".encode('utf-8')).hexdigest()
+
+def create_app(process_func, secret_token, workers=8, maxsize=1000, collapsible_texts=(), on_discard=None):
+    """Создает Flask-приложение с webhook endpoint"""
+    app = Flask(__name__)
+    update_workers = UpdateWorkers(process_func, workers, maxsize, collapsible_texts, on_discard)
+    update_workers.start()
+    app.config['UPDATE_WORKERS'] = update_workers
+
+    @app.route(WEBHOOK_PATH, methods=['POST'])
+    def telegram_webhook():
+        received = request.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(received, secret_token):
+            logger.warning(f"⚠️ Webhook с неверным секретом от {request.remote_addr}")
+            webhook_responses.labels(403).inc()
+            return '', 403
+
+        update = request.get_json(silent=True)
+        if not isinstance(update, dict) or 'update_id' not in update:
+            webhook_responses.labels(400).inc()
+            return '', 400
+
+        try:
+            update_workers.submit(update)
+        except QueueFull:
+            # Telegram повторит доставку позже - это и есть обратное давление для webhook
+            webhook_responses.labels(503).inc()
+            return '', 503
+        webhook_responses.labels(200).inc()
+        return '', 200
+
+    @app.route('/health', methods=['GET'])
+    def health():
+        return jsonify({'ok': True})
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+    return app
+
+def serve(app, port, threads=8):
+    """Обслуживает приложение WSGI-сервером waitress (блокирует поток до остановки процесса)"""
+    try:
+        from waitress import serve as waitress_serve
+    except ImportError:
+        logger.warning("⚠️ waitress не установлен (pip install waitress) - запускаю отладочный сервер Flask")
+        app.run(host='0.0.0.0', port=port, threaded=True)
+        return
+    waitress_serve(app, host='0.0.0.0', port=port, threads=threads)
+
+def set_webhook(base_url, webhook_url, secret_token):
+    """Регистрирует webhook в Telegram"""
+    import requests
+    response = requests.post(
+        f"{base_url}/setWebhook",
+        json={
+            'url': webhook_url,
+            'secret_token': secret_token,
+            'allowed_updates': ['message', 'callback_query'],
+            'max_connections': 40
+        },
+        timeout=10
+    )
+    data = response.json()
+    if not data.get('ok'):
+        logger.error(f"❌ Не удалось установить webhook: {data}")
+        return False
+    logger.info(f"✅ Webhook установлен: {webhook_url}")
+    return True
+
+def delete_webhook(base_url):
+    """Снимает webhook, иначе getUpdates отвечает 409 Conflict"""
+    import requests
+    try:
+        response = requests.post(f"{base_url}/deleteWebhook", timeout=10)
+        return response.status_code == 200
+    except Exception as e:
+        logger.error(f"❌ Ошибка удаления webhook: {e}")
+        return False
+
+def post_recorded_updates(path, url, secret_token):
+    """Отправляет записанные update (JSON-массив или JSON lines) на локальный webhook"""
+    import requests
+    with open(path, 'r', encoding='utf-8') as f:
+        content = f.read().strip()
+    if content.startswith('['):
+        updates = json.loads(content)
+    else:
+        updates = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    ok = 0
+    for update in updates:
+        response = requests.post(url, json=update, headers={SECRET_HEADER: secret_token}, timeout=10)
+        if response.status_code == 200:
+            ok += 1
+        else:
+            print(f"❌ update {update.get('update_id')}: HTTP {response.status_code}")
+    print(f"✅ Отправлено {ok}/{len(updates)} update")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Отправка записанных update на webhook")
+    parser.add_argument('updates', help="Файл с update (JSON-массив или JSON lines)")
+    parser.add_argument('--url', default=f"http://localhost:8080{WEBHOOK_PATH}")
+    parser.add_argument('--secret', required=True)
+    args = parser.parse_args()
+    post_recorded_updates(args.updates, args.url, args.secret)